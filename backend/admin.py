@@ -0,0 +1,64 @@
+"""
+监控接口
+
+- `metrics_router`: /metrics, API进程和调度进程都挂载
+- `router`: /admin/下的tracing和profile, 只挂在调度进程监听本机的`plan.admin_port`上,
+  不对外暴露
+"""
+import asyncio
+
+from fastapi import APIRouter, Response
+from fastapi.responses import PlainTextResponse
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+
+import metrics
+from config import get_config
+from tracing import tracer, profile
+from utils import handles_error
+
+metrics_router = APIRouter()
+router = APIRouter()
+
+
+@metrics_router.get("/metrics")
+def get_metrics():
+    """
+    Prometheus指标
+    """
+    return Response(generate_latest(metrics.registry()), media_type=CONTENT_TYPE_LATEST)
+
+
+@router.post("/admin/tracing/")
+@handles_error
+async def set_tracing(enabled: bool, clear: bool = False):
+    """
+    打开或关闭调度循环的span记录
+    """
+    tracer.enabled = enabled
+    if clear:
+        tracer.clear()
+
+
+@router.get("/admin/traces/")
+async def get_traces(limit: int = 1000, name: str | None = None):
+    """
+    最近记录的span, 从新到旧
+    """
+    return dict(enabled=tracer.enabled, spans=tracer.recent(limit, name))
+
+
+@router.get("/admin/profile/")
+async def get_profile(seconds: float = 10, interval: float = 0.005):
+    """
+    采样所有线程的调用栈`seconds`秒, 下载flamegraph折叠格式的结果
+    """
+    seconds = min(seconds, get_config()["tracing"]["profile_max"])
+    loop = asyncio.get_running_loop()
+    try:
+        result = await loop.run_in_executor(None, profile, seconds, interval)
+    except RuntimeError as e:
+        return PlainTextResponse(str(e), status_code=409)
+    return PlainTextResponse(
+        result,
+        headers={"Content-Disposition": "attachment; filename=profile.folded"},
+    )
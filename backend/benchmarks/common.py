@@ -0,0 +1,65 @@
+"""
+benchmarks共用的工具
+
+临时配置用tests/helpers.py的`use_temp_config`, 必须在导入config/models/handlers
+等模块之前调用
+"""
+import json
+import socket
+import resource
+import threading
+from typing import Dict, List
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentiles(values: List[float], points=(50, 90, 99)) -> Dict[str, float]:
+    """毫秒为单位的分位数"""
+    if not values:
+        return {}
+    values = sorted(values)
+    result = {}
+    for point in points:
+        index = min(len(values) - 1, int(len(values) * point / 100))
+        result[f"p{point}"] = round(values[index] * 1000, 3)
+    result["max"] = round(values[-1] * 1000, 3)
+    return result
+
+
+def max_rss_mb() -> float:
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+class ThreadSampler:
+    """后台定期记录线程数的峰值"""
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.peak = threading.active_count()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, threading.active_count())
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+
+def emit(result: dict, output: str | None = None):
+    """输出一行JSON, 指定`output`时同时写入文件"""
+    text = json.dumps(result, ensure_ascii=False, default=str)
+    print(text)
+    if output:
+        with open(output, "w") as f:
+            f.write(text + "\n")
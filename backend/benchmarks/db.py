@@ -0,0 +1,340 @@
+"""
+数据库层的微基准
+
+在临时SQLite里按不同规模灌入用户、机器人、脚本、已安装脚本、Plan、打卡状态和打卡记录,
+逐项计时JobManager和handlers里的热点, 每个规模输出一行JSON::
+
+    cd backend
+    python -m benchmarks.db --scales 10000,100000 --output bench.json
+
+灌入的数据`modified_at`都在一小时前, 增量加载的计时不会落进JobManager的回看窗口;
+`reload_incremental`是没有变化时的增量加载, `reload_churn`每次先修改`--churn`个用户
+
+指定`--baseline`时和之前的结果比较, 任一项比基线慢超过`--threshold`则退出码为1::
+
+    python -m benchmarks.db --baseline bench.json --threshold 0.2
+"""
+import sys
+import json
+import time
+import random
+import argparse
+import statistics
+from datetime import date, datetime, timedelta
+from typing import Callable, Dict, List
+
+from benchmarks import common
+from tests.helpers import use_temp_config, quiet_logs
+
+ALL_DAY = "00:00-24:00"
+# 灌入数据的modified_at, 早于JobManager.overlap
+BACKDATE = timedelta(hours=1)
+
+
+def timeit(func: Callable, repeat: int, setup: Callable | None = None) -> float:
+    """运行`repeat`次取中位数, `setup`不计入耗时"""
+    durations = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        started = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - started)
+    return statistics.median(durations)
+
+
+def fill(plans: int, plans_per_user: int, records_per_user: int):
+    """清空数据库并按规模灌入数据"""
+    from sqlalchemy import insert
+    from models import (
+        Base,
+        engine,
+        migrate,
+        User,
+        Robot,
+        Script,
+        Installation,
+        Plan,
+        PlanType,
+        Clock,
+        Record,
+    )
+
+    Base.metadata.drop_all(engine)
+    migrate(engine)
+
+    users = max(1, plans // plans_per_user)
+    now = datetime.now() - BACKDATE
+    today = date.today()
+    configuration = {"values": {"clockInRange": ALL_DAY, "clockOutRange": ALL_DAY}}
+
+    def rows(make, count):
+        return [make(index) for index in range(count)]
+
+    with engine.begin() as conn:
+        conn.execute(
+            insert(User),
+            rows(
+                lambda i: dict(
+                    id=f"u{i}", username=f"user{i}", token=f"t{i}", modified_at=now
+                ),
+                users,
+            ),
+        )
+        conn.execute(
+            insert(Robot),
+            rows(
+                lambda i: dict(
+                    id=f"u{i}-r0",
+                    user_id=f"u{i}",
+                    name="robot-0",
+                    deleted=False,
+                    modified_at=now,
+                ),
+                users,
+            ),
+        )
+        conn.execute(
+            insert(Script),
+            rows(
+                lambda i: dict(
+                    id=f"u{i // plans_per_user}-s{i % plans_per_user}",
+                    user_id=f"u{i // plans_per_user}",
+                    name=f"script-{i % plans_per_user}",
+                    updated_at=now,
+                    configuration=configuration,
+                    files=[],
+                    deleted=False,
+                    modified_at=now,
+                ),
+                users * plans_per_user,
+            ),
+        )
+        conn.execute(
+            insert(Installation),
+            rows(
+                lambda i: dict(
+                    id=f"u{i}-i0",
+                    user_id=f"u{i}",
+                    name="installation-0",
+                    configuration=configuration,
+                    deleted=False,
+                    modified_at=now,
+                ),
+                users,
+            ),
+        )
+        conn.execute(
+            insert(Plan),
+            rows(
+                lambda i: dict(
+                    type=PlanType.script,
+                    user_id=f"u{i // plans_per_user}",
+                    robot_id=f"u{i // plans_per_user}-r0",
+                    script_id=f"u{i // plans_per_user}-s{i % plans_per_user}",
+                    ranges={"clockin_range": ALL_DAY, "clockout_range": ALL_DAY},
+                    deleted=False,
+                    modified_at=now,
+                ),
+                users * plans_per_user,
+            ),
+        )
+        conn.execute(
+            insert(Clock),
+            rows(
+                lambda i: dict(
+                    user_id=f"u{i}",
+                    date=today,
+                    clockin=i % 2 == 0,
+                    clockout=False,
+                    modified_at=now,
+                ),
+                users,
+            ),
+        )
+        if records_per_user:
+            conn.execute(
+                insert(Record),
+                rows(
+                    lambda i: dict(
+                        user_id=f"u{i % users}",
+                        robot_id=f"u{i % users}-r0",
+                        script_id=f"u{i % users}-s0",
+                        app_env="production",
+                        timestamp=now - timedelta(minutes=i),
+                        extra={"direction": "in", "done": True},
+                    ),
+                    users * records_per_user,
+                ),
+            )
+    return users
+
+
+def run_scale(plans: int, args) -> Dict[str, float]:
+    from sqlalchemy import update
+    from models import Session, ReadSession, User
+    from schemas import DoneClockRequest, UserInfo, RobotInfo, ScriptInfo
+    from handlers.plan import JobManager
+    from handlers.server import handle_done_clock
+    from handlers.tasks import add_plan, list_plans, update_user
+
+    started = time.perf_counter()
+    users = fill(plans, args.plans_per_user, args.records_per_user)
+    results = {"fill": time.perf_counter() - started}
+    rand = random.Random(plans)
+
+    def get_jobs():
+        list(JobManager().get_jobs())
+
+    results["get_jobs"] = timeit(get_jobs, args.repeat)
+
+    # 增量: 已经全量加载过的JobManager再取一次
+    jobmanager = JobManager()
+    list(jobmanager.get_jobs())
+    results["get_jobs_incremental"] = timeit(
+        lambda: list(jobmanager.get_jobs()), args.repeat
+    )
+
+    def reload_plans():
+        with ReadSession() as session:
+            JobManager().reload_plans(session)
+
+    results["reload_plans"] = timeit(reload_plans, args.repeat)
+
+    loaded = JobManager()
+    with ReadSession() as session:
+        loaded.reload_plans(session)
+
+    def reload_clocks():
+        with ReadSession() as session:
+            loaded.reload_clocks(session)
+
+    results["reload_clocks"] = timeit(reload_clocks, args.repeat)
+
+    # 增量加载: 没有变化, 以及每次有`churn`个用户变化
+    incremental = JobManager()
+    with ReadSession() as session:
+        incremental.reload_models(session)
+
+    def reload_incremental():
+        with ReadSession() as session:
+            incremental.reload_models(session)
+
+    def touch_users():
+        user_ids = [f"u{rand.randrange(users)}" for _ in range(args.churn)]
+        with Session() as session:
+            session.execute(
+                update(User)
+                .where(User.id.in_(user_ids))
+                .values(modified_at=datetime.now())
+            )
+            session.commit()
+
+    results["reload_incremental"] = timeit(reload_incremental, args.repeat)
+    results["reload_churn"] = timeit(reload_incremental, args.repeat, touch_users)
+
+    def done_clock():
+        index = rand.randrange(users)
+        handle_done_clock(
+            DoneClockRequest(
+                app_env="production",
+                user_id=f"u{index}",
+                robot_id=f"u{index}-r0",
+                script_id=f"u{index}-s0",
+                timestamp=datetime.now(),
+                extra={"direction": "in", "done": True},
+            )
+        )
+
+    results["handle_done_clock"] = timeit(done_clock, args.calls)
+
+    def new_plan():
+        index = rand.randrange(users)
+        add_plan(userid=f"u{index}", robotname="robot-0")
+
+    results["add_plan"] = timeit(new_plan, args.calls)
+    results["list_plans"] = timeit(list_plans, args.repeat)
+
+    def sync_user():
+        index = rand.randrange(users)
+        user_id = f"u{index}"
+        update_user(
+            cookie=f"uid={user_id}",
+            user_info=UserInfo(token=f"t{index}", user_id=user_id),
+            robots=[RobotInfo(_id=f"{user_id}-r0", name="robot-0")],
+            scripts=[
+                ScriptInfo(
+                    _id=f"{user_id}-s{j}",
+                    name=f"script-{j}",
+                    updatedAt=datetime.now(),
+                )
+                for j in range(args.plans_per_user)
+            ],
+            installations=[],
+        )
+
+    results["update_user"] = timeit(sync_user, args.calls)
+    return {key: round(value, 6) for key, value in results.items()}
+
+
+def compare(results: List[dict], baseline: List[dict], threshold: float) -> List[str]:
+    """返回比基线慢超过`threshold`的项"""
+    previous = {item["plans"]: item["seconds"] for item in baseline}
+    regressions = []
+    for item in results:
+        base = previous.get(item["plans"])
+        if not base:
+            continue
+        for key, seconds in item["seconds"].items():
+            if key == "fill" or key not in base or base[key] <= 0:
+                continue
+            ratio = seconds / base[key]
+            if ratio > 1 + threshold:
+                regressions.append(
+                    f"{item['plans']} plans {key}: {base[key]:.6f}s -> {seconds:.6f}s"
+                    f" (+{(ratio - 1) * 100:.0f}%)"
+                )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--scales", default="10000,100000", help="逗号分隔的Plan数")
+    parser.add_argument("--plans-per-user", type=int, default=2)
+    parser.add_argument("--records-per-user", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=3, help="批量操作的重复次数")
+    parser.add_argument("--calls", type=int, default=20, help="单次操作的调用次数")
+    parser.add_argument(
+        "--churn", type=int, default=10, help="reload_churn每次修改的用户数"
+    )
+    parser.add_argument("--output", help="把所有结果写入JSON Lines文件")
+    parser.add_argument("--baseline", help="之前--output的结果")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    args = parser.parse_args()
+
+    use_temp_config({"ingest": {"enabled": False}, "tracing": {"enabled": False}})
+    quiet_logs()
+
+    results = []
+    for plans in [int(scale) for scale in args.scales.split(",") if scale]:
+        result = dict(benchmark="db", plans=plans, seconds=run_scale(plans, args))
+        common.emit(result)
+        results.append(result)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = [json.loads(line) for line in f if line.strip()]
+        regressions = compare(results, baseline, args.threshold)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+"""
+端到端吞吐测试
+
+启动本地的假Hamibot服务, 用N个合成用户走一遍真实流程:
+
+1. 按Cookie获取用户信息并连接WebSocket拉取列表, 写入数据库(统计连接耗时)
+2. 为每个用户建`plans`个全天到期的Plan, 每个Plan用单独的机器人
+3. 用Scheduler跑一次tick派发所有Plan, 等全部收到运行确认
+
+输出一行JSON: jobs/sec、连接和Job耗时的分位数、线程数峰值和内存峰值::
+
+    cd backend
+    python -m benchmarks.e2e --users 200 --mode asyncio
+"""
+import time
+import socket
+import argparse
+import multiprocessing
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks import common
+from benchmarks import fake_hamibot
+from tests.helpers import use_temp_config, quiet_logs
+
+
+def wait_for_port(port: int, timeout: float = 10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with socket.socket() as sock:
+            if sock.connect_ex(("127.0.0.1", port)) == 0:
+                return
+        time.sleep(0.05)
+    raise TimeoutError(f"fake hamibot not listening on {port}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--plans", type=int, default=1, help="每个用户的Plan数")
+    parser.add_argument("--scripts", type=int, default=2)
+    parser.add_argument("--installations", type=int, default=2)
+    parser.add_argument("--latency", type=float, default=0.0, help="假服务的回复延迟")
+    parser.add_argument("--mode", default="thread", choices=["thread", "asyncio"])
+    parser.add_argument("--threads", type=int, default=10, help="最大线程数")
+    parser.add_argument("--min-threads", type=int, default=2)
+    parser.add_argument("--queue-size", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=1000)
+    parser.add_argument("--onboard-concurrency", type=int, default=20)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument(
+        "--stall-ticks", type=int, default=10, help="连续多少次tick没有进展就停止派发"
+    )
+    parser.add_argument("--output", help="同时把结果写入文件")
+    args = parser.parse_args()
+
+    port = common.free_port()
+    server = multiprocessing.Process(
+        target=fake_hamibot.serve,
+        args=(port,),
+        kwargs=dict(
+            robots=args.plans,
+            scripts=max(args.scripts, args.plans),
+            installations=args.installations,
+            latency=args.latency,
+        ),
+        daemon=True,
+    )
+    server.start()
+    wait_for_port(port)
+
+    use_temp_config(
+        {
+            "plan": {
+                "mode": args.mode,
+                "threads": args.threads,
+                "min_threads": args.min_threads,
+                "queue_size": args.queue_size,
+                "concurrency": args.concurrency,
+                # 假服务不会回调/done_clock/, 名额一直占着, 同一用户的Plan要能同时运行
+                "user_concurrency": args.plans,
+            },
+            "hamibot": {
+                "robots_url": f"http://127.0.0.1:{port}/dashboard/robots",
+                "websocket_url": f"ws://127.0.0.1:{port}/socket.io/?token=bench",
+                "timeout": 30,
+                "run_timeout": 30,
+            },
+            "ingest": {"enabled": False},
+            "tracing": {"enabled": True, "buffer": 1000000},
+        }
+    )
+    quiet_logs()
+
+    # 配置生效后才能导入项目模块
+    from models import engine, migrate, Session, Plan, PlanType
+    from hamicli import HamiCli
+    import metrics
+    from logger import logger
+    from tracing import tracer
+    from handlers.plan import Scheduler, Dispatch
+    from handlers.tasks import update_users
+
+    migrate(engine)
+
+    with common.ThreadSampler() as sampler:
+        # 1. 添加用户
+        def onboard(index: int):
+            started = time.perf_counter()
+            cli = HamiCli(cookie=f"uid=u{index}", fetch=True, timeout=30)
+            cli.close()
+            return cli, time.perf_counter() - started
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(args.onboard_concurrency) as executor:
+            results = list(executor.map(onboard, range(args.users)))
+        clis = [cli for cli, _ in results]
+        update_users(clis)
+        onboard_seconds = time.perf_counter() - started
+
+        # 2. 建Plan
+        with Session() as session:
+            session.bulk_insert_mappings(
+                Plan,
+                [
+                    dict(
+                        type=PlanType.script,
+                        user_id=cli.user.user_id,
+                        robot_id=cli.robots[index].id,
+                        script_id=cli.scripts[index].id,
+                        ranges={
+                            "clockin_range": fake_hamibot.ALL_DAY,
+                            "clockout_range": fake_hamibot.ALL_DAY,
+                        },
+                    )
+                    for cli in clis
+                    for index in range(args.plans)
+                ],
+            )
+            session.commit()
+
+        # 3. 派发
+        tracer.clear()
+        scheduler = Scheduler()
+        started = time.perf_counter()
+        scheduler.tick(datetime.now())
+        deadline = time.monotonic() + args.timeout
+        # 执行器队列满时一部分Plan会推迟, 继续tick直到全部派发;
+        # 没有任务在运行、也没有新的派发时不会再有进展
+        total = args.users * args.plans
+        entries = scheduler.ledger.entries
+        stalled = 0
+        while (
+            len(entries) < total
+            and stalled < args.stall_ticks
+            and time.monotonic() < deadline
+        ):
+            before = len(entries)
+            scheduler.wakeup.wait(scheduler.deferral)
+            scheduler.wakeup.clear()
+            scheduler.tick(datetime.now())
+            states = [entry.state for entry in list(entries.values())]
+            if len(entries) > before or Dispatch.IN_FLIGHT in states:
+                stalled = 0
+            else:
+                stalled += 1
+        dispatched = len(entries)
+        if dispatched < total:
+            deferred_plans = sorted(scheduler.dispatcher.owners)
+            logger.warning(
+                f"{total - dispatched} plans not dispatched "
+                f"({stalled} ticks without progress), deferred: {deferred_plans[:50]}"
+            )
+        while True:
+            states = [entry.state for entry in list(scheduler.ledger.entries.values())]
+            if Dispatch.IN_FLIGHT not in states or time.monotonic() >= deadline:
+                break
+            time.sleep(0.01)
+        run_seconds = time.perf_counter() - started
+
+    # 超时的话只输出部分结果
+    ok = states.count(Dispatch.SENT)
+    unconfirmed = states.count(Dispatch.UNCONFIRMED)
+    in_flight = states.count(Dispatch.IN_FLIGHT)
+    spans = {}
+    for span in tracer.spans:
+        spans.setdefault(span.name, []).append(span.duration)
+
+    common.emit(
+        dict(
+            benchmark="e2e",
+            mode=args.mode,
+            users=args.users,
+            plans=args.users * args.plans,
+            onboard_seconds=round(onboard_seconds, 3),
+            onboard_latency_ms=common.percentiles([d for _, d in results]),
+            dispatched=dispatched,
+            ok=ok,
+            unconfirmed=unconfirmed,
+            in_flight=in_flight,
+            failed=dispatched - ok - unconfirmed - in_flight,
+            run_seconds=round(run_seconds, 3),
+            jobs_per_sec=round(dispatched / run_seconds, 1) if run_seconds else None,
+            connect_latency_ms=common.percentiles(spans.get("connect", [])),
+            job_latency_ms=common.percentiles(spans.get("job", [])),
+            ack_latency_ms=common.percentiles(spans.get("ack", [])),
+            deferred=int(metrics.scheduler_deferred._value.get()),
+            peak_threads=sampler.peak,
+            max_rss_mb=common.max_rss_mb(),
+        ),
+        args.output,
+    )
+    server.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+"""
+本地的假Hamibot服务
+
+实现HamiCli用到的WebSocket事件和获取用户信息的控制台页面, 数据按用户序号生成:
+
+- Cookie为`uid=u<序号>`, 控制台页面返回对应用户的`window.__NUXT__`
+- 每个用户有`robots`个机器人、`scripts`个脚本、`installations`个已安装脚本,
+  打卡时间段都是全天, 保证Plan一加载就到期
+
+单独运行::
+
+    python -m benchmarks.fake_hamibot --port 9000
+"""
+import json
+import asyncio
+import argparse
+from datetime import datetime, timezone
+
+import socketio
+import uvicorn
+
+PAGE_SIZE = 10
+ALL_DAY = "00:00-24:00"
+
+
+class GatherManager(socketio.AsyncManager):
+    """
+    python-socketio 4.x的AsyncManager.emit把协程直接交给asyncio.wait,
+    Python 3.11起不再支持, 这里改用gather
+    """
+
+    async def emit(
+        self, event, data, namespace, room=None, skip_sid=None, callback=None, **kwargs
+    ):
+        if namespace not in self.rooms or room not in self.rooms[namespace]:
+            return
+        if not isinstance(skip_sid, list):
+            skip_sid = [skip_sid]
+        tasks = []
+        for sid in self.get_participants(namespace, room):
+            if sid not in skip_sid:
+                id = None
+                if callback is not None:
+                    id = self._generate_ack_id(sid, namespace, callback)
+                tasks.append(self.server._emit_internal(sid, event, data, namespace, id))
+        await asyncio.gather(*tasks)
+
+
+class FakeHamibot:
+    def __init__(
+        self,
+        robots: int = 1,
+        scripts: int = 2,
+        installations: int = 2,
+        latency: float = 0.0,
+    ):
+        self.robots = robots
+        self.scripts = scripts
+        self.installations = installations
+        self.latency = latency
+        self.users = {}  # sid => user_id
+        self.runs = 0
+
+        self.sio = socketio.AsyncServer(
+            async_mode="asgi", client_manager=GatherManager()
+        )
+        self.app = socketio.ASGIApp(self.sio, other_asgi_app=self.dashboard)
+        self.sio.on("b:join", self.on_join)
+        self.sio.on("b:script:list", self.on_script_list)
+        self.sio.on("b:installation:list", self.on_installation_list)
+        self.sio.on("b:script:pull", self.on_script_pull)
+        self.sio.on("b:script:run", self.on_run)
+        self.sio.on("b:installation:run", self.on_run)
+        self.sio.on("disconnect", self.on_disconnect)
+
+    @staticmethod
+    def user(user_id: str) -> dict:
+        return {
+            "token": f"token-{user_id}",
+            "userId": user_id,
+            "username": f"user-{user_id}",
+            "email": f"{user_id}@example.com",
+            "avatarUrl": "",
+            "name": user_id,
+            "balance": 0,
+            "role": "user",
+            "plan": "free",
+            "referralCode": "",
+            "referralCount": 0,
+        }
+
+    def configuration(self) -> dict:
+        return {"values": {"clockInRange": ALL_DAY, "clockOutRange": ALL_DAY}}
+
+    def script(self, user_id: str, index: int) -> dict:
+        return {
+            "_id": f"{user_id}-s{index}",
+            "configuration": self.configuration(),
+            "obfuscate": False,
+            "useMessage": False,
+            "name": f"script-{index}",
+            "updatedAt": datetime(2022, 7, 1, tzinfo=timezone.utc).isoformat(),
+            "listingSlug": "",
+        }
+
+    def installation(self, user_id: str, index: int) -> dict:
+        return {
+            "_id": f"{user_id}-i{index}",
+            "configuration": self.configuration(),
+            "plan": {"_id": f"{user_id}-p{index}"},
+            "hasUpdate": False,
+            "settings": {"autoUpdate": False, "autoRenew": False},
+            "slug": f"slug-{index}",
+            "name": f"installation-{index}",
+            "version": "2022.07.28",
+            "icon": "",
+            "useForTask": False,
+        }
+
+    def page(self, items: list, page: int) -> dict:
+        start = (page - 1) * PAGE_SIZE
+        return {
+            "items": items[start : start + PAGE_SIZE],
+            "total": len(items),
+            "pageSize": PAGE_SIZE,
+        }
+
+    async def reply(self, sid: str, event: str, data: dict):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        await self.sio.emit(event, data, room=sid)
+
+    async def dashboard(self, scope, receive, send):
+        """控制台页面, 只认Cookie里的uid"""
+        if scope["type"] != "http":
+            return
+        headers = dict(scope["headers"])
+        cookie = headers.get(b"cookie", b"").decode()
+        user_id = ""
+        for part in cookie.split(";"):
+            key, _, value = part.strip().partition("=")
+            if key == "uid":
+                user_id = value
+
+        if not user_id:
+            body = b"<html>login required</html>"
+        else:
+            # avatarUrl用闭包参数传入, 和真实页面一样需要替换
+            user = self.user(user_id)
+            user.pop("avatarUrl")
+            obj = json.dumps(user)[:-1] + ',"avatarUrl":a}'
+            body = (
+                "<html><script>window.__NUXT__=(function(a,b){return "
+                f'{{layout:"default",data:[{{}}],state:{{auth:{{loggedIn:b,user:{obj}'
+                '}}}}("",true));</script></html>'
+            ).encode()
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [(b"content-type", b"text/html; charset=utf-8")],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
+
+    async def on_join(self, sid, data):
+        user_id = data["userId"]
+        self.users[sid] = user_id
+        await self.reply(sid, "join:success", "ok")
+        robots = [
+            {
+                "_id": f"{user_id}-r{index}",
+                "online": True,
+                "tags": [],
+                "version": "12",
+                "brand": "Fake",
+                "model": "Bench",
+                "appVersionCode": 114,
+                "name": f"robot-{index}",
+            }
+            for index in range(self.robots)
+        ]
+        await self.reply(sid, "robot:list", {"items": robots})
+
+    async def on_script_list(self, sid, data):
+        user_id = self.users[sid]
+        items = [self.script(user_id, index) for index in range(self.scripts)]
+        await self.reply(sid, "script:list:success", self.page(items, data["page"]))
+
+    async def on_installation_list(self, sid, data):
+        user_id = self.users[sid]
+        items = [
+            self.installation(user_id, index) for index in range(self.installations)
+        ]
+        await self.reply(
+            sid, "installation:list:success", self.page(items, data["page"])
+        )
+
+    async def on_script_pull(self, sid, data):
+        detail = {
+            "_id": data["_id"],
+            "files": [{"filename": "index.js", "text": f"// {data['_id']}\n"}],
+            "configuration": self.configuration(),
+            "name": data["_id"],
+        }
+        await self.reply(sid, "script:pull:success", detail)
+
+    async def on_run(self, sid, data):
+        self.runs += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        # 返回值作为ack回复
+        return {"ok": True}
+
+    async def on_disconnect(self, sid):
+        self.users.pop(sid, None)
+
+
+def serve(port: int, host: str = "127.0.0.1", **options):
+    fake = FakeHamibot(**options)
+    uvicorn.run(fake.app, host=host, port=port, log_level="warning")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--robots", type=int, default=1)
+    parser.add_argument("--scripts", type=int, default=2)
+    parser.add_argument("--installations", type=int, default=2)
+    parser.add_argument("--latency", type=float, default=0.0)
+    args = parser.parse_args()
+    serve(
+        args.port,
+        args.host,
+        robots=args.robots,
+        scripts=args.scripts,
+        installations=args.installations,
+        latency=args.latency,
+    )
+
+
+if __name__ == "__main__":
+    main()
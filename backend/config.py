@@ -1,8 +1,7 @@
 import os
 import time
-import pickle
-import functools
-from typing import TypedDict
+import threading
+from typing import Callable, TypedDict, Dict, List, Tuple
 
 import yaml
 
@@ -15,38 +14,205 @@ if ENV == "production":
 else:
     filename = "dev.yaml"
 
-config_path = os.path.join(os.path.dirname(__file__), "configs", filename)
+# CONFIG_PATH可以指定其他配置文件, 比如benchmarks里的临时配置
+config_path = os.environ.get("CONFIG_PATH") or os.path.join(
+    os.path.dirname(__file__), "configs", filename
+)
 
 
-def cached(seconds: int):
-    def outer(func, cached={}):
-        @functools.wraps(func)
-        def inner(*args, **kwargs):
-            key = pickle.dumps((args, kwargs))
-            if key not in cached or time.time() - cached[key][0] > seconds:
-                cached[key] = (time.time(), func(*args, **kwargs))
-            return cached[key][1]
+class Database(TypedDict):
+    url: str
+    async_url: str
+    readonly_url: str
+    profile: str
 
-        return inner
 
-    return outer
+class Records(TypedDict):
+    raw_days: int
+    archive_months: int
+    compact_at: str
 
 
-class Database(TypedDict):
-    url: str
+class Cluster(TypedDict):
+    enabled: bool
+    node_id: str
+    shards: int
+    vnodes: int
+    lease_ttl: float
+    heartbeat: float
+
+
+class Tracing(TypedDict):
+    enabled: bool
+    buffer: int
+    profile_max: float
+
+
+class Storage(TypedDict):
+    journal_mode: str
+    synchronous: str
+    mmap_size: int
+    cache_size: int
+    busy_timeout: int
+    pool_size: int
+    max_overflow: int
 
 
 class Executor(TypedDict):
     threads: int
 
 
+class Plan(TypedDict):
+    threads: int
+    min_threads: int
+    thread_idle: float
+    queue_size: int
+    robot_concurrency: int
+    user_concurrency: int
+    robot_hold: float
+    interval: int
+    resync: int
+    cooldown: int
+    backoff: int
+    backoff_max: int
+    mode: str
+    concurrency: int
+    notify_socket: str
+    admin_port: int
+
+
+class Server(TypedDict):
+    workers: int
+    metrics_dir: str
+
+
+class Hamibot(TypedDict):
+    timeout: float
+    idle_timeout: float
+    run_timeout: float
+    http_pool: int
+    onboard_concurrency: int
+    user_info_ttl: float
+    robots_url: str
+    websocket_url: str
+
+
+class Ingest(TypedDict):
+    enabled: bool
+    flush_interval: float
+    flush_size: int
+    flush_retries: int
+
+
 class Config(TypedDict):
     database: Database
     executor: Executor
+    plan: Plan
+    server: Server
+    hamibot: Hamibot
+    ingest: Ingest
+    records: Records
+    tracing: Tracing
+    cluster: Cluster
+    storage: Dict[str, Storage]
+
+
+Subscriber = Callable[[Config, Config], None]
+
+
+class ConfigStore:
+    """
+    配置文件的内存副本
+
+    `get`不解析文件, 每`check_interval`秒最多stat一次, 文件的mtime或大小变化时才重新读取;
+    重新读取后有变化的, 调用`subscribe`注册的回调`callback(旧配置, 新配置)`
+    """
+
+    check_interval = 1.0
+
+    def __init__(self, path: str):
+        self.path = path
+        self.stamp: Tuple[int, int] | None = None
+        self.next_check = 0.0
+        self.subscribers: List[Tuple[Subscriber, Tuple[str, ...]]] = []
+        self.lock = threading.Lock()
+        self.watcher: threading.Thread | None = None
+        self.config: Config = self.load()
+
+    def load(self) -> Config:
+        stat = os.stat(self.path)
+        with open(self.path) as f:
+            loaded: Config = yaml.load(f, yaml.CSafeLoader)
+        self.stamp = (stat.st_mtime_ns, stat.st_size)
+        logger.debug(loaded)
+        return loaded
+
+    def get(self) -> Config:
+        if time.monotonic() >= self.next_check:
+            self.check()
+        return self.config
+
+    def check(self) -> bool:
+        """文件有变化时重新读取, 返回配置是否变化"""
+        self.next_check = time.monotonic() + self.check_interval
+        try:
+            stat = os.stat(self.path)
+        except OSError as e:
+            logger.error(f"config {self.path}: {e}")
+            return False
+        if (stat.st_mtime_ns, stat.st_size) == self.stamp:
+            return False
+
+        with self.lock:
+            old = self.config
+            try:
+                new = self.load()
+            except Exception as e:
+                # 写了一半或格式错误, 继续用旧配置, 等文件再次变化
+                self.stamp = (stat.st_mtime_ns, stat.st_size)
+                logger.error(f"failed to reload config {self.path}: {e}")
+                return False
+            if new == old:
+                return False
+            self.config = new
+
+        logger.info(f"config reloaded from {self.path}")
+        for callback, sections in list(self.subscribers):
+            if sections and all(old.get(key) == new.get(key) for key in sections):
+                continue
+            try:
+                callback(old, new)
+            except Exception as e:
+                logger.exception(f"config subscriber {callback}: {e}")
+        return True
+
+    def subscribe(self, callback: Subscriber, *sections: str):
+        """配置变化时调用`callback`, 指定`sections`时只关心这些顶层配置"""
+        self.subscribers.append((callback, sections))
+
+    def unsubscribe(self, callback: Subscriber):
+        self.subscribers = [item for item in self.subscribers if item[0] != callback]
+
+    def watch(self) -> threading.Thread:
+        """
+        在后台线程定期检查配置文件
+
+        即使没有人调用`get`, 回调也能及时收到变化; 同一进程只启动一个
+        """
+        with self.lock:
+            if self.watcher is None:
+                self.watcher = threading.Thread(target=self.run, daemon=True)
+                self.watcher.start()
+        return self.watcher
+
+    def run(self):
+        while True:
+            time.sleep(self.check_interval)
+            self.check()
+
+
+store = ConfigStore(config_path)
 
 
-@cached(seconds=60)
 def get_config() -> Config:
-    loaded: Config = yaml.load(open(config_path), yaml.CSafeLoader)
-    logger.debug(loaded)
-    return loaded
+    return store.get()
@@ -7,45 +7,527 @@ A Websocket Client to Hamibot Console
 
 1. 先访问 https://hamibot.com/dashboard/robots 拿到基本信息
 """
-import re
+import abc
+import math
 import time
-from typing import List
+import hashlib
+import functools
+import asyncio
+import threading
+from typing import List, Dict, Set, Deque, Tuple, Callable
+from datetime import datetime
+from collections import deque
+from concurrent.futures import Future
+from contextlib import contextmanager, asynccontextmanager
 
-import pyjson5
 import socketio
 import requests
 
+import nuxt
+import metrics
+from tracing import tracer
 from schemas import UserInfo, RobotInfo, ScriptInfo, InstallationInfo
+from config import get_config
 from logger import logger
 from utils import handles_error
 
 
-URL_ROBOTS = "https://hamibot.com/dashboard/robots"
-URL_WEBSOCKET = "wss://hamibot.com/socket.io/?token=x3xF4gG9oHbBnGhOE9TGgPjcDxc78DUn"
+# user_id => {script_id: updatedAt}, 由调用方从数据库读取
+ScriptVersions = Callable[[str], Dict[str, datetime]]
 
+URL_ROBOTS = get_config()["hamibot"]["robots_url"]
+URL_WEBSOCKET = get_config()["hamibot"]["websocket_url"]
 
-def get_user_info(cookie: str) -> UserInfo:
-    """获取用户信息"""
-    resp = requests.get(URL_ROBOTS, headers={"Cookie": cookie})
-    m = re.compile(r"return ({.*})\((null.*)\)\)").search(resp.text)
-    if not m:
+
+def http_session(pool_size: int = 100) -> requests.Session:
+    """共享keep-alive连接池的HTTP会话"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+http = http_session(get_config()["hamibot"]["http_pool"])
+
+
+class UserInfoCache:
+    """
+    按Cookie缓存用户信息, `ttl`秒后过期
+
+    key是Cookie的sha256, 不在内存里保存Cookie原文
+    """
+
+    def __init__(self, ttl: float, max_size: int = 10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.items: Dict[str, Tuple[float, UserInfo]] = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(cookie: str) -> str:
+        return hashlib.sha256(cookie.encode()).hexdigest()
+
+    def get(self, cookie: str) -> UserInfo | None:
+        key = self.key(cookie)
+        with self.lock:
+            item = self.items.get(key)
+            if item and item[0] > time.time():
+                return item[1]
+            self.items.pop(key, None)
+            return None
+
+    def put(self, cookie: str, user_info: UserInfo):
+        now = time.time()
+        with self.lock:
+            if len(self.items) >= self.max_size:
+                for key in [k for k, (exp, _) in self.items.items() if exp <= now]:
+                    del self.items[key]
+                while len(self.items) >= self.max_size:
+                    del self.items[next(iter(self.items))]
+            self.items[self.key(cookie)] = (now + self.ttl, user_info)
+
+    def invalidate(self, cookie: str):
+        with self.lock:
+            self.items.pop(self.key(cookie), None)
+
+
+user_info_cache = UserInfoCache(get_config()["hamibot"]["user_info_ttl"])
+
+
+def parse_user_info(html: str) -> UserInfo:
+    """从控制台页面的`window.__NUXT__`里取出state.auth.user"""
+    try:
+        info = nuxt.extract_state(html, ["state", "auth", "user"])
+    except ValueError as e:
+        raise RuntimeError(f"cannot parse user info from url: {URL_ROBOTS}, {e}")
+    if not isinstance(info, dict):
         raise RuntimeError(f"cannot parse user info from url: {URL_ROBOTS}")
-    else:
-        res = m.group(1)
-        for i, val in enumerate(m.group(2).split(",")):
-            res = res.replace(f':{chr(ord("a") + i)},', ":" + val + ",")
-            res = res.replace(f':{chr(ord("a") + i)}}}', ":" + val + "}")
-        info = pyjson5.decode(res[:-1])
-        return UserInfo(**info["state"]["auth"]["user"])
+    return UserInfo(**info)
+
+
+def get_user_info(cookie: str, timeout: float = 10, refresh: bool = False) -> UserInfo:
+    """获取用户信息, `refresh`为True时跳过缓存"""
+    if not refresh:
+        user_info = user_info_cache.get(cookie)
+        if user_info:
+            return user_info
+    resp = http.get(URL_ROBOTS, headers={"Cookie": cookie}, timeout=timeout)
+    user_info = parse_user_info(resp.text)
+    user_info_cache.put(cookie, user_info)
+    return user_info
+
+
+class BaseHamiCli(abc.ABC):
+    """
+    HamiCli/AsyncHamiCli共用的协议处理
+
+    子类提供`sio`以及`send`/`drop`/`notify`的具体实现
+    """
+
+    ROBOT_LIST = 0
+    SCRIPT_LIST = 1
+    INSTALLATION_LIST = 2
+
+    # 运行指令 => 服务端的确认消息
+    RUN_ACKS = {
+        "b:script:run": "script:run:success",
+        "b:installation:run": "installation:run:success",
+    }
+
+    def __init__(self, user_info: UserInfo):
+        self.user = user_info
+        self.cookie: str | None = None
+        self.joined = False
+        self.fetch = True
+        self.last_used = time.time()
+        self.successes: List[bool] = []
+        self.error: str | None = None
+        # 运行指令 => 等待确认的(scriptId, robotId, handle), 按发送顺序
+        self.pending_runs: Dict[str, Deque[Tuple[str, str, object]]] = {
+            event: deque() for event in self.RUN_ACKS
+        }
+        self.runs_lock = threading.Lock()
+        # 服务端用ack回调确认过运行指令后, 不再用广播的确认消息完成handle
+        self.run_callbacks = False
+        self.robots: List[RobotInfo] = []
+        # id => info, 按收到的顺序
+        self.script_index: Dict[str, ScriptInfo] = {}
+        self.installation_index: Dict[str, InstallationInfo] = {}
+        # 列表类型 => 总页数(不知道总数时为None)/已收到的页数
+        self.list_pages: Dict[int, int | None] = {}
+        self.list_received: Dict[int, int] = {}
+        self.scripts_listed = False
+        self.pending_pulls: Set[str] = set()
+        # 连接当前阶段的开始时间, 用于统计各阶段耗时
+        self.phase_at: float | None = None
+        # 已保存的脚本 id => updatedAt, 没变的脚本不再拉取文件
+        self.script_versions: Dict[str, datetime] = {}
+
+    @property
+    def scripts(self) -> List[ScriptInfo]:
+        return list(self.script_index.values())
+
+    @property
+    def installations(self) -> List[InstallationInfo]:
+        return list(self.installation_index.values())
+
+    @abc.abstractmethod
+    def send(self, event: str, data: dict):
+        """发送WebSocket消息"""
+
+    @abc.abstractmethod
+    def drop(self):
+        """断开连接"""
+
+    @abc.abstractmethod
+    def notify(self):
+        """列表拿全或登录失败时唤醒等待connect的一方"""
+
+    def register(self):
+        """绑定WebSocket事件"""
+        sio = self.sio
+        sio.on("connect_error", self.on_connect_error)
+        sio.on("connect", self.on_connect)
+        sio.on("join:success", self.on_join_success)
+        sio.on("join:conflict", self.on_join_conflict)
+        sio.on("join:unauthorized", self.on_join_failed)
+        sio.on("join_failed", self.on_join_failed)
+        sio.on("robot:list", self.on_robot_list)
+        sio.on("script:list:success", self.on_script_list)
+        sio.on("script:pull:success", self.on_script_detail)
+        sio.on("installation:list:success", self.on_installation_list)
+        for event, ack in self.RUN_ACKS.items():
+            sio.on(ack, functools.partial(self.on_run_ack, event))
+
+    def reset(self, fetch: bool):
+        self.fetch = fetch
+        self.error = None
+        self.list_pages.clear()
+        self.list_received.clear()
+        self.scripts_listed = False
+        self.pending_pulls.clear()
+        self.phase_at = time.perf_counter()
+        if fetch:
+            self.script_index.clear()
+            self.installation_index.clear()
+            self.successes = [False, False, False]
+        else:
+            self.successes = [False]
+
+    @property
+    def ready(self) -> bool:
+        return sum(self.successes) == len(self.successes)
+
+    def mark_phase(self, phase: str):
+        """记录连接阶段`phase`结束"""
+        if self.phase_at is None:
+            return
+        now = time.perf_counter()
+        metrics.hamicli_connect_seconds.labels(phase).observe(now - self.phase_at)
+        self.phase_at = now
+
+    def succeed(self, index: int):
+        self.successes[index] = True
+        if self.ready:
+            self.mark_phase("list")
+            self.phase_at = None
+            self.notify()
+
+    def fail(self, msg):
+        self.error = str(msg)
+        self.notify()
+
+    def on_connect_error(self, msg):
+        logger.error(f"failed to connnet websocket: {msg}")
+
+    def on_connect(self):
+        self.mark_phase("handshake")
+        # 登录'聊天室'
+        self.send("b:join", self.user.dict(by_alias=True))
+
+    def on_join_success(self, msg):
+        logger.info(f"{self.user.username} joined: {msg}")
+        self.joined = True
+        self.mark_phase("join")
+
+        if self.fetch:
+            # 查看自有脚本列表
+            self.request_page(self.SCRIPT_LIST, 1)
+
+            # 查看已安装脚本列表
+            self.request_page(self.INSTALLATION_LIST, 1)
+
+    def request_page(self, index: int, page: int):
+        if index == self.SCRIPT_LIST:
+            self.send("b:script:list", {"page": page})
+        else:
+            self.send("b:installation:list", {"page": page, "hasRecently": 0})
 
+    def receive_page(self, index: int, msg: dict) -> bool:
+        """
+        记录收到一页列表, 返回是否已经收齐
 
-class HamiCli:
+        第一页带回`total`后一次性请求剩下的所有页,
+        没有`total`时退回到收到满页再请求下一页
+        """
+        received = self.list_received[index] = self.list_received.get(index, 0) + 1
+        page_size = msg.get("pageSize") or 0
+        if received == 1:
+            total = msg.get("total")
+            pages = None
+            if total is not None and page_size:
+                pages = max(1, math.ceil(total / page_size))
+                for page in range(2, pages + 1):
+                    self.request_page(index, page)
+            self.list_pages[index] = pages
+
+        pages = self.list_pages[index]
+        if pages is None:
+            if page_size and len(msg["items"]) == page_size:
+                self.request_page(index, received + 1)
+                return False
+            return True
+        return received >= pages
+
+    def check_scripts(self):
+        """脚本列表收齐并且文件都拉取完才算完成"""
+        if self.scripts_listed and not self.pending_pulls:
+            self.succeed(self.SCRIPT_LIST)
+
+    def on_join_conflict(self, msg):
+        self.joined = False
+        self.drop()
+        self.fail(f"joined elsewhere: {msg}")
+        logger.info(f"{self.user.username} joined elsewhere: {msg}")
+
+    def on_join_failed(self, msg):
+        self.joined = False
+        self.drop()
+        self.fail(f"join failed: {msg}")
+        if self.cookie:
+            # Cookie可能已经失效, 下次重新获取用户信息
+            user_info_cache.invalidate(self.cookie)
+        logger.error(f"connect failed: {msg}")
+
+    @handles_error
+    def on_robot_list(self, msg):
+        """
+        收到robot:list消息
+
+        该消息在连接成功后会推送
+        Example::
+        {
+            "items": [
+                {
+                    "_id": "62e213120e4a4558984af087",
+                    "online": true,
+                    "tags": [],
+                    "version": "12",
+                    "brand": "Xiaomi",
+                    "model": "M2007J1SC",
+                    "appVersionCode": 114,
+                    "name": "Bot01",
+                }
+            ]
+        }
+        """
+        robots = []
+        for item in msg["items"]:
+            ri = RobotInfo(**item)
+            ri.user_id = self.user.user_id
+            robots.append(ri)
+        self.robots = robots
+
+        logger.info(f"found {len(msg['items'])} robots")
+        self.succeed(self.ROBOT_LIST)
+
+    @handles_error
+    def on_script_list(self, msg):
+        """
+        b:script:list的回复消息
+
+        Example::
+        {
+            "items": [
+                {
+                    "_id": "62e2182e0e4a4558984b73df",
+                    "configuration": {
+                    },
+                    "obfuscate": false,
+                    "useMessage": false,
+                    "name": "飞书打卡",
+                    "updatedAt": "2022-07-29T11:50:33.858Z",
+                    "listingSlug": "73NeY",
+                }
+            ],
+            "total": 1,
+            "pageSize": 10,
+        }
+        """
+        for item in msg["items"]:
+            si = ScriptInfo(**item)
+            si.user_id = self.user.user_id
+            updated_at = si.updated_at.replace(tzinfo=None)
+            if self.script_versions.get(si.id) != updated_at:
+                self.pending_pulls.add(si.id)
+                self.send("b:script:pull", {"_id": si.id})
+            self.script_index[si.id] = si
+
+        logger.info(f"found {len(msg['items'])} scripts")
+        if self.receive_page(self.SCRIPT_LIST, msg):
+            self.scripts_listed = True
+            self.check_scripts()
+
+    @handles_error
+    def on_script_detail(self, msg):
+        """
+        b:script:pull的回复消息
+
+        Example::
+        {
+            "_id": "62e2182e0e4a4558984b73df",
+            "files": [
+                {
+                    "object": "file",
+                    "_id": "62e2182e0e4a4558984b73e0",
+                    "filename": "index.js",
+                    "type": "application/javascript",
+                    "size": 5991,
+                    "dir": "",
+                    "path": "",
+                    "text": "...",
+                }
+            ],
+            "configuration": {},
+            "name": "飞书打卡",
+        }
+        """
+        script_info = self.script_index.get(msg["_id"])
+        if script_info:
+            script_info.configuration = msg["configuration"]
+            script_info.files = msg["files"]
+        self.pending_pulls.discard(msg["_id"])
+        self.check_scripts()
+
+    @handles_error
+    def on_installation_list(self, msg):
+        """
+        b:installation:list的回复消息
+
+        Example::
+        {
+            "items": [
+                {
+                    "_id": "62e37ef9da4dcb7369c7daf4",
+                    "configuration": {
+                    },
+                    "plan": {"_id": "62e37ef9da4dcb7369c7daf3"},
+                    "hasUpdate": false,
+                    "settings": {"autoUpdate": false, "autoRenew": false},
+                    "slug": "XufO7",
+                    "name": "钉钉自动打卡",
+                    "version": "2022.07.28.540",
+                    "icon": "https://usercontent.hamibot.com/avatars/mlc/22/b2/225dcc05c5c8d148215fa471d91bfeb2",
+                    "useForTask": false,
+                },
+            ],
+            "total": 2,
+            "pageSize": 10,
+            "recently": [
+                {
+                    "_id": "627f16a932ed68743d2514da",
+                    "name": "叮咚嗨选(新农人2.0)，每天7个广告获取积分，当前积分每个7元",
+                    "slug": "kAi2q",
+                    "icon": "https://usercontent.hamibot.com/avatars/mlc/bc/25/bc3a6a2b9c3cbf18d7bd20ab9f905625",
+                    "developer": {
+                        "username": "lao8",
+                        "avatarUrl": "https://usercontent.hamibot.com/avatars/uc/02/ed/024508a6d8cca9366c8f551ca25eeded",
+                        "name": "老八，微信jiaming20131227",
+                        "developer": true,
+                    },
+                    "version": "2022.08.02.10",
+                },
+            ],
+        }
+        """
+        for item in msg["items"]:
+            ii = InstallationInfo(**item)
+            ii.user_id = self.user.user_id
+            self.installation_index[ii.id] = ii
+
+        logger.info(f"found {len(msg['items'])} installations")
+        if self.receive_page(self.INSTALLATION_LIST, msg):
+            self.succeed(self.INSTALLATION_LIST)
+
+    def on_run_ack(self, event: str, msg=None):
+        """
+        广播的运行确认消息, 只在服务端不回ack时使用
+
+        每个handle只由一种消息完成: 同一次运行的ack回调和广播都到达时,
+        广播不能顺延去完成下一次运行。消息里带scriptId/robotId时只完成对应的运行,
+        否则完成最早的一个
+        """
+        if self.run_callbacks:
+            return
+        script_id = robot_id = None
+        if isinstance(msg, dict):
+            script_id, robot_id = msg.get("scriptId"), msg.get("robotId")
+
+        with self.runs_lock:
+            pending = self.pending_runs[event]
+            for entry in list(pending):
+                run_script_id, run_robot_id, handle = entry
+                if handle.done():
+                    pending.remove(entry)
+                    continue
+                if script_id and script_id != run_script_id:
+                    continue
+                if robot_id and robot_id != run_robot_id:
+                    continue
+                pending.remove(entry)
+                handle.set_result(msg)
+                break
+
+    def on_run_callback(self, handle, *args):
+        """运行指令的ack回调, 只完成自己那一次运行"""
+        self.run_callbacks = True
+        if not handle.done():
+            handle.set_result(args[0] if args else None)
+
+    def track_run(self, event: str, script_id: str, robot: RobotInfo, handle):
+        with self.runs_lock:
+            pending = self.pending_runs[event]
+            # 清掉已经确认或超时放弃的handle
+            while pending and pending[0][2].done():
+                pending.popleft()
+            pending.append((script_id, robot.id, handle))
+        return handle
+
+    def run_payload(self, script_id: str, robot: RobotInfo) -> dict:
+        return {
+            "scriptId": script_id,
+            "robots": [
+                {
+                    "robotId": robot.id,
+                    "robotName": robot.name,
+                    "version": robot.version,
+                    "appVersionCode": robot.app_version_code,
+                }
+            ],
+        }
+
+
+class HamiCli(BaseHamiCli):
     def __init__(
         self,
         cookie: str | None = None,
         user_info: UserInfo | None = None,
         fetch: bool = True,
         timeout: float = 5,
+        script_versions: ScriptVersions | None = None,
     ):
         if not cookie and not user_info:
             raise RuntimeError("should provide either `cookie` or `user_info`")
@@ -56,12 +538,14 @@ class HamiCli:
         if not user_info:
             raise RuntimeError("user info not fetched")
 
-        self.user = user_info
-        self.robots: List[RobotInfo] = []
-        self.scripts: List[ScriptInfo] = []
-        self.installations: List[InstallationInfo] = []
+        super().__init__(user_info)
+        self.cookie = cookie
+        if fetch and script_versions:
+            self.script_versions = script_versions(user_info.user_id)
 
         self.sio = socketio.Client(reconnection=False, engineio_logger=True)
+        self.ready_event = threading.Event()
+        self.register()
 
         try:
             self.connect(user_info=user_info, fetch=fetch, timeout=timeout)
@@ -70,6 +554,15 @@ class HamiCli:
                 self.sio.disconnect()
             raise e
 
+    def send(self, event: str, data: dict):
+        self.sio.emit(event, data)
+
+    def drop(self):
+        self.sio.disconnect()
+
+    def notify(self):
+        self.ready_event.set()
+
     def connect(self, user_info: UserInfo, timeout: float = 5, fetch: bool = True):
         """
         连接WebSocket
@@ -77,269 +570,369 @@ class HamiCli:
         连上后等待获取robot/script/installation信息后返回
         超时或验证失败则抛出异常RuntimeError/TimeoutError
         """
-        sio = self.sio
-
-        script_page = 1
-        installation_page = 1
-        ROBOT_LIST = 0
-        SCRIPT_LIST = 1
-        INSTALLATION_LIST = 2
-        if fetch:
-            successes = [False, False, False]
-        else:
-            successes = [False]
-
-        @sio.on("connect_error")
-        def connect_error(msg):
-            logger.error(f"failed to connnet websocket: {msg}")
-
-        @sio.on("connect")
-        def connect():
-            # 登录'聊天室'
-            sio.emit("b:join", user_info.dict(by_alias=True))
-
-        @sio.on("join:success")
-        def join_success(msg):
-            logger.info(f"{user_info.username} joined: {msg}")
-
-            if fetch:
-                # 查看自有脚本列表
-                sio.emit("b:script:list", {"page": script_page})
-
-                # 查看已安装脚本列表
-                sio.emit(
-                    "b:installation:list", {"page": installation_page, "hasRecently": 0}
-                )
-
-        @sio.on("join:conflict")
-        def join_conflict(msg):
-            sio.disconnect()
-            logger.info(f"{user_info.username} joined elsewhere: {msg}")
-
-        def join_failed(msg):
-            sio.disconnect()
-            logger.error(f"connect failed: {msg}")
-
-        sio.on("join:unauthorized", join_failed)
-        sio.on("join_failed", join_failed)
-
-        @sio.on("robot:list")
-        @handles_error
-        def robot_list(msg):
-            """
-            收到robot:list消息
-
-            该消息在连接成功后会推送
-            Example::
-            {
-                "items": [
-                    {
-                        "_id": "62e213120e4a4558984af087",
-                        "online": true,
-                        "tags": [],
-                        "version": "12",
-                        "brand": "Xiaomi",
-                        "model": "M2007J1SC",
-                        "appVersionCode": 114,
-                        "name": "Bot01",
-                    }
-                ]
-            }
-            """
-            robots = []
-            for item in msg["items"]:
-                ri = RobotInfo(**item)
-                ri.user_id = user_info.user_id
-                robots.append(ri)
-            self.robots = robots
-
-            logger.info(f"found {len(msg['items'])} robots")
-            successes[ROBOT_LIST] = True
-
-        @sio.on("script:list:success")
-        @handles_error
-        def script_list(msg):
-            """
-            b:script:list的回复消息
-
-            Example::
-            {
-                "items": [
-                    {
-                        "_id": "62e2182e0e4a4558984b73df",
-                        "configuration": {
-                        },
-                        "obfuscate": false,
-                        "useMessage": false,
-                        "name": "飞书打卡",
-                        "updatedAt": "2022-07-29T11:50:33.858Z",
-                        "listingSlug": "73NeY",
-                    }
-                ],
-                "total": 1,
-                "pageSize": 10,
-            }
-            """
-            for item in msg["items"]:
-                si = ScriptInfo(**item)
-                si.user_id = user_info.user_id
-                sio.emit("b:script:pull", {"_id": si.id})
-                self.scripts.append(si)
-
-            if len(msg["items"]) == msg["pageSize"]:
-                script_page += 1
-                sio.emit("b:script:list", {"page": script_page})
-
-            logger.info(f"found {len(msg['items'])} scripts")
-            successes[SCRIPT_LIST] = True
-
-        @sio.on("script:pull:success")
-        @handles_error
-        def script_detail(msg):
-            """
-            b:script:pull的回复消息
-
-            Example::
-            {
-                "_id": "62e2182e0e4a4558984b73df",
-                "files": [
-                    {
-                        "object": "file",
-                        "_id": "62e2182e0e4a4558984b73e0",
-                        "filename": "index.js",
-                        "type": "application/javascript",
-                        "size": 5991,
-                        "dir": "",
-                        "path": "",
-                        "text": "...",
-                    }
-                ],
-                "configuration": {},
-                "name": "飞书打卡",
-            }
-            """
-            for script_info in self.scripts:
-                if script_info.id == msg["_id"]:
-                    script_info.configuration = msg["configuration"]
-                    script_info.files = msg["files"]
-                    break
-
-        @sio.on("installation:list:success")
-        @handles_error
-        def installation_list(msg):
-            """
-            b:installation:list的回复消息
-
-            Example::
-            {
-                "items": [
-                    {
-                        "_id": "62e37ef9da4dcb7369c7daf4",
-                        "configuration": {
-                        },
-                        "plan": {"_id": "62e37ef9da4dcb7369c7daf3"},
-                        "hasUpdate": false,
-                        "settings": {"autoUpdate": false, "autoRenew": false},
-                        "slug": "XufO7",
-                        "name": "钉钉自动打卡",
-                        "version": "2022.07.28.540",
-                        "icon": "https://usercontent.hamibot.com/avatars/mlc/22/b2/225dcc05c5c8d148215fa471d91bfeb2",
-                        "useForTask": false,
-                    },
-                ],
-                "total": 2,
-                "pageSize": 10,
-                "recently": [
-                    {
-                        "_id": "627f16a932ed68743d2514da",
-                        "name": "叮咚嗨选(新农人2.0)，每天7个广告获取积分，当前积分每个7元",
-                        "slug": "kAi2q",
-                        "icon": "https://usercontent.hamibot.com/avatars/mlc/bc/25/bc3a6a2b9c3cbf18d7bd20ab9f905625",
-                        "developer": {
-                            "username": "lao8",
-                            "avatarUrl": "https://usercontent.hamibot.com/avatars/uc/02/ed/024508a6d8cca9366c8f551ca25eeded",
-                            "name": "老八，微信jiaming20131227",
-                            "developer": true,
-                        },
-                        "version": "2022.08.02.10",
-                    },
-                ],
-            }
-            """
-            for item in msg["items"]:
-                ii = InstallationInfo(**item)
-                ii.user_id = user_info.user_id
-                self.installations.append(ii)
-
-            if len(msg["items"]) == msg["pageSize"]:
-                installation_page += 1
-                sio.emit(
-                    "b:installation:list", {"page": installation_page, "hasRecently": 0}
-                )
-
-            logger.info(f"found {len(msg['items'])} installations")
-            successes[INSTALLATION_LIST] = True
+        self.user = user_info
+        self.ready_event.clear()
+        self.reset(fetch)
 
-        sio.connect(URL_WEBSOCKET, transports=["websocket"])
+        self.sio.connect(URL_WEBSOCKET, transports=["websocket"])
 
         # 等待全部列表信息返回
-        start_time = time.time()
-        interval = 0.008
-        while sum(successes) != len(successes):
-            time.sleep(interval)
-            interval += min(interval, 0.5)
-            if time.time() - start_time > timeout:
-                raise TimeoutError(
-                    f"failed to connect to websocket, timed out in {timeout} seconds"
-                )
+        if not self.ready_event.wait(timeout):
+            raise TimeoutError(
+                f"failed to connect to websocket, timed out in {timeout} seconds"
+            )
+        if self.error:
+            raise RuntimeError(self.error)
+
+    @property
+    def alive(self) -> bool:
+        """连接仍然可用(已连接且已登录)"""
+        return self.joined and self.sio.connected
 
     def close(self):
+        self.joined = False
         if self.sio.connected:
             self.sio.disconnect()
 
-    def run_script(self, script_id: str, robot: RobotInfo):
+    def emit_run(self, event: str, script_id: str, robot: RobotInfo) -> Future:
+        handle = self.track_run(event, script_id, robot, Future())
+        callback = functools.partial(self.on_run_callback, handle)
+        self.sio.emit(event, self.run_payload(script_id, robot), callback=callback)
+        return handle
+
+    def run_script(self, script_id: str, robot: RobotInfo) -> Future:
         """
         运行自己的脚本
 
+        返回的Future在服务端确认后完成, 可用`handle.result(timeout)`等待
+
         # ["b:script:run",{"scriptId":"62e2182e0e4a4558984b73df",
         # "robots":[{"robotId":"62e213120e4a4558984af087","robotName":"Bot01","version":"12","appVersionCode":114}]}]
         """
-        self.sio.emit(
-            "b:script:run",
-            {
-                "scriptId": script_id,
-                "robots": [
-                    {
-                        "robotId": robot.id,
-                        "robotName": robot.name,
-                        "version": robot.version,
-                        "appVersionCode": robot.app_version_code,
-                    }
-                ],
-            },
-        )
+        return self.emit_run("b:script:run", script_id, robot)
 
-    def run_installation(self, script_id: str, robot: RobotInfo):
+    def run_installation(self, script_id: str, robot: RobotInfo) -> Future:
         """
         运行安装的脚本
 
+        返回的Future在服务端确认后完成, 可用`handle.result(timeout)`等待
+
         # ["b:installation:run",{"scriptId":"62e37ef9da4dcb7369c7daf4",
         # "robots":[{"robotId":"62e213120e4a4558984af087","robotName":"Bot01","version":"12","appVersionCode":114}]}]
         """
-        self.sio.emit(
-            "b:installation:run",
-            {
-                "scriptId": script_id,
-                "robots": [
-                    {
-                        "robotId": robot.id,
-                        "robotName": robot.name,
-                        "version": robot.version,
-                        "appVersionCode": robot.app_version_code,
-                    }
-                ],
-            },
+        return self.emit_run("b:installation:run", script_id, robot)
+
+
+class AsyncHamiCli(BaseHamiCli):
+    """
+    基于socketio.AsyncClient的HamiCli
+
+    用法::
+
+        cli = await AsyncHamiCli.create(user_info=user_info, fetch=False)
+        await cli.run_script(script_id, robot)
+    """
+
+    def __init__(self, user_info: UserInfo):
+        super().__init__(user_info)
+        self.sio = socketio.AsyncClient(reconnection=False, engineio_logger=True)
+        self.tasks: Set[asyncio.Task] = set()
+        self.ready_event = asyncio.Event()
+        self.register()
+
+    @classmethod
+    async def create(
+        cls,
+        cookie: str | None = None,
+        user_info: UserInfo | None = None,
+        fetch: bool = True,
+        timeout: float = 5,
+        script_versions: ScriptVersions | None = None,
+    ) -> "AsyncHamiCli":
+        if not cookie and not user_info:
+            raise RuntimeError("should provide either `cookie` or `user_info`")
+
+        loop = asyncio.get_running_loop()
+        if not user_info and cookie:
+            user_info = await loop.run_in_executor(None, get_user_info, cookie)
+
+        if not user_info:
+            raise RuntimeError("user info not fetched")
+
+        cli = cls(user_info)
+        cli.cookie = cookie
+        if fetch and script_versions:
+            cli.script_versions = await loop.run_in_executor(
+                None, script_versions, user_info.user_id
+            )
+        try:
+            await cli.connect(user_info=user_info, fetch=fetch, timeout=timeout)
+        except BaseException as e:
+            await cli.close()
+            raise e
+        return cli
+
+    def send(self, event: str, data: dict):
+        # 事件回调里不能await, 交给事件循环发送
+        task = asyncio.ensure_future(self.sio.emit(event, data))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def drop(self):
+        task = asyncio.ensure_future(self.sio.disconnect())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def notify(self):
+        self.ready_event.set()
+
+    async def connect(
+        self, user_info: UserInfo, timeout: float = 5, fetch: bool = True
+    ):
+        """
+        连接WebSocket
+
+        同HamiCli.connect
+        """
+        self.user = user_info
+        self.ready_event.clear()
+        self.reset(fetch)
+
+        await self.sio.connect(URL_WEBSOCKET, transports=["websocket"])
+
+        try:
+            await asyncio.wait_for(self.ready_event.wait(), timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(
+                f"failed to connect to websocket, timed out in {timeout} seconds"
+            )
+        if self.error:
+            raise RuntimeError(self.error)
+
+    @property
+    def alive(self) -> bool:
+        return self.joined and self.sio.connected
+
+    async def close(self):
+        self.joined = False
+        if self.sio.connected:
+            await self.sio.disconnect()
+
+    async def emit_run(
+        self, event: str, script_id: str, robot: RobotInfo
+    ) -> asyncio.Future:
+        handle = self.track_run(
+            event, script_id, robot, asyncio.get_running_loop().create_future()
+        )
+        callback = functools.partial(self.on_run_callback, handle)
+        await self.sio.emit(
+            event, self.run_payload(script_id, robot), callback=callback
         )
+        return handle
+
+    async def run_script(self, script_id: str, robot: RobotInfo) -> asyncio.Future:
+        """运行自己的脚本, 返回服务端确认后完成的Future"""
+        return await self.emit_run("b:script:run", script_id, robot)
+
+    async def run_installation(
+        self, script_id: str, robot: RobotInfo
+    ) -> asyncio.Future:
+        """运行安装的脚本, 返回服务端确认后完成的Future"""
+        return await self.emit_run("b:installation:run", script_id, robot)
+
+
+class HamiCliPool:
+    """
+    按用户维护的HamiCli长连接池
+
+    连接登录后一直保留, 空闲超过`idle_timeout`秒后关闭;
+    遇到join:conflict/join:unauthorized等断开的情况, 下次取用时重新连接;
+    调用`watch`后由后台线程定期清理, 不依赖下一次`get`
+    """
+
+    def __init__(self, idle_timeout: float = 300, timeout: float = 5):
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.clis: Dict[str, HamiCli] = {}
+        self.locks: Dict[str, threading.Lock] = {}
+        self.lock = threading.Lock()
+        self.last_evicted = time.time()
+        self.watcher: threading.Thread | None = None
+
+    @property
+    def evict_interval(self) -> float:
+        return min(self.idle_timeout, 10)
+
+    def user_lock(self, user_id: str) -> threading.Lock:
+        with self.lock:
+            if user_id not in self.locks:
+                self.locks[user_id] = threading.Lock()
+            return self.locks[user_id]
+
+    def get(self, user_info: UserInfo) -> HamiCli:
+        """取出已登录的连接, 没有或已失效则新建"""
+        self.evict_idle()
+
+        with self.user_lock(user_info.user_id):
+            cli = self.clis.get(user_info.user_id)
+            if cli and (not cli.alive or cli.user.token != user_info.token):
+                logger.info(f"reconnecting {user_info.username}")
+                self.discard(cli)
+                cli = None
+
+            if not cli:
+                with tracer.span("connect", user_id=user_info.user_id):
+                    cli = HamiCli(
+                        user_info=user_info, fetch=False, timeout=self.timeout
+                    )
+                self.clis[user_info.user_id] = cli
+
+            cli.last_used = time.time()
+            return cli
+
+    @contextmanager
+    def session(self, user_info: UserInfo):
+        """
+        以上下文的方式取用连接
+
+        使用过程中出错则丢弃该连接, 下次取用时重连
+        """
+        cli = self.get(user_info)
+        try:
+            yield cli
+        except Exception:
+            self.discard(cli)
+            raise
+        finally:
+            cli.last_used = time.time()
+
+    def discard(self, cli: HamiCli):
+        if self.clis.get(cli.user.user_id) is cli:
+            self.clis.pop(cli.user.user_id, None)
+        cli.close()
+
+    def evict_idle(self):
+        """关闭空闲过久的连接"""
+        now = time.time()
+        if now - self.last_evicted < self.evict_interval:
+            return
+        self.last_evicted = now
+
+        for cli in list(self.clis.values()):
+            # 持有用户锁再检查一次, 避免关掉刚被get取走的连接
+            with self.user_lock(cli.user.user_id):
+                if not cli.alive or now - cli.last_used > self.idle_timeout:
+                    logger.debug(f"evicting connection of {cli.user.username}")
+                    self.discard(cli)
+
+    def watch(self) -> threading.Thread:
+        """在后台线程定期清理空闲连接, 同一个连接池只启动一个"""
+        with self.lock:
+            if self.watcher is None:
+                self.watcher = threading.Thread(target=self.run, daemon=True)
+                self.watcher.start()
+        return self.watcher
+
+    def run(self):
+        while True:
+            time.sleep(self.evict_interval)
+            try:
+                self.evict_idle()
+            except Exception as e:
+                logger.error(f"evicting idle connections failed: {e}")
+
+    def close(self):
+        for cli in list(self.clis.values()):
+            self.discard(cli)
+
+
+class AsyncHamiCliPool:
+    """
+    HamiCliPool的asyncio版本, 只能在创建它的事件循环中使用
+    """
+
+    def __init__(self, idle_timeout: float = 300, timeout: float = 5):
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.clis: Dict[str, AsyncHamiCli] = {}
+        self.locks: Dict[str, asyncio.Lock] = {}
+        self.last_evicted = time.time()
+        self.watcher: asyncio.Task | None = None
+
+    @property
+    def evict_interval(self) -> float:
+        return min(self.idle_timeout, 10)
+
+    async def get(self, user_info: UserInfo) -> AsyncHamiCli:
+        await self.evict_idle()
+
+        lock = self.locks.setdefault(user_info.user_id, asyncio.Lock())
+        async with lock:
+            cli = self.clis.get(user_info.user_id)
+            if cli and (not cli.alive or cli.user.token != user_info.token):
+                logger.info(f"reconnecting {user_info.username}")
+                await self.discard(cli)
+                cli = None
+
+            if not cli:
+                with tracer.span("connect", user_id=user_info.user_id):
+                    cli = await AsyncHamiCli.create(
+                        user_info=user_info, fetch=False, timeout=self.timeout
+                    )
+                self.clis[user_info.user_id] = cli
+
+            cli.last_used = time.time()
+            return cli
+
+    @asynccontextmanager
+    async def session(self, user_info: UserInfo):
+        cli = await self.get(user_info)
+        try:
+            yield cli
+        except Exception:
+            await self.discard(cli)
+            raise
+        finally:
+            cli.last_used = time.time()
+
+    async def discard(self, cli: AsyncHamiCli):
+        if self.clis.get(cli.user.user_id) is cli:
+            self.clis.pop(cli.user.user_id, None)
+        await cli.close()
+
+    async def evict_idle(self):
+        now = time.time()
+        if now - self.last_evicted < self.evict_interval:
+            return
+        self.last_evicted = now
+
+        for cli in list(self.clis.values()):
+            lock = self.locks.setdefault(cli.user.user_id, asyncio.Lock())
+            async with lock:
+                if not cli.alive or now - cli.last_used > self.idle_timeout:
+                    logger.debug(f"evicting connection of {cli.user.username}")
+                    await self.discard(cli)
+
+    def watch(self) -> asyncio.Task:
+        """在事件循环里定期清理空闲连接, 需要在事件循环内调用"""
+        if self.watcher is None:
+            self.watcher = asyncio.get_running_loop().create_task(self.run())
+        return self.watcher
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.evict_interval)
+            try:
+                await self.evict_idle()
+            except Exception as e:
+                logger.error(f"evicting idle connections failed: {e}")
+
+    async def close(self):
+        if self.watcher:
+            self.watcher.cancel()
+            self.watcher = None
+        for cli in list(self.clis.values()):
+            await self.discard(cli)
 
 
 def test_cli():
@@ -0,0 +1,128 @@
+"""
+脚本文件正文的内容寻址存储
+
+正文按sha256去重、zlib压缩后存进blobs表, Script.files里只保留元信息和"blob"引用;
+正文还直接存在Script.files里的旧数据用`pack_inline_files`迁移(`inv migrate-db`)
+"""
+import zlib
+import hashlib
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Set
+
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.dialects.sqlite import insert
+
+from logger import logger
+from models import Blob, Script, Session
+
+
+def put_blobs(session: Session, texts: Iterable[str]) -> List[str]:
+    """
+    保存正文, 已经存在的不再写入, 返回对应的hash
+
+    先更新已有正文的`referenced_at`(同时拿到写锁, 和`prune_blobs`的删除串行),
+    再查一次跳过已有正文的压缩; 并发同步的用户可能同时写入同一份正文, 冲突时忽略
+    """
+    contents: Dict[str, bytes] = {}
+    hashes = []
+    for text in texts:
+        data = text.encode()
+        hash = hashlib.sha256(data).hexdigest()
+        contents.setdefault(hash, data)
+        hashes.append(hash)
+    if not contents:
+        return hashes
+
+    now = datetime.now()
+    in_contents = Blob.hash.in_(list(contents))
+    session.execute(update(Blob).where(in_contents).values(referenced_at=now))
+    existing = set(session.execute(select(Blob.hash).where(in_contents)).scalars())
+    missing = [
+        dict(
+            hash=hash,
+            size=len(data),
+            data=zlib.compress(data),
+            created_at=now,
+            referenced_at=now,
+        )
+        for hash, data in contents.items()
+        if hash not in existing
+    ]
+    if missing:
+        session.execute(insert(Blob).on_conflict_do_nothing(), missing)
+        logger.debug(f"stored {len(missing)} new blobs")
+    return hashes
+
+
+def get_blobs(session: Session, hashes: Iterable[str]) -> Dict[str, str]:
+    statement = select(Blob.hash, Blob.data).where(Blob.hash.in_(list(set(hashes))))
+    return {
+        hash: zlib.decompress(data).decode()
+        for hash, data in session.execute(statement)
+    }
+
+
+def pack_files(session: Session, files: List[dict]) -> List[dict]:
+    """把b:script:pull返回的files里的正文换成blob引用"""
+    texts = [file.get("text") or "" for file in files]
+    packed = []
+    for file, hash in zip(files, put_blobs(session, texts)):
+        file = {key: value for key, value in file.items() if key != "text"}
+        file["blob"] = hash
+        packed.append(file)
+    return packed
+
+
+def unpack_files(session: Session, files: List[dict] | None) -> List[dict]:
+    """还原带正文的files, 兼容正文还直接存在Script.files里的旧数据"""
+    files = files or []
+    texts = get_blobs(session, (file["blob"] for file in files if "blob" in file))
+    unpacked = []
+    for file in files:
+        file = dict(file)
+        if "blob" in file:
+            file["text"] = texts.get(file.pop("blob"), "")
+        unpacked.append(file)
+    return unpacked
+
+
+def pack_inline_files(session: Session) -> int:
+    """把正文还直接存在Script.files里的旧数据换成blob引用, 返回迁移的脚本数"""
+    statement = select(Script.id, Script.files).where(Script.files.is_not(None))
+    updates = [
+        dict(id=script_id, files=pack_files(session, files))
+        for script_id, files in session.execute(statement).all()
+        if files and all("blob" not in file for file in files)
+    ]
+    if updates:
+        session.bulk_update_mappings(Script, updates)
+    return len(updates)
+
+
+def prune_blobs(session: Session, grace: timedelta = timedelta(days=1)) -> int:
+    """
+    删除没有被任何Script引用的正文
+
+    `grace`之内被`put_blobs`引用过的不删: 并发同步的脚本可能刚跳过了这份正文,
+    Script.files还没提交。删除时再判断一次, 不会删掉扫描之后才被引用的正文
+    """
+    stale = func.coalesce(Blob.referenced_at, Blob.created_at) < datetime.now() - grace
+    referenced: Set[str] = set()
+    for files in session.execute(select(Script.files)).scalars():
+        referenced.update(file["blob"] for file in files or [] if "blob" in file)
+
+    unused = [
+        hash
+        for hash in session.execute(select(Blob.hash).where(stale)).scalars()
+        if hash not in referenced
+    ]
+    pruned = 0
+    for i in range(0, len(unused), 500):
+        result = session.execute(
+            delete(Blob)
+            .where(Blob.hash.in_(unused[i : i + 500]))
+            .where(stale)
+            .execution_options(synchronize_session=False)
+        )
+        pruned += result.rowcount
+    return pruned
@@ -0,0 +1,238 @@
+"""
+多个调度节点之间的分片协调
+
+- Plan按用户分到`cluster.shards`个分片(models.shard_of)
+- 每个节点定期在scheduler_nodes里心跳, 心跳未过期的节点组成一致性哈希环,
+  环决定每个分片应该归哪个节点
+- 分片通过shard_leases的租约转移: 节点只放弃不再归自己的分片, 只接手
+  没有租约或租约已过期的分片, 所以任何时刻一个分片最多只有一个持有者
+- 派发前把(plan_id, phase)写进plan_dispatches, 接手分片的节点据此恢复
+  DispatchLedger, 不会重复派发刚被前一个节点派发过的Plan
+"""
+import os
+import bisect
+import socket
+import hashlib
+from typing import Dict, Iterable, List, Set, Tuple
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, insert, or_, select, update
+
+from config import get_config
+from logger import logger
+from models import Session, SchedulerNode, ShardLease, PlanDispatch
+
+
+def ring_hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """一致性哈希环, 每个节点放`vnodes`个虚拟节点"""
+
+    def __init__(self, nodes: Iterable[str], vnodes: int = 32):
+        points = sorted(
+            (ring_hash(f"{node}#{index}"), node)
+            for node in nodes
+            for index in range(vnodes)
+        )
+        self.hashes = [point for point, _ in points]
+        self.nodes = [node for _, node in points]
+
+    def owner(self, key: str) -> str | None:
+        if not self.nodes:
+            return None
+        index = bisect.bisect(self.hashes, ring_hash(key)) % len(self.hashes)
+        return self.nodes[index]
+
+
+def default_node_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class Cluster:
+    """
+    当前节点在集群里的身份和持有的分片
+
+    `heartbeat`需要每隔`cluster.heartbeat`秒调用一次;
+    续约失败超过`lease_ttl`后`valid`返回False, 调度器应停止派发
+    """
+
+    def __init__(
+        self,
+        node_id: str | None = None,
+        shards: int | None = None,
+        vnodes: int | None = None,
+        lease_ttl: float | None = None,
+        heartbeat: float | None = None,
+    ):
+        config = get_config()["cluster"]
+        self.node_id = node_id or config["node_id"] or default_node_id()
+        self.shards = shards or config["shards"]
+        self.vnodes = vnodes or config["vnodes"]
+        self.lease_ttl = timedelta(seconds=lease_ttl or config["lease_ttl"])
+        self.interval = timedelta(seconds=heartbeat or config["heartbeat"])
+        self.owned: Set[int] = set()
+        self.nodes: List[str] = []
+        self.valid_until = datetime.min
+        self.next_heartbeat = datetime.min
+
+    def due(self, now: datetime) -> bool:
+        return now >= self.next_heartbeat
+
+    def valid(self, now: datetime) -> bool:
+        """租约仍然有效, 可以派发"""
+        return now < self.valid_until
+
+    def heartbeat(self, now: datetime) -> Tuple[Set[int], Set[int]]:
+        """
+        心跳、放弃不再归自己的分片并接手/续约归自己的分片
+
+        返回(新接手的分片, 失去的分片)
+        """
+        self.next_heartbeat = now + self.interval
+        expires_at = now + self.lease_ttl
+        try:
+            with Session() as session:
+                self.beat(session, now)
+                self.nodes = self.live_nodes(session, now)
+                ring = HashRing(self.nodes, self.vnodes)
+                desired = {
+                    shard
+                    for shard in range(self.shards)
+                    if ring.owner(str(shard)) == self.node_id
+                }
+                self.ensure_leases(session)
+
+                # 先放弃, 其他节点在下一次心跳时才能接手
+                session.execute(
+                    update(ShardLease)
+                    .where(ShardLease.node_id == self.node_id)
+                    .where(ShardLease.shard.not_in(desired))
+                    .values(node_id=None, expires_at=now)
+                )
+                session.execute(
+                    update(ShardLease)
+                    .where(ShardLease.shard.in_(desired))
+                    .where(
+                        or_(
+                            ShardLease.node_id == self.node_id,
+                            ShardLease.node_id.is_(None),
+                            ShardLease.expires_at < now,
+                        )
+                    )
+                    .values(node_id=self.node_id, expires_at=expires_at)
+                )
+                owned = set(
+                    session.execute(
+                        select(ShardLease.shard)
+                        .where(ShardLease.node_id == self.node_id)
+                        .where(ShardLease.expires_at > now)
+                    ).scalars()
+                )
+                session.commit()
+        except Exception as e:
+            logger.error(f"cluster heartbeat failed: {e}")
+            return set(), set()
+
+        # 留出一个心跳间隔的余量, 保证租约过期、别的节点接手之前本节点已停止派发
+        self.valid_until = expires_at - self.interval
+        acquired, lost = owned - self.owned, self.owned - owned
+        self.owned = owned
+        if acquired or lost:
+            logger.info(
+                f"{self.node_id} owns {len(owned)}/{self.shards} shards "
+                f"(+{len(acquired)} -{len(lost)}), nodes: {self.nodes}"
+            )
+        return acquired, lost
+
+    def beat(self, session: Session, now: datetime):
+        # 先写再读: SQLite的读事务升级为写事务时不会等待busy_timeout
+        result = session.execute(
+            update(SchedulerNode)
+            .where(SchedulerNode.id == self.node_id)
+            .values(heartbeat_at=now)
+        )
+        if not result.rowcount:
+            session.add(
+                SchedulerNode(
+                    id=self.node_id,
+                    host=socket.gethostname(),
+                    pid=os.getpid(),
+                    heartbeat_at=now,
+                )
+            )
+            session.flush()
+
+    def live_nodes(self, session: Session, now: datetime) -> List[str]:
+        statement = select(SchedulerNode.id).where(
+            SchedulerNode.heartbeat_at > now - self.lease_ttl
+        )
+        return sorted(session.execute(statement).scalars())
+
+    def ensure_leases(self, session: Session):
+        existing = set(session.execute(select(ShardLease.shard)).scalars())
+        missing = [
+            dict(shard=shard) for shard in range(self.shards) if shard not in existing
+        ]
+        if missing:
+            session.execute(insert(ShardLease), missing)
+
+    def leave(self):
+        """正常退出时让出所有分片, 其他节点不必等租约过期"""
+        with Session() as session:
+            session.execute(
+                update(ShardLease)
+                .where(ShardLease.node_id == self.node_id)
+                .values(node_id=None, expires_at=datetime.now())
+            )
+            session.execute(
+                delete(SchedulerNode).where(SchedulerNode.id == self.node_id)
+            )
+            session.commit()
+        self.owned = set()
+        self.valid_until = datetime.min
+
+    def log_dispatches(self, dispatches: List[Tuple[int, str]], now: datetime):
+        """派发前记下(plan_id, phase)"""
+        if not dispatches:
+            return
+        plan_ids = [plan_id for plan_id, _ in dispatches]
+        with Session() as session:
+            session.execute(
+                delete(PlanDispatch).where(PlanDispatch.plan_id.in_(plan_ids))
+            )
+            session.execute(
+                insert(PlanDispatch),
+                [
+                    dict(
+                        plan_id=plan_id,
+                        phase=phase,
+                        node_id=self.node_id,
+                        dispatched_at=now,
+                    )
+                    for plan_id, phase in dispatches
+                ],
+            )
+            session.commit()
+
+    def recent_dispatches(
+        self, plan_ids: Iterable[int], since: datetime
+    ) -> Dict[int, Tuple[str, datetime]]:
+        """`since`之后派发过的Plan: plan_id => (phase, dispatched_at)"""
+        plan_ids = list(plan_ids)
+        result = {}
+        with Session() as session:
+            for i in range(0, len(plan_ids), 500):
+                statement = (
+                    select(
+                        PlanDispatch.plan_id,
+                        PlanDispatch.phase,
+                        PlanDispatch.dispatched_at,
+                    )
+                    .where(PlanDispatch.plan_id.in_(plan_ids[i : i + 500]))
+                    .where(PlanDispatch.dispatched_at >= since)
+                )
+                for plan_id, phase, dispatched_at in session.execute(statement):
+                    result[plan_id] = (phase, dispatched_at)
+        return result
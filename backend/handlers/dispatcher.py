@@ -0,0 +1,160 @@
+"""
+到期的Plan进入executor之前的公平派发
+
+- 同一个机器人同时最多`robot_limit`个任务(默认1), 避免手机上的脚本互相打断
+- 同一个用户同时最多`user_limit`个任务, Plan很多的用户不会占满executor
+- 有空位时在等待的用户之间轮流取, 每轮每个用户最多一个
+- 服务端确认运行后脚本还在手机上跑, 名额一直占着(`hold`),
+  直到收到该用户的/done_clock/(`release_user`)或超过`hold_seconds`秒(`expire`)
+"""
+import threading
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
+from typing import Deque, Dict, List, Set, Tuple
+
+from models import Plan
+
+Item = Tuple[Plan, str]  # (plan, phase)
+
+
+class FairDispatcher:
+    def __init__(
+        self, robot_limit: int = 1, user_limit: int = 2, hold_seconds: float = 600
+    ):
+        self.robot_limit = robot_limit
+        self.user_limit = user_limit
+        self.hold_time = timedelta(seconds=hold_seconds)
+        self.queues: Dict[str, "OrderedDict[int, Item]"] = {}  # user_id => 等待的Plan
+        self.users: Deque[str] = deque()  # 有Plan在等待的用户, 轮流取
+        self.owners: Dict[int, str] = {}  # 等待中的plan_id => user_id
+        self.running_robots: Dict[str, int] = {}  # robot_id => 运行中的任务数
+        self.running_users: Dict[str, int] = {}  # user_id => 运行中的任务数
+        self.held: Dict[int, Tuple[Plan, datetime]] = {}  # plan_id => (plan, 最晚释放时间)
+        self.held_users: Dict[str, Set[int]] = {}  # user_id => held的plan_id
+        self.lock = threading.Lock()
+
+    def configure(self, robot_limit: int, user_limit: int, hold_seconds: float = 600):
+        with self.lock:
+            self.robot_limit = robot_limit
+            self.user_limit = user_limit
+            self.hold_time = timedelta(seconds=hold_seconds)
+
+    def offer(self, plan: Plan, phase: str):
+        """排队等待派发, 已经在排队的Plan只更新phase"""
+        with self.lock:
+            queue = self.queues.get(plan.user_id)
+            if queue is None:
+                queue = self.queues[plan.user_id] = OrderedDict()
+                self.users.append(plan.user_id)
+            queue[plan.id] = (plan, phase)
+            self.owners[plan.id] = plan.user_id
+
+    def discard(self, plan_ids):
+        """Plan有变化, 不再等待, 重新排期后会再次排队"""
+        with self.lock:
+            for plan_id in plan_ids:
+                user_id = self.owners.pop(plan_id, None)
+                if user_id is not None:
+                    del self.queues[user_id][plan_id]
+
+    def clear(self):
+        """全量重新加载时清空等待的Plan, 运行中和占着名额的保留"""
+        with self.lock:
+            self.queues.clear()
+            self.users.clear()
+            self.owners.clear()
+
+    def pick(self, user_id: str) -> Item | None:
+        """用户排在最前面、机器人空闲的Plan, 调用时需持有`lock`"""
+        if self.running_users.get(user_id, 0) >= self.user_limit:
+            return None
+        queue = self.queues[user_id]
+        for plan_id, (plan, phase) in queue.items():
+            if self.running_robots.get(plan.robot_id, 0) < self.robot_limit:
+                del queue[plan_id]
+                del self.owners[plan_id]
+                return plan, phase
+        return None
+
+    def take(self, limit: int) -> List[Item]:
+        """轮流从每个用户取一个可以运行的Plan, 最多`limit`个, 取出的计入运行中"""
+        taken = []
+        with self.lock:
+            misses = 0
+            while self.users and len(taken) < limit and misses < len(self.users):
+                user_id = self.users.popleft()
+                if not self.queues.get(user_id):
+                    self.queues.pop(user_id, None)
+                    continue
+                item = self.pick(user_id)
+                if item:
+                    misses = 0
+                    taken.append(item)
+                    self.acquire(item[0])
+                else:
+                    misses += 1
+                if self.queues[user_id]:
+                    self.users.append(user_id)
+                else:
+                    del self.queues[user_id]
+        return taken
+
+    @property
+    def waiting(self) -> int:
+        return len(self.owners)
+
+    def acquire(self, plan: Plan):
+        robots, users = self.running_robots, self.running_users
+        robots[plan.robot_id] = robots.get(plan.robot_id, 0) + 1
+        users[plan.user_id] = users.get(plan.user_id, 0) + 1
+
+    def free(self, plan: Plan):
+        """让出机器人和用户的名额, 调用时需持有`lock`"""
+        for counts, key in (
+            (self.running_robots, plan.robot_id),
+            (self.running_users, plan.user_id),
+        ):
+            count = counts.get(key, 0) - 1
+            if count > 0:
+                counts[key] = count
+            else:
+                counts.pop(key, None)
+
+    def release(self, plan: Plan):
+        """任务失败(或没能提交), 马上让出名额"""
+        with self.lock:
+            self.free(plan)
+
+    def hold(self, plan: Plan, now: datetime):
+        """服务端已确认运行, 名额留到收到/done_clock/或`hold_time`之后"""
+        with self.lock:
+            self.unhold(plan.id)
+            self.held[plan.id] = (plan, now + self.hold_time)
+            self.held_users.setdefault(plan.user_id, set()).add(plan.id)
+
+    def unhold(self, plan_id: int):
+        """调用时需持有`lock`"""
+        plan, _ = self.held.pop(plan_id, (None, None))
+        if plan is None:
+            return
+        plan_ids = self.held_users.get(plan.user_id)
+        if plan_ids is not None:
+            plan_ids.discard(plan_id)
+            if not plan_ids:
+                del self.held_users[plan.user_id]
+        self.free(plan)
+
+    def release_user(self, user_id: str):
+        """收到用户的/done_clock/, 脚本已经跑完, 让出该用户占着的名额"""
+        with self.lock:
+            for plan_id in list(self.held_users.get(user_id, ())):
+                self.unhold(plan_id)
+
+    def expire(self, now: datetime):
+        """超过`hold_time`还没收到/done_clock/的, 不再等待"""
+        with self.lock:
+            expired = [
+                plan_id for plan_id, (_, until) in self.held.items() if until <= now
+            ]
+            for plan_id in expired:
+                self.unhold(plan_id)
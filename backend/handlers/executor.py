@@ -0,0 +1,254 @@
+"""
+按负载伸缩的线程池
+
+- 线程数在`min_workers`和`max_workers`之间: 有排队时加线程, 空闲`idle_timeout`秒后退出
+- 队列有上限, `capacity`返回还能提交多少个任务, 调度器据此少派发(背压)
+- 最近的任务失败率或耗时明显升高时(通常是Hamibot那边扛不住了), 不再加线程
+
+`plan.mode`为asyncio时换成在事件循环里运行的AsyncExecutor
+"""
+import time
+import queue
+import asyncio
+import threading
+from typing import Awaitable, Callable
+from concurrent.futures import Future
+
+import metrics
+from config import get_config
+from hamicli import AsyncHamiCliPool
+
+
+def is_failure(result) -> bool:
+    """Job.run的返回值: code不为0就是失败"""
+    return isinstance(result, dict) and result.get("code") != 0
+
+
+class AdaptiveExecutor:
+    # 耗时/失败率的指数移动平均系数
+    fast_alpha = 0.2
+    slow_alpha = 0.02
+    # 失败率超过多少、或近期耗时超过长期耗时的多少倍时不再加线程
+    max_failure_rate = 0.5
+    max_latency_ratio = 2.0
+
+    def __init__(
+        self,
+        min_workers: int,
+        max_workers: int,
+        queue_size: int,
+        idle_timeout: float = 60,
+    ):
+        self.lock = threading.Lock()
+        self.queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.workers = 0
+        self.active = 0
+        self.latency = 0.0  # 近期的平均耗时
+        self.baseline = 0.0  # 长期的平均耗时
+        self.failure_rate = 0.0
+        self.shutting_down = False
+        self.resize(min_workers, max_workers, queue_size, idle_timeout)
+
+    def resize(
+        self,
+        min_workers: int,
+        max_workers: int,
+        queue_size: int,
+        idle_timeout: float = 60,
+    ):
+        """修改上下限, 多出来的线程做完手上的任务后退出"""
+        with self.lock:
+            self.min_workers = max(0, min_workers)
+            self.max_workers = max(1, self.min_workers, max_workers)
+            self.idle_timeout = idle_timeout
+        with self.queue.mutex:
+            self.queue.maxsize = max(1, queue_size)
+        self.adjust()
+
+    def capacity(self) -> int:
+        """还能提交的任务数"""
+        return max(0, self.queue.maxsize - self.queue.qsize())
+
+    def throttled(self) -> bool:
+        return (
+            self.failure_rate > self.max_failure_rate
+            or self.baseline > 0
+            and self.latency > self.baseline * self.max_latency_ratio
+        )
+
+    def target(self) -> int:
+        """应有的线程数, 调用时需持有`lock`"""
+        demand = self.active + self.queue.qsize()
+        target = min(max(demand, self.min_workers), self.max_workers)
+        if self.throttled():
+            target = min(target, max(self.workers, self.min_workers))
+        return target
+
+    def adjust(self):
+        with self.lock:
+            if self.shutting_down:
+                return
+            spawn = self.target() - self.workers
+            self.workers += max(0, spawn)
+            metrics.executor_workers.set(self.workers)
+        for _ in range(spawn):
+            threading.Thread(target=self.work, daemon=True).start()
+
+    def submit(self, fn: Callable, *args) -> Future:
+        """队列满时抛出queue.Full"""
+        if self.shutting_down:
+            raise RuntimeError("cannot submit after shutdown")
+        future = Future()
+        self.queue.put_nowait((future, fn, args))
+        self.adjust()
+        return future
+
+    def record(self, duration: float, failed: bool):
+        with self.lock:
+            if self.baseline == 0:
+                self.latency = self.baseline = duration
+            else:
+                self.latency += self.fast_alpha * (duration - self.latency)
+                self.baseline += self.slow_alpha * (duration - self.baseline)
+            self.failure_rate += self.fast_alpha * (failed - self.failure_rate)
+
+    def retire(self, idle: bool) -> bool:
+        """当前线程是否应该退出, 退出时减掉线程数"""
+        with self.lock:
+            limit = self.min_workers if idle else self.max_workers
+            if self.workers <= limit:
+                return False
+            self.workers -= 1
+            metrics.executor_workers.set(self.workers)
+            return True
+
+    def work(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                if self.retire(idle=True):
+                    return
+                continue
+            if item is None:
+                with self.lock:
+                    self.workers -= 1
+                    metrics.executor_workers.set(self.workers)
+                return
+
+            future, fn, args = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            with self.lock:
+                self.active += 1
+            started = time.perf_counter()
+            failed = True
+            try:
+                result = fn(*args)
+                failed = is_failure(result)
+                future.set_result(result)
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                with self.lock:
+                    self.active -= 1
+                self.record(time.perf_counter() - started, failed)
+
+            if self.retire(idle=False):
+                return
+
+    def shutdown(self, wait: bool = True):
+        """已经提交的任务运行完后退出所有线程"""
+        with self.lock:
+            self.shutting_down = True
+            workers = self.workers
+        for _ in range(workers):
+            # 不受maxsize限制, 排在已提交的任务后面
+            with self.queue.mutex:
+                self.queue.queue.append(None)
+                self.queue.unfinished_tasks += 1
+                self.queue.not_empty.notify()
+        if wait:
+            while self.workers:
+                time.sleep(0.01)
+
+
+class AsyncExecutor:
+    """
+    在单独线程的事件循环中运行协程任务(Job.arun)
+
+    同时运行的任务数不超过`concurrency`, 另外最多排队`queue_size`个;
+    任务的第一个参数是事件循环里的AsyncHamiCliPool
+    """
+
+    def __init__(self, concurrency: int, queue_size: int = 500):
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.pending = 0  # 已提交还没结束的任务
+        self.pending_lock = threading.Lock()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.semaphore: asyncio.Semaphore = self.call(self.setup)
+
+    async def setup(self) -> asyncio.Semaphore:
+        # 需要在事件循环内创建
+        self.pool = AsyncHamiCliPool(
+            idle_timeout=get_config()["hamibot"]["idle_timeout"],
+            timeout=get_config()["hamibot"]["timeout"],
+        )
+        self.pool.watch()
+        return asyncio.Semaphore(self.concurrency)
+
+    def call(self, coro_func, *args):
+        return asyncio.run_coroutine_threadsafe(coro_func(*args), self.loop).result()
+
+    def resize(self, concurrency: int, queue_size: int = 500):
+        """修改并发数, 已经在运行的任务仍占用旧的信号量直到结束"""
+
+        async def create():
+            return asyncio.Semaphore(concurrency)
+
+        self.semaphore = self.call(create)
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+
+    def capacity(self) -> int:
+        """还能提交的任务数"""
+        return max(0, self.concurrency + self.queue_size - self.pending)
+
+    def shutdown(self, wait: bool = True):
+        """已经提交的任务运行完后停止事件循环"""
+
+        async def drain():
+            while self.pending:
+                await asyncio.sleep(0.1)
+            self.loop.stop()
+
+        asyncio.run_coroutine_threadsafe(drain(), self.loop)
+        if wait:
+            self.thread.join()
+
+    async def run(self, fn: Callable[..., Awaitable], *args) -> dict:
+        async with self.semaphore:
+            started = metrics.job_started()
+            result = None
+            try:
+                result = await fn(self.pool, *args)
+                return result
+            finally:
+                metrics.job_finished(started, result)
+
+    def submit(self, fn: Callable[..., Awaitable], *args) -> Future:
+        """队列满时抛出queue.Full"""
+        with self.pending_lock:
+            if self.pending >= self.concurrency + self.queue_size:
+                raise queue.Full
+            self.pending += 1
+        future = asyncio.run_coroutine_threadsafe(self.run(fn, *args), self.loop)
+        future.add_done_callback(self.release)
+        return future
+
+    def release(self, future: Future):
+        with self.pending_lock:
+            self.pending -= 1
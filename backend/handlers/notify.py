@@ -0,0 +1,94 @@
+"""
+API进程到调度进程的变更通知
+
+API进程(uvicorn可以有多个worker)在Plan或打卡状态变化后, 往调度进程监听的
+Unix datagram socket发一条JSON消息, 调度进程收到后调用`Scheduler.notify`。
+通知只是提前唤醒: 调度进程没有运行或者消息被丢弃时, 下一次定期resync也会读到变化
+"""
+import os
+import json
+import socket
+import threading
+from typing import Callable, Iterable
+
+from config import get_config
+from logger import logger
+
+# 单条消息里最多带多少个id, 避免超过socket的发送缓冲区
+BATCH = 500
+
+
+class Notifier:
+    def __init__(self, path: str):
+        self.path = path
+        self.sock: socket.socket | None = None
+        self.lock = threading.Lock()
+
+    def socket(self) -> socket.socket:
+        if self.sock is None:
+            with self.lock:
+                if self.sock is None:
+                    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                    # 调度进程处理不过来时丢弃, 不阻塞请求
+                    sock.setblocking(False)
+                    self.sock = sock
+        return self.sock
+
+    def notify(self, plan_ids: Iterable[int] = (), user_ids: Iterable[str] = ()):
+        plan_ids, user_ids = list(plan_ids), list(user_ids)
+        for i in range(0, max(len(plan_ids), len(user_ids)), BATCH):
+            message = dict(
+                plan_ids=plan_ids[i : i + BATCH], user_ids=user_ids[i : i + BATCH]
+            )
+            try:
+                self.socket().sendto(json.dumps(message).encode(), self.path)
+            except OSError as e:
+                logger.debug(f"notify scheduler failed: {e}")
+                return
+
+
+class NotifyListener:
+    """在调度进程里接收通知, 每个plan_id/user_id调用一次`callback`"""
+
+    def __init__(self, path: str, callback: Callable):
+        self.path = path
+        self.callback = callback
+        self.sock: socket.socket | None = None
+
+    def bind(self):
+        # 上次退出时留下的socket文件
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path)
+
+    def start(self) -> threading.Thread:
+        self.bind()
+        thread = threading.Thread(target=self.serve, daemon=True)
+        thread.start()
+        return thread
+
+    def serve(self):
+        while True:
+            try:
+                data = self.sock.recv(1 << 20)
+            except OSError:
+                return  # 已关闭
+            try:
+                message = json.loads(data)
+                for plan_id in message.get("plan_ids", []):
+                    self.callback(plan_id=plan_id)
+                for user_id in message.get("user_ids", []):
+                    self.callback(user_id=user_id)
+            except Exception as e:
+                logger.error(f"bad notification {data[:100]!r}: {e}")
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+notifier = Notifier(get_config()["plan"]["notify_socket"])
@@ -1,34 +1,63 @@
 import time
+import queue
+import atexit
+import heapq
+import asyncio
 import threading
-from typing import List, Dict, Iterable
-from datetime import date, datetime
-from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Iterable, Tuple, Set
+from datetime import date, datetime, timedelta
+from concurrent.futures import Future
 
+import numpy as np
 from logger import logger
-from sqlalchemy import select
+from sqlalchemy import select, union
 from sqlalchemy.orm import joinedload
 
-from config import get_config
+from config import get_config, store, Plan as PlanConfig
 from schemas import UserInfo
-from models import Plan, Clock, Session, PlanType, object_as_dict
-from hamicli import HamiCli
+from models import (
+    User,
+    Robot,
+    Script,
+    Installation,
+    Plan,
+    Clock,
+    Session,
+    ReadSession,
+    PlanType,
+    object_as_dict,
+)
+import metrics
+from tracing import tracer
+from hamicli import HamiCliPool, AsyncHamiCliPool
+from handlers.timetable import PlanTable
+from handlers.cluster import Cluster
+from handlers.notify import NotifyListener
+from handlers.executor import AdaptiveExecutor, AsyncExecutor
+from handlers.dispatcher import FairDispatcher
+from handlers.records import start_compaction
 from utils import handles_error
 
+cli_pool = HamiCliPool(
+    idle_timeout=get_config()["hamibot"]["idle_timeout"],
+    timeout=get_config()["hamibot"]["timeout"],
+)
+
+# 运行指令已经发出, 但等不到服务端确认
+UNCONFIRMED = dict(code=0, msg="sent, unconfirmed", confirmed=False)
+
 
 class Job:
     def __init__(self, plan: Plan):
         self.plan = plan
 
-    @handles_error
-    def run(self):
+    def describe(self):
         plan = self.plan
 
         if plan.type == PlanType.script:
             script_name = plan.script.name
-            script_id = plan.script_id
         else:
             script_name = plan.installation.name
-            script_id = plan.script_id
 
         logger.info(
             f"running job: {plan.user.username}, {script_name}, {plan.robot.name}"
@@ -38,142 +67,750 @@ class Job:
             user_id=plan.user_id,
             **object_as_dict(plan.user),
         )
+        return user_info, plan.script_id
 
-        cli = HamiCli(user_info=user_info, fetch=False)
-
-        if plan.type == PlanType.script:
-            cli.run_script(script_id, plan.robot)
-        else:
-            cli.run_installation(script_id, plan.robot)
+    @handles_error
+    def run(self):
+        plan = self.plan
+        with tracer.span("job", plan_id=plan.id):
+            with tracer.span("describe"):
+                user_info, script_id = self.describe()
+
+            with cli_pool.session(user_info) as cli:
+                with tracer.span("emit"):
+                    if plan.type == PlanType.script:
+                        handle = cli.run_script(script_id, plan.robot)
+                    else:
+                        handle = cli.run_installation(script_id, plan.robot)
+
+                # 指令已经发出, 等不到确认也不能重发, 否则手机会重复运行脚本
+                try:
+                    with tracer.span("ack"):
+                        handle.result(timeout=get_config()["hamibot"]["run_timeout"])
+                except TimeoutError:
+                    handle.cancel()
+                    logger.warning(f"run of plan {plan.id} sent but not confirmed")
+                    return UNCONFIRMED
 
-        time.sleep(1)
-        cli.close()
+    @handles_error
+    async def arun(self, pool: AsyncHamiCliPool):
+        plan = self.plan
+        with tracer.span("job", plan_id=plan.id):
+            with tracer.span("describe"):
+                user_info, script_id = self.describe()
+
+            async with pool.session(user_info) as cli:
+                with tracer.span("emit"):
+                    if plan.type == PlanType.script:
+                        handle = await cli.run_script(script_id, plan.robot)
+                    else:
+                        handle = await cli.run_installation(script_id, plan.robot)
+
+                try:
+                    with tracer.span("ack"):
+                        await asyncio.wait_for(
+                            handle, get_config()["hamibot"]["run_timeout"]
+                        )
+                except asyncio.TimeoutError:
+                    logger.warning(f"run of plan {plan.id} sent but not confirmed")
+                    return UNCONFIRMED
 
 
 class JobManager:
-    def __init__(self):
-        self.plans: List[Plan] = []
-        self.clocked_dict: Dict[str, Clock] = {}  # user_id => Clock
+    """
+    Plan/Clock的内存缓存
 
-    def reload_models(self, session: Session):
-        self.reload_plans(session)
-        self.reload_clocks(session)
+    首次(以及每天第一次)全量加载, 之后只按`modified_at`水位线增量读取变化的行,
+    `invalidate`可显式指定下次必须重新读取的plan/user;
+    `shards`不为None时只加载这些分片的Plan
+    """
 
-    def reload_plans(self, session: Session):
+    # 增量加载时回看的秒数, 避免漏掉在水位线之前开始、之后才提交的事务
+    overlap = 5
+
+    def __init__(self):
+        self.plans: Dict[int, Plan] = {}  # plan_id => Plan
+        self.user_plans: Dict[str, Set[int]] = {}  # user_id => plan_ids
+        self.clocked_dict: Dict[str, Clock] = {}  # user_id => 当天的Clock
+        self.prev_clocks: Dict[str, Clock] = {}  # user_id => 前一天的Clock
+        self.table = PlanTable()
+        self.day: date | None = None
+        self.watermark: datetime | None = None
+        self.reloaded_all = False
+        self.invalid_plans: Set[int] = set()
+        self.invalid_users: Set[str] = set()
+        self.shards: Set[int] | None = None
+        self.lock = threading.Lock()
+
+    def set_shards(self, shards: Set[int] | None):
+        """切换负责的分片, 下次全量加载"""
+        self.shards = shards
+        self.watermark = None
+
+    def invalidate(self, plan_id: int | None = None, user_id: str | None = None):
+        """标记有变化的plan/user, 下次加载时重新读取"""
+        with self.lock:
+            if plan_id is not None:
+                self.invalid_plans.add(plan_id)
+            if user_id is not None:
+                self.invalid_users.add(user_id)
+
+    def reload_models(self, session: Session) -> Set[int]:
+        """刷新缓存, 返回有变化的plan_id"""
+        today = date.today()
+        if self.day != today:
+            self.day = today
+            self.watermark = None
+
+        since = self.watermark and self.watermark - timedelta(seconds=self.overlap)
+        self.watermark = datetime.now()
+        self.reloaded_all = since is None
+
+        with self.lock:
+            plan_ids, self.invalid_plans = self.invalid_plans, set()
+            user_ids, self.invalid_users = self.invalid_users, set()
+
+        with tracer.span("reload_plans", full=self.reloaded_all):
+            changed = self.reload_plans(session, since=since, plan_ids=plan_ids)
+        with tracer.span("reload_clocks"):
+            changed |= self.reload_clocks(
+                session, since=since, user_ids=user_ids, plan_ids=changed
+            )
+
+        with tracer.span("sync_table", plans=len(changed)):
+            if self.reloaded_all:
+                self.table.clear()
+            self.sync_table(changed)
+        return changed
+
+    def reload_plans(
+        self,
+        session: Session,
+        since: datetime | None = None,
+        plan_ids: Iterable[int] = (),
+    ) -> Set[int]:
         """刷新生效的定时任务Plans"""
+        if since is None:
+            self.plans.clear()
+            self.user_plans.clear()
+
+        changed = set()
+        plan: Plan
+        for plan in session.execute(self.plans_query(since, plan_ids)).scalars():
+            changed.add(plan.id)
+            old = self.plans.pop(plan.id, None)
+            if old:
+                self.user_plans.get(old.user_id, set()).discard(plan.id)
+            if not plan.deleted:
+                self.plans[plan.id] = plan
+                self.user_plans.setdefault(plan.user_id, set()).add(plan.id)
+        return changed
+
+    def plans_query(self, since: datetime | None, plan_ids: Iterable[int] = ()):
+        """全量加载时读取所有生效的Plan, 增量加载时只读取有变化的Plan"""
         statement = (
             select(Plan)
-            .where(Plan.deleted == False)
             .options(joinedload(Plan.user))
             .options(joinedload(Plan.robot))
+            .options(joinedload(Plan.script))
+            .options(joinedload(Plan.installation))
         )
-        self.plans = session.execute(statement).scalars().all()
-
-    def reload_clocks(self, session: Session):
-        """刷新打卡状态"""
-        statement = (
-            select(Clock)
-            .where(Clock.user_id.in_(plan.user_id for plan in self.plans))
-            .where(Clock.date == date.today())
-        )
-
-        clocks = session.execute(statement).scalars().all()
+        if since is None:
+            statement = statement.where(Plan.deleted == False)
+        else:
+            statement = statement.where(
+                Plan.id.in_(self.changed_plan_ids(since, plan_ids))
+            )
+        if self.shards is not None:
+            statement = statement.where(Plan.shard.in_(list(self.shards)))
+        return statement
+
+    @staticmethod
+    def changed_plan_ids(since: datetime, plan_ids: Iterable[int] = ()):
+        """
+        Plan本身或关联的User/Robot/Script/Installation在`since`之后有变化的plan_id
 
-        self.clocked_dict.clear()
+        每个条件单独走modified_at和外键上的索引再UNION,
+        没有变化时不会扫描plans表
+        """
+        parts = [select(Plan.id).where(Plan.modified_at >= since)]
+        for column, model in (
+            (Plan.user_id, User),
+            (Plan.robot_id, Robot),
+            (Plan.script_id, Script),
+            (Plan.installation_id, Installation),
+        ):
+            changed = select(model.id).where(model.modified_at >= since)
+            parts.append(select(Plan.id).where(column.in_(changed)))
+        plan_ids = list(plan_ids)
+        if plan_ids:
+            parts.append(select(Plan.id).where(Plan.id.in_(plan_ids)))
+        return union(*parts)
+
+    def reload_clocks(
+        self,
+        session: Session,
+        since: datetime | None = None,
+        user_ids: Iterable[str] = (),
+        plan_ids: Iterable[int] = (),
+    ) -> Set[int]:
+        """
+        刷新当天和前一天的打卡状态, 返回打卡状态有变化的plan_id
 
-        for clock in clocks:
-            self.clocked_dict[clock.user_id] = clock
+        前一天的用于判断跨零点的时间段在零点之后是否还需要打卡
+        """
+        today = date.today()
+        if since is None:
+            self.clocked_dict.clear()
+            self.prev_clocks.clear()
+
+        changed = set()
+        statement = self.clocks_query(today, since, user_ids)
+        for clock in session.execute(statement).scalars():
+            if clock.date == today:
+                self.clocked_dict[clock.user_id] = clock
+            else:
+                self.prev_clocks[clock.user_id] = clock
+            changed |= self.user_plans.get(clock.user_id, set())
 
         # 新建clocks
-        for plan in self.plans:
-            if plan.user_id not in self.clocked_dict:
-                clock = Clock(user_id=plan.user_id, date=date.today())
-                self.clocked_dict[plan.user_id] = clock
-                session.add(clock)
-        session.commit()
+        if since is None:
+            new_users = set(self.user_plans)
+        else:
+            new_users = {
+                self.plans[plan_id].user_id
+                for plan_id in plan_ids
+                if plan_id in self.plans
+            }
+        clocks = []
+        for user_id in new_users:
+            if user_id not in self.clocked_dict:
+                clock = Clock(user_id=user_id, date=today)
+                self.clocked_dict[user_id] = clock
+                clocks.append(clock)
+        if clocks:
+            # `session`可能是只读的, 新建的clocks单独写入
+            with Session(expire_on_commit=False) as writer:
+                writer.add_all(clocks)
+                writer.commit()
+        return changed
+
+    @staticmethod
+    def clocks_query(
+        today: date, since: datetime | None = None, user_ids: Iterable[str] = ()
+    ):
+        """当天和前一天的Clock, 增量加载时只读取有变化的"""
+        yesterday = today - timedelta(days=1)
+        statement = select(Clock).where(Clock.date.in_([yesterday, today]))
+        if since is not None:
+            # 和changed_plan_ids一样分开走索引再UNION
+            changed = [select(Clock.id).where(Clock.modified_at >= since)]
+            user_ids = list(user_ids)
+            if user_ids:
+                changed.append(select(Clock.id).where(Clock.user_id.in_(user_ids)))
+            statement = statement.where(Clock.id.in_(union(*changed)))
+        return statement
 
     def load_lazy_columns(self, plan: Plan):
         _ = plan.script
         _ = plan.installation
 
-    def parse_range(self, ran: str):
-        vals = ran.split("-")
-        v1, v2 = vals[0].split(":")
-        v3, v4 = vals[1].split(":")
-        return f"{v1:>02.2s}:{v2:>02.2s}", f"{v3:>02.2s}:{v4:>02.2s}"
+    def sync_table(self, plan_ids: Iterable[int]):
+        """把Plan的时间段和打卡状态写入PlanTable"""
+        for plan_id in plan_ids:
+            plan = self.plans.get(plan_id)
+            if not plan:
+                self.table.remove(plan_id)
+                continue
+            clock = self.clocked_dict.get(plan.user_id)
+            prev = self.prev_clocks.get(plan.user_id)
+            self.table.upsert(
+                plan_id,
+                plan.ranges,
+                clockin=bool(clock and clock.clockin),
+                clockout=bool(clock and clock.clockout),
+                prev_clockin=bool(prev and prev.clockin),
+                prev_clockout=bool(prev and prev.clockout),
+            )
+
+    def next_fire_times(
+        self, plan_ids: List[int], now: datetime
+    ) -> Tuple[np.ndarray, List[datetime]]:
+        """
+        批量计算plan下一次可以运行的时间
+
+        返回(是否已经到期, 下次运行时间), 已经到期的运行时间为`now`
+        """
+        return self.table.evaluate(plan_ids, now)
+
+    def next_fire_time(self, plan: Plan, now: datetime) -> datetime:
+        return self.next_fire_times([plan.id], now)[1][0]
+
+    def phase(self, plan: Plan, now: datetime) -> str:
+        """当前需要上班打卡(in)还是下班打卡(out)"""
+        return self.table.phase(plan.id, now)
 
     def get_jobs(self) -> Iterable[Job]:
         """
         获取可以运行的任务
         """
-        with Session() as session:
+        with ReadSession() as session:
             self.reload_models(session=session)
-            for plan in self.plans:
-                clock = self.clocked_dict.get(plan.user_id)
-                if clock:
-                    logger.debug(f"plan: {object_as_dict(plan)}")
-                    logger.debug(f"clock: {object_as_dict(clock)}")
+            for plan_id in self.table.due(datetime.now()).tolist():
+                plan = self.plans[plan_id]
+                logger.debug(f"plan: {object_as_dict(plan)}")
+                self.load_lazy_columns(plan)
+                yield Job(plan=plan)
+
+
+class Dispatch:
+    """一个Plan最近一次派发的状态"""
+
+    IN_FLIGHT = "in_flight"
+    SENT = "sent"
+    UNCONFIRMED = "unconfirmed"  # 已发出, 没有收到服务端确认
+    FAILED = "failed"
+
+    def __init__(self, phase: str, now: datetime):
+        self.phase = phase  # in/out, 对应上班/下班打卡
+        self.state = self.IN_FLIGHT
+        self.failures = 0
+        self.dispatched_at = now
+        self.until = now
+
+
+class DispatchLedger:
+    """
+    Plan的派发台账
+
+    - 派发中的Plan不会重复派发
+    - 派发成功(或已发出但没有确认)后等待`cooldown`秒, 期间应收到/done_clock/回调
+    - 连接或发送失败按`backoff`指数退避, 最多`backoff_max`秒
+    - 收到/done_clock/(打卡状态变化)后清除对应记录
+    """
+
+    def __init__(
+        self, cooldown: float = 600, backoff: float = 30, backoff_max: float = 600
+    ):
+        self.cooldown = timedelta(seconds=cooldown)
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.entries: Dict[int, Dispatch] = {}  # plan_id => Dispatch
+        self.lock = threading.Lock()
+
+    def blocked_until(self, plan_id: int, phase: str, now: datetime) -> datetime | None:
+        """返回最早可再次派发的时间, 可以派发则返回None"""
+        with self.lock:
+            entry = self.entries.get(plan_id)
+            if not entry or entry.phase != phase:
+                return None
+            if entry.state == Dispatch.IN_FLIGHT:
+                # 派发太久没有结束的, 当作已丢失
+                if now - entry.dispatched_at < self.cooldown:
+                    return now + min(self.cooldown, timedelta(seconds=60))
+                return None
+            if entry.until > now:
+                return entry.until
+            return None
+
+    def start(self, plan_id: int, phase: str, now: datetime):
+        with self.lock:
+            entry = self.entries.get(plan_id)
+            if not entry or entry.phase != phase:
+                entry = self.entries[plan_id] = Dispatch(phase, now)
+            entry.state = Dispatch.IN_FLIGHT
+            entry.dispatched_at = now
+
+    def finish(self, plan_id: int, ok: bool, now: datetime, confirmed: bool = True):
+        with self.lock:
+            entry = self.entries.get(plan_id)
+            if not entry:
+                return
+            if ok:
+                entry.state = Dispatch.SENT if confirmed else Dispatch.UNCONFIRMED
+                entry.failures = 0
+                entry.until = now + self.cooldown
+            else:
+                entry.state = Dispatch.FAILED
+                entry.failures += 1
+                delay = min(self.backoff * 2 ** (entry.failures - 1), self.backoff_max)
+                entry.until = now + timedelta(seconds=delay)
+
+    def restore(self, plan_id: int, phase: str, dispatched_at: datetime):
+        """按其他节点(或重启前)的派发记录, 在`cooldown`内不再派发"""
+        with self.lock:
+            entry = self.entries.get(plan_id)
+            if entry and entry.dispatched_at >= dispatched_at:
+                return
+            entry = self.entries[plan_id] = Dispatch(phase, dispatched_at)
+            entry.state = Dispatch.SENT
+            entry.until = dispatched_at + self.cooldown
+
+    def configure(self, cooldown: float, backoff: float, backoff_max: float):
+        with self.lock:
+            self.cooldown = timedelta(seconds=cooldown)
+            self.backoff = backoff
+            self.backoff_max = backoff_max
+
+    def expire(self, plan_ids: Iterable[int]):
+        with self.lock:
+            for plan_id in plan_ids:
+                self.entries.pop(plan_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
 
-                    now = datetime.now()
-
-                    before_in, after_in = self.parse_range(
-                        (plan.ranges or {}).get("clockin_range", "8:00-11:00")
-                    )
-                    before_out, after_out = self.parse_range(
-                        (plan.ranges or {}).get("clockout_range", "19:00-24:00")
-                    )
 
-                    logger.debug(
-                        f"conds_in: {before_in}, {now.strftime('%H:%M')}, {after_in}"
-                    )
-                    logger.debug(
-                        f"conds_out: {before_out}, {now.strftime('%H:%M')}, {after_out}"
-                    )
+class Scheduler:
+    """
+    按下次运行时间排队的调度器
 
-                    if (
-                        not clock.clockin
-                        and before_in <= now.strftime("%H:%M") < after_in
-                    ):
-                        self.load_lazy_columns(plan)
-                        yield Job(plan=plan)
+    所有Plan按下次可运行的时间放进最小堆, 调度线程只睡到堆顶的时间;
+    Plan或打卡状态变化时调用`notify`提前唤醒并重新加载。
+    在打卡时间段内还没有完成打卡的Plan, 由DispatchLedger决定何时重试。
 
-                    elif (
-                        clock.clockin
-                        and not clock.clockout
-                        and before_out <= now.strftime("%H:%M") < after_out
-                    ):
-                        self.load_lazy_columns(plan)
-                        yield Job(plan=plan)
+    开启`cluster.enabled`后只调度本节点持有租约的分片, 派发前先写入派发记录。
 
+    `plan`配置变化时在调度线程里重新设置间隔、台账参数和executor, 不需要重启。
+    到期的Plan先进入FairDispatcher排队, 按机器人/用户的并发上限在用户之间轮流取,
+    每次最多取executor还能接收的数量; 没取到的有任务结束时再取, 最多等`deferral`秒
+    """
 
-class Scheduler:
-    threads = get_config()["plan"]["threads"]
-    interval = get_config()["plan"]["interval"]
+    deferral = 1
 
     def __init__(self) -> None:
-        self.executor = ThreadPoolExecutor(self.threads)
         self.jobmanager = JobManager()
+        self.ledger = DispatchLedger()
+        self.dispatcher = FairDispatcher()
+        self.executor: AdaptiveExecutor | AsyncExecutor | None = None
+        self.executor_options: tuple | None = None
+        self.pending_config: PlanConfig | None = None
+        self.deferred = False
+        self.configure(get_config()["plan"])
+
+        self.heap: List[Tuple[datetime, int]] = []  # (fire_time, plan_id)
+        self.fire_times: Dict[int, datetime] = {}  # plan_id => fire_time
+        self.wakeup = threading.Event()
+        self.dirty = True
+        self.loaded_at = datetime.min
+        # 收到/done_clock/的用户, 由调度线程清除他们的派发记录
+        self.done_users: Set[str] = set()
+        self.done_lock = threading.Lock()
+
+        self.cluster: Cluster | None = None
+        if get_config()["cluster"]["enabled"]:
+            self.cluster = Cluster()
+            # 拿到租约之前不负责任何分片
+            self.jobmanager.set_shards(set())
+
+    def configure(self, config: PlanConfig):
+        """按`plan`配置设置调度参数, 执行方式或并发数变化时换一个executor"""
+        self.interval = config["interval"]
+        self.resync = config.get("resync", 300)
+        self.ledger.configure(
+            config.get("cooldown", 600),
+            config.get("backoff", 30),
+            config.get("backoff_max", 600),
+        )
+        self.dispatcher.configure(
+            config.get("robot_concurrency", 1),
+            config.get("user_concurrency", 2),
+            config.get("robot_hold", 600),
+        )
+
+        mode = config.get("mode", "thread")
+        queue_size = config.get("queue_size", 500)
+        if mode == "asyncio":
+            options = (mode, config.get("concurrency", 1000), queue_size)
+            executor_class = AsyncExecutor
+        else:
+            options = (
+                mode,
+                config.get("min_threads", 1),
+                config["threads"],
+                queue_size,
+                config.get("thread_idle", 60),
+            )
+            executor_class = AdaptiveExecutor
+        if options == self.executor_options:
+            return
+
+        old = self.executor
+        if isinstance(old, executor_class):
+            old.resize(*options[1:])
+        else:
+            self.executor = executor_class(*options[1:])
+            if old:
+                # 已经提交的任务照常运行完
+                old.shutdown(wait=False)
+        self.executor_options = options
+        logger.info(f"scheduler executor: {options}")
+
+    def on_config_changed(self, old: dict, new: dict):
+        # 在配置检查的线程里调用, 交给调度线程处理
+        self.pending_config = new["plan"]
+        self.wakeup.set()
 
     def start(self):
+        if self.cluster:
+            atexit.register(self.cluster.leave)
+        store.subscribe(self.on_config_changed, "plan")
         self.run()
 
+    def heartbeat(self, now: datetime):
+        """续约, 分片有变化时全量重新加载"""
+        acquired, lost = self.cluster.heartbeat(now)
+        if acquired or lost:
+            self.jobmanager.set_shards(set(self.cluster.owned))
+            self.dirty = True
+
+    def restore_ledger(self, now: datetime):
+        """从派发记录恢复`cooldown`内派发过的Plan"""
+        since = now - self.ledger.cooldown
+        dispatches = self.cluster.recent_dispatches(self.fire_times, since)
+        for plan_id, (phase, dispatched_at) in dispatches.items():
+            self.ledger.restore(plan_id, phase, dispatched_at)
+
+    def notify(self, plan_id: int | None = None, user_id: str | None = None):
+        """
+        Plan或打卡状态有变化, 唤醒调度线程重新加载
+
+        在接收通知的线程里调用, 不读取调度线程维护的缓存
+        """
+        self.jobmanager.invalidate(plan_id=plan_id, user_id=user_id)
+        if user_id is not None:
+            with self.done_lock:
+                self.done_users.add(user_id)
+        self.dirty = True
+        self.wakeup.set()
+
+    def dispatch(self, job: Job):
+        metrics.scheduler_dispatched.inc()
+        metrics.executor_queued.inc()
+        try:
+            if isinstance(self.executor, AsyncExecutor):
+                return self.executor.submit(job.arun)
+            else:
+                return self.executor.submit(self.run_job, job)
+        except queue.Full:
+            metrics.executor_queued.dec()
+            raise
+
+    @staticmethod
+    def run_job(job: Job) -> dict:
+        started = metrics.job_started()
+        result = None
+        try:
+            result = job.run()
+            return result
+        finally:
+            metrics.job_finished(started, result)
+
+    def track(self, plan: Plan, phase: str, future: Future, now: datetime):
+        """记录派发, 任务失败时让出名额, 成功时名额留到收到/done_clock/"""
+        self.ledger.start(plan.id, phase, now)
+
+        def done(future: Future):
+            result = {} if future.exception() else future.result()
+            ok = result.get("code") == 0
+            finished = datetime.now()
+            self.ledger.finish(plan.id, ok, finished, result.get("confirmed", True))
+            if ok:
+                self.dispatcher.hold(plan, finished)
+            else:
+                self.dispatcher.release(plan)
+            if self.deferred:
+                # 有Plan在等executor或机器人/用户的空位
+                self.deferred = False
+                self.wakeup.set()
+
+        future.add_done_callback(done)
+
+    def schedule(self, plan_id: int, fire_time: datetime):
+        self.fire_times[plan_id] = fire_time
+        heapq.heappush(self.heap, (fire_time, plan_id))
+
+    def rebuild(self, now: datetime):
+        """增量加载Plan和打卡状态, 只重排有变化的Plan"""
+        self.dirty = False
+        jobmanager = self.jobmanager
+        started = time.perf_counter()
+        with self.done_lock:
+            done_users, self.done_users = self.done_users, set()
+        with tracer.span("reload"), ReadSession() as session:
+            changed = jobmanager.reload_models(session=session)
+        # 收到了/done_clock/, 之前的派发记录作废, 脚本占着的名额让出来
+        for user_id in done_users:
+            self.ledger.expire(list(jobmanager.user_plans.get(user_id, ())))
+            self.dispatcher.release_user(user_id)
+        kind = "full" if jobmanager.reloaded_all else "incremental"
+        metrics.plan_reload_seconds.labels(kind).observe(time.perf_counter() - started)
+
+        alive = [plan_id for plan_id in changed if plan_id in jobmanager.plans]
+        _, fire_times = jobmanager.next_fire_times(alive, now)
+
+        if jobmanager.reloaded_all:
+            self.ledger.clear()
+            self.dispatcher.clear()
+            self.fire_times = dict(zip(alive, fire_times))
+            self.heap = [(t, plan_id) for plan_id, t in self.fire_times.items()]
+            heapq.heapify(self.heap)
+            if self.cluster:
+                self.restore_ledger(now)
+        else:
+            self.dispatcher.discard(changed)
+            for plan_id in changed:
+                self.fire_times.pop(plan_id, None)
+            for plan_id, fire_time in zip(alive, fire_times):
+                self.schedule(plan_id, fire_time)
+
+            # 过期条目太多时压缩堆
+            if len(self.heap) > 2 * len(self.fire_times) + 64:
+                self.heap = [(t, plan_id) for plan_id, t in self.fire_times.items()]
+                heapq.heapify(self.heap)
+
+        self.loaded_at = now
+        logger.debug(f"scheduler reloaded {len(changed)}/{len(self.fire_times)} plans")
+
+    def tick(self, now: datetime):
+        """运行所有到期的Plan, 并排好它们的下次运行时间"""
+        if self.cluster and self.cluster.due(now):
+            with tracer.span("heartbeat"):
+                self.heartbeat(now)
+        if (
+            self.dirty
+            or now.date() != self.loaded_at.date()
+            or (now - self.loaded_at).total_seconds() >= self.resync
+        ):
+            self.rebuild(now)
+
+        jobmanager = self.jobmanager
+        popped = []
+        while self.heap and self.heap[0][0] <= now:
+            fire_time, plan_id = heapq.heappop(self.heap)
+            if plan_id not in jobmanager.plans:
+                continue  # 已删除
+            if self.fire_times.get(plan_id) != fire_time:
+                continue  # 已重排
+            self.fire_times.pop(plan_id)
+            popped.append(plan_id)
+
+        retry_at = now + timedelta(seconds=self.interval)
+        with tracer.span("evaluate", plans=len(popped)):
+            dues, fire_times = jobmanager.next_fire_times(popped, now)
+
+        cluster = self.cluster
+        dispatcher = self.dispatcher
+        for plan_id, due, fire_time in zip(popped, dues.tolist(), fire_times):
+            plan = jobmanager.plans[plan_id]
+            if cluster and plan.shard not in cluster.owned:
+                continue  # 分片已经转给其他节点, 等待全量重新加载
+            if due:
+                phase = jobmanager.phase(plan, now)
+                blocked_until = self.ledger.blocked_until(plan_id, phase, now)
+                if blocked_until:
+                    fire_time = blocked_until
+                else:
+                    dispatcher.offer(plan, phase)
+                    fire_time = retry_at
+            self.schedule(plan_id, fire_time)
+
+        dispatcher.expire(now)
+        dispatches = self.take(now)
+        deferred = dispatcher.waiting
+        if deferred:
+            # 等executor或机器人/用户的空位
+            self.deferred = True
+            metrics.scheduler_deferred.inc(deferred)
+
+        if cluster and dispatches:
+            # 租约快到期(或续约失败)时不派发; 派发记录写不进去也不派发
+            try:
+                if not cluster.valid(now):
+                    raise RuntimeError(f"{cluster.node_id} lease expired")
+                with tracer.span("log_dispatches", plans=len(dispatches)):
+                    cluster.log_dispatches(
+                        [(plan.id, phase) for plan, phase in dispatches], now
+                    )
+            except Exception as e:
+                logger.error(f"skip {len(dispatches)} dispatches: {e}")
+                for plan, _ in dispatches:
+                    dispatcher.release(plan)
+                dispatches = []
+
+        with tracer.span("submit", dispatched=len(dispatches), deferred=deferred):
+            for plan, phase in dispatches:
+                try:
+                    future = self.dispatch(Job(plan=plan))
+                except queue.Full:
+                    dispatcher.release(plan)
+                    dispatcher.offer(plan, phase)
+                    self.deferred = True
+                    continue
+                self.track(plan, phase, future, now)
+
+    def take(self, now: datetime) -> List[Tuple[Plan, str]]:
+        """从FairDispatcher取executor放得下的Plan, 丢掉排队期间已经过了时间段的"""
+        taken = self.dispatcher.take(self.executor.capacity())
+        if not taken:
+            return []
+        jobmanager = self.jobmanager
+        plan_ids = [plan.id for plan, _ in taken]
+        dues, _ = jobmanager.next_fire_times(plan_ids, now)
+        dispatches = []
+        for (plan, phase), due in zip(taken, dues.tolist()):
+            if due and jobmanager.plans.get(plan.id) is plan:
+                dispatches.append((plan, phase))
+            else:
+                self.dispatcher.release(plan)
+        return dispatches
+
+    def timeout(self, now: datetime) -> float:
+        """距离下次需要醒来的秒数"""
+        wake_at = self.loaded_at + timedelta(seconds=self.resync)
+        wake_at = min(wake_at, datetime.combine(now.date(), datetime.max.time()))
+        if self.heap:
+            wake_at = min(wake_at, self.heap[0][0])
+        if self.dispatcher.waiting:
+            # 任务结束时会提前唤醒
+            wake_at = min(wake_at, now + timedelta(seconds=self.deferral))
+        if self.cluster:
+            wake_at = min(wake_at, self.cluster.next_heartbeat)
+        return max(0, (wake_at - now).total_seconds())
+
     def run(self):
         while True:
-            current_time = time.time()
             logger.debug("scheduler run")
+            self.wakeup.clear()
+            if self.pending_config:
+                config, self.pending_config = self.pending_config, None
+                self.configure(config)
             try:
-                for job in self.jobmanager.get_jobs():
-                    self.executor.submit(job.run)
+                with metrics.scheduler_tick_seconds.time(), tracer.span("tick"):
+                    self.tick(datetime.now())
             except Exception as e:
                 logger.error(str(e))
-            finally:
-                time.sleep(max(0, self.interval - (time.time() - current_time)))
-
-
-scheduler = Scheduler()
+                self.dirty = True
+                time.sleep(self.interval)
+            self.wakeup.wait(self.timeout(datetime.now()))
 
 
 def start_scheduler() -> threading.Thread:
+    """
+    在后台线程运行调度器, 并接收API进程发来的变更通知
+
+    同一个数据库只应由一个进程调用(开启cluster后每个节点一个)
+    """
+    store.watch()
+    cli_pool.watch()
+    scheduler = Scheduler()
+    listener = NotifyListener(get_config()["plan"]["notify_socket"], scheduler.notify)
+    listener.start()
+    atexit.register(listener.close)
+    # 开启cluster时由持有0号分片的节点汇总打卡记录
+    cluster = scheduler.cluster
+    start_compaction(lambda: cluster is None or 0 in cluster.owned)
     thread = threading.Thread(target=scheduler.start, daemon=True)
     thread.start()
     return thread
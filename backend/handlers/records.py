@@ -0,0 +1,222 @@
+"""
+打卡记录的汇总、归档和清理
+
+- records只保留最近`records.raw_days`天的原始记录
+- 更早的记录按天汇总进record_dailies, 原始行移到按月分表的records_YYYYMM
+- 超过`records.archive_months`个月的分表整张删除, 为0时不归档直接删除原始行
+- 调度进程每天`records.compact_at`运行一次(`start_compaction`), 也可以用
+  `inv compact-records`手动运行
+"""
+import re
+import time
+import threading
+from typing import Callable, Dict, List, Tuple
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import (
+    Column,
+    DateTime,
+    Index,
+    Integer,
+    JSON,
+    MetaData,
+    String,
+    Table,
+    delete,
+    func,
+    insert,
+    inspect,
+    select,
+)
+
+from config import get_config
+from logger import logger
+from models import Session, Record, RecordDaily, engine
+
+partition_metadata = MetaData()
+partitions: Dict[str, Table] = {}
+
+PARTITION_PATTERN = re.compile(r"^records_(\d{6})$")
+
+
+def record_partition(month: str) -> Table:
+    """按月分表records_YYYYMM, 结构与records相同"""
+    if month not in partitions:
+        name = f"records_{month}"
+        partitions[month] = Table(
+            name,
+            partition_metadata,
+            Column("id", Integer, primary_key=True),
+            Column("user_id", String),
+            Column("robot_id", String),
+            Column("script_id", String),
+            Column("app_env", String),
+            Column("timestamp", DateTime),
+            Column("extra", JSON),
+            Index(f"ix_{name}_user_timestamp", "user_id", "timestamp"),
+        )
+    return partitions[month]
+
+
+def list_partitions() -> List[str]:
+    """已有分表的月份, 从早到晚"""
+    months = []
+    for name in inspect(engine).get_table_names():
+        m = PARTITION_PATTERN.match(name)
+        if m:
+            months.append(m.group(1))
+    return sorted(months)
+
+
+def rollup(session: Session, records: List[Record]):
+    """把一批原始记录累加进RecordDaily"""
+    # (user_id, date) => [count, clockin_at, clockout_at]
+    summaries: Dict[Tuple[str, date], list] = {}
+    for record in records:
+        summary = summaries.setdefault(
+            (record.user_id, record.timestamp.date()), [0, None, None]
+        )
+        summary[0] += 1
+
+        extra = record.extra if isinstance(record.extra, dict) else {}
+        if not extra.get("done"):
+            continue
+        if extra.get("direction") == "in":
+            if not summary[1] or record.timestamp < summary[1]:
+                summary[1] = record.timestamp
+        elif extra.get("direction") == "out":
+            if not summary[2] or record.timestamp > summary[2]:
+                summary[2] = record.timestamp
+
+    for (user_id, day), (count, clockin_at, clockout_at) in summaries.items():
+        daily = session.get(RecordDaily, (user_id, day))
+        if not daily:
+            daily = RecordDaily(user_id=user_id, date=day, count=0)
+            session.add(daily)
+        daily.count = (daily.count or 0) + count
+        if clockin_at and (not daily.clockin_at or clockin_at < daily.clockin_at):
+            daily.clockin_at = clockin_at
+        if clockout_at and (
+            not daily.clockout_at or clockout_at > daily.clockout_at
+        ):
+            daily.clockout_at = clockout_at
+
+
+def compact_day(day: date, archive: bool) -> int:
+    """
+    汇总并移走某一天的原始记录
+
+    汇总、归档和删除在同一个事务里, 中途失败不会重复计数
+    """
+    start = datetime.combine(day, datetime.min.time())
+    end = start + timedelta(days=1)
+    with Session() as session:
+        in_day = (Record.timestamp >= start) & (Record.timestamp < end)
+        records = session.execute(select(Record).where(in_day)).scalars().all()
+        if not records:
+            return 0
+
+        rollup(session, records)
+
+        if archive:
+            table = record_partition(day.strftime("%Y%m"))
+            table.create(session.connection(), checkfirst=True)
+            session.execute(
+                insert(table),
+                [
+                    dict(
+                        id=record.id,
+                        user_id=record.user_id,
+                        robot_id=record.robot_id,
+                        script_id=record.script_id,
+                        app_env=record.app_env,
+                        timestamp=record.timestamp,
+                        extra=record.extra,
+                    )
+                    for record in records
+                ],
+            )
+
+        session.execute(delete(Record).where(in_day))
+        session.commit()
+        return len(records)
+
+
+def prune_partitions(archive_months: int, today: date | None = None) -> List[str]:
+    """删除超过保留期的分表"""
+    today = today or date.today()
+    index = today.year * 12 + today.month - 1 - archive_months
+    oldest = f"{index // 12:04d}{index % 12 + 1:02d}"
+
+    dropped = []
+    for month in list_partitions():
+        if month < oldest:
+            record_partition(month).drop(engine, checkfirst=True)
+            partitions.pop(month, None)
+            dropped.append(month)
+    return dropped
+
+
+def compact_records(
+    raw_days: int | None = None,
+    archive_months: int | None = None,
+    today: date | None = None,
+):
+    """把`raw_days`天之前的原始记录汇总、归档, 并清理过期分表"""
+    config = get_config()["records"]
+    if raw_days is None:
+        raw_days = config["raw_days"]
+    if archive_months is None:
+        archive_months = config["archive_months"]
+    today = today or date.today()
+    cutoff = today - timedelta(days=raw_days)
+
+    with Session() as session:
+        oldest = session.execute(
+            select(func.min(Record.timestamp)).where(
+                Record.timestamp < datetime.combine(cutoff, datetime.min.time())
+            )
+        ).scalar()
+
+    day = oldest.date() if oldest else cutoff
+    while day < cutoff:
+        count = compact_day(day, archive=archive_months > 0)
+        if count:
+            logger.info(f"compacted {count} records of {day}")
+        day += timedelta(days=1)
+
+    if archive_months > 0:
+        for month in prune_partitions(archive_months, today):
+            logger.info(f"dropped records of {month}")
+
+
+def next_compaction(now: datetime) -> datetime:
+    """下一次`records.compact_at`的时间"""
+    hour, minute = get_config()["records"]["compact_at"].split(":")
+    at = now.replace(hour=int(hour), minute=int(minute), second=0, microsecond=0)
+    return at if at > now else at + timedelta(days=1)
+
+
+def start_compaction(
+    should_run: Callable[[], bool] = lambda: True
+) -> threading.Thread:
+    """
+    在后台线程每天运行一次`compact_records`
+
+    开启cluster时每个节点都会启动, 由`should_run`决定这次是否由本节点运行
+    """
+
+    def run():
+        while True:
+            at = next_compaction(datetime.now())
+            time.sleep(max(0.0, (at - datetime.now()).total_seconds()))
+            if not should_run():
+                continue
+            try:
+                compact_records()
+            except Exception as e:
+                logger.error(f"compacting records failed: {e}")
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
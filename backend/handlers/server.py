@@ -1,15 +1,87 @@
-from datetime import date
+import time
+import asyncio
+import threading
+from typing import List, Dict, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
 
 from sqlalchemy import select
-from invoke.context import Context
 
-from schemas import DoneClockRequest, AddUserRequest, AddPlanRequest
-from models import Session, Record, Clock
-from handlers.tasks import add_plan, update_user
+from config import get_config
+from logger import logger
+from schemas import DoneClockRequest, AddUserRequest, AddUsersRequest, AddPlanRequest
+from models import Session, AsyncSession, Record, Clock, Plan
+import metrics
+from hamicli import HamiCli, AsyncHamiCli
+from handlers.tasks import (
+    aadd_plan,
+    aupdate_user,
+    update_users,
+    aupdate_users,
+    load_script_versions,
+)
+from handlers.notify import notifier
+from handlers.timetable import clock_date
 
 
-def handle_add_plan(req: AddPlanRequest):
-    add_plan(
+def handle_add_users(cookies: List[str], concurrency: int) -> List[dict]:
+    """
+    批量添加用户
+
+    最多`concurrency`个用户同时获取信息, 全部拿到后在一个事务里写入,
+    返回失败的cookie序号和原因
+    """
+
+    def fetch(cookie: str) -> HamiCli:
+        cli = HamiCli(
+            cookie=cookie, fetch=True, script_versions=load_script_versions
+        )
+        cli.close()
+        return cli
+
+    clis, failed = [], []
+    with ThreadPoolExecutor(concurrency) as executor:
+        futures = [executor.submit(fetch, cookie) for cookie in cookies]
+        for index, future in enumerate(futures):
+            try:
+                clis.append(future.result())
+            except Exception as e:
+                logger.error(f"failed to add user #{index}: {e}")
+                failed.append(dict(index=index, msg=str(e)))
+
+    update_users(clis)
+    return failed
+
+
+async def ahandle_add_users(req: AddUsersRequest) -> List[dict]:
+    """handle_add_users的异步版本"""
+    semaphore = asyncio.Semaphore(get_config()["hamibot"]["onboard_concurrency"])
+
+    async def fetch(cookie: str) -> AsyncHamiCli:
+        async with semaphore:
+            cli = await AsyncHamiCli.create(
+                cookie=cookie, fetch=True, script_versions=load_script_versions
+            )
+            await cli.close()
+            return cli
+
+    results = await asyncio.gather(
+        *(fetch(cookie) for cookie in req.cookies), return_exceptions=True
+    )
+    clis, failed = [], []
+    for index, result in enumerate(results):
+        if isinstance(result, Exception):
+            logger.error(f"failed to add user #{index}: {result}")
+            failed.append(dict(index=index, msg=str(result)))
+        else:
+            clis.append(result)
+
+    await aupdate_users(clis)
+    return failed
+
+
+async def ahandle_add_plan(req: AddPlanRequest):
+    await aadd_plan(
         username=req.username,
         robotname=req.robotname,
         scriptname=req.scriptname,
@@ -17,15 +89,15 @@ def handle_add_plan(req: AddPlanRequest):
     )
 
 
-def handle_add_user(req: AddUserRequest):
-    from hamicli import HamiCli
-
-    cli = HamiCli(cookie=req.cookie, fetch=True)
+async def ahandle_add_user(req: AddUserRequest):
+    cli = await AsyncHamiCli.create(
+        cookie=req.cookie, fetch=True, script_versions=load_script_versions
+    )
 
     # 上一步初始化的东西都拿到了, 直接关闭cli即可
-    cli.close()
+    await cli.close()
 
-    update_user(
+    await aupdate_user(
         cookie=req.cookie,
         user_info=cli.user,
         robots=cli.robots,
@@ -35,8 +107,32 @@ def handle_add_user(req: AddUserRequest):
 
 
 def handle_done_clock(req: DoneClockRequest):
-    with Session() as session:
-        record = Record(
+    if get_config()["ingest"]["enabled"]:
+        done_clock_buffer.put(req)
+    else:
+        with Session() as session:
+            write_done_clocks(session, [req])
+
+
+async def ahandle_done_clock(req: DoneClockRequest):
+    if get_config()["ingest"]["enabled"]:
+        done_clock_buffer.put(req)
+    else:
+        async with AsyncSession() as session:
+            await session.run_sync(write_done_clocks, [req])
+
+
+def write_done_clocks(session: Session, reqs: List[DoneClockRequest]):
+    """
+    在一个事务里写入一批打卡回调
+
+    同一个用户的多次回调合并成一次Clock更新; 在跨零点时间段零点之后的打卡
+    和夜班第二天的下班打卡记到前一天, 和调度器判断是否到期时用的打卡状态一致
+    """
+    metrics.done_clock_batch_size.observe(len(reqs))
+    now = datetime.now()
+    session.add_all(
+        Record(
             user_id=req.user_id,
             robot_id=req.robot_id,
             script_id=req.script_id,
@@ -44,28 +140,146 @@ def handle_done_clock(req: DoneClockRequest):
             timestamp=req.timestamp,
             extra=req.extra,
         )
-        session.add(record)
-
-        statement = (
-            select(Clock)
-            .where(Clock.user_id == req.user_id)
-            .where(Clock.date == date.today())
-        )
-        clock = session.execute(statement).scalar()
-        if not clock:
-            clock = Clock(
-                user_id=req.user_id,
-                date=date.today(),
-            )
-            session.add(clock)
+        for req in reqs
+    )
 
+    # user_id => {"clockin": True, ...}
+    updates: Dict[str, Dict[str, bool]] = {}
+    for req in reqs:
+        update = updates.setdefault(req.user_id, {})
         direction = req.extra.get("direction")
         done = req.extra.get("done")
 
         if direction == "in" and done:
-            clock.clockin = True
-            clock.clokout = False
+            update["clockin"] = True
         elif direction == "out" and done:
-            clock.clockout = True
+            update["clockout"] = True
+
+    # (user_id, 打卡日期) => {"clockin": True, ...}
+    dated: Dict[Tuple[str, date], Dict[str, bool]] = {}
+    user_ranges = plan_ranges(session, list(updates))
+    for user_id, update in updates.items():
+        for key, value in update.items():
+            day = min(
+                (
+                    clock_date(now, ranges, key)
+                    for ranges in user_ranges.get(user_id, [])
+                ),
+                default=now.date(),
+            )
+            dated.setdefault((user_id, day), {})[key] = value
+
+    statement = (
+        select(Clock)
+        .where(Clock.user_id.in_(list(updates)))
+        .where(Clock.date.in_(list({day for _, day in dated})))
+    )
+    clocks = {
+        (clock.user_id, clock.date): clock
+        for clock in session.execute(statement).scalars()
+    }
+
+    for (user_id, day), update in dated.items():
+        clock = clocks.get((user_id, day))
+        if not clock:
+            clock = Clock(user_id=user_id, date=day)
+            session.add(clock)
+        for key, value in update.items():
+            setattr(clock, key, value)
+
+    session.commit()
+
+    notifier.notify(user_ids=updates)
+
+
+def plan_ranges(session: Session, user_ids: List[str]) -> Dict[str, List[dict]]:
+    """用户生效的Plan的打卡时间段"""
+    result: Dict[str, List[dict]] = {}
+    statement = (
+        select(Plan.user_id, Plan.ranges)
+        .where(Plan.user_id.in_(user_ids))
+        .where(Plan.deleted == False)
+    )
+    for user_id, ranges in session.execute(statement):
+        result.setdefault(user_id, []).append(ranges or {})
+    return result
+
+
+class DoneClockBuffer:
+    """
+    /done_clock/回调的写缓冲
+
+    回调先放进内存, 由后台线程每`flush_interval`毫秒或攒够`flush_size`条时
+    一次性写入数据库; `close`时把剩下的写完。
+    调用方已经收到成功的回复, 写入失败(比如多个worker同时写时SQLITE_BUSY)时
+    同一批退避后重试, 最多`retries`次
+    """
+
+    def __init__(self, flush_interval: float, flush_size: int, retries: int = 3):
+        self.flush_interval = flush_interval / 1000
+        self.flush_size = flush_size
+        self.retries = retries
+        self.pending: List[DoneClockRequest] = []
+        self.cond = threading.Condition()
+        self.thread: threading.Thread | None = None
+        self.closed = False
+
+    def put(self, req: DoneClockRequest):
+        with self.cond:
+            if self.closed:
+                raise RuntimeError("done_clock buffer is closed")
+            if not self.thread:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.pending.append(req)
+            if len(self.pending) in (1, self.flush_size):
+                self.cond.notify()
+
+    def take(self) -> List[DoneClockRequest]:
+        """空闲时一直等到有回调, 之后最多再等`flush_interval`攒一批"""
+        with self.cond:
+            while not self.pending and not self.closed:
+                self.cond.wait()
+            if len(self.pending) < self.flush_size and not self.closed:
+                self.cond.wait(self.flush_interval)
+            reqs, self.pending = self.pending, []
+            return reqs
+
+    def flush(self, reqs: List[DoneClockRequest]):
+        if not reqs:
+            return
+        for attempt in range(self.retries + 1):
+            try:
+                with Session() as session:
+                    write_done_clocks(session, reqs)
+                logger.debug(f"flushed {len(reqs)} done_clock requests")
+                return
+            except Exception as e:
+                if attempt == self.retries:
+                    logger.exception(
+                        f"dropped {len(reqs)} done_clock requests "
+                        f"after {attempt + 1} attempts: {e}"
+                    )
+                    return
+                logger.warning(f"failed to flush {len(reqs)} done_clock requests: {e}")
+                time.sleep(self.flush_interval * 2**attempt)
+
+    def run(self):
+        while not self.closed:
+            self.flush(self.take())
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        if self.thread:
+            self.thread.join()
+        self.flush(self.pending)
+        self.pending = []
+
 
-        session.commit()
+done_clock_buffer = DoneClockBuffer(
+    flush_interval=get_config()["ingest"]["flush_interval"],
+    flush_size=get_config()["ingest"]["flush_size"],
+    retries=get_config()["ingest"].get("flush_retries", 3),
+)
@@ -1,10 +1,27 @@
-from typing import Iterable, List
+from typing import Dict, Iterable, List, Tuple
+from datetime import datetime
 
+from pydantic import BaseModel
 from sqlalchemy import select, update
 from sqlalchemy.orm import joinedload
-from models import User, Script, Installation, Robot, Plan, Session, PlanType, engine
+from models import (
+    User,
+    Script,
+    Installation,
+    Robot,
+    Plan,
+    Session,
+    ReadSession,
+    AsyncSession,
+    PlanType,
+    engine,
+)
 from schemas import UserInfo, ScriptInfo, InstallationInfo, RobotInfo
+from hamicli import BaseHamiCli
 from logger import logger
+from handlers.notify import notifier
+from handlers.timetable import parse_range, format_range
+from handlers.blobs import pack_files
 
 
 def update_user(
@@ -15,121 +32,211 @@ def update_user(
     installations: List[InstallationInfo],
 ):
     with Session() as session:
-        statement = select(User).filter_by(id=user_info.user_id)
-        user: User = session.execute(statement).scalar_one_or_none()
+        upsert_user(session, cookie, user_info, robots, scripts, installations)
+        session.commit()
 
-        if user:
-            for key, value in user_info:
-                setattr(user, key, value)
-            user.cookie = cookie
-        else:
-            user_dict = user_info.dict()
-            user_dict["id"] = user_dict.pop("user_id")
-            user = User(cookie=cookie, **user_dict)
-            session.add(user)
 
-        logger.debug("updating user")
+async def aupdate_user(
+    cookie: str,
+    user_info: UserInfo,
+    robots: List[RobotInfo],
+    scripts: List[ScriptInfo],
+    installations: List[InstallationInfo],
+):
+    """update_user的异步版本"""
+    async with AsyncSession() as session:
+        await session.run_sync(
+            upsert_user, cookie, user_info, robots, scripts, installations
+        )
+        await session.commit()
 
-        update_robots(session, robots)
-        update_scripts(session, scripts)
-        update_installations(session, installations)
 
+def update_users(clis: List[BaseHamiCli]):
+    """在一个事务里写入多个用户"""
+    with Session() as session:
+        for cli in clis:
+            upsert_user(
+                session,
+                cli.cookie,
+                cli.user,
+                cli.robots,
+                cli.scripts,
+                cli.installations,
+            )
         session.commit()
 
 
+async def aupdate_users(clis: List[BaseHamiCli]):
+    """update_users的异步版本"""
+
+    def upsert_users(session: Session):
+        for cli in clis:
+            upsert_user(
+                session,
+                cli.cookie,
+                cli.user,
+                cli.robots,
+                cli.scripts,
+                cli.installations,
+            )
+
+    async with AsyncSession() as session:
+        await session.run_sync(upsert_users)
+        await session.commit()
+
+
+def upsert_user(
+    session: Session,
+    cookie: str,
+    user_info: UserInfo,
+    robots: List[RobotInfo],
+    scripts: List[ScriptInfo],
+    installations: List[InstallationInfo],
+):
+    statement = select(User).filter_by(id=user_info.user_id)
+    user: User = session.execute(statement).scalar_one_or_none()
+
+    if user:
+        for key, value in user_info:
+            setattr(user, key, value)
+        user.cookie = cookie
+    else:
+        user_dict = user_info.dict()
+        user_dict["id"] = user_dict.pop("user_id")
+        user = User(cookie=cookie, **user_dict)
+        session.add(user)
+
+    logger.debug("updating user")
+    # bulk写入不经过unit of work, 先把用户写进去
+    session.flush()
+
+    update_robots(session, user.id, robots)
+    update_scripts(session, user.id, scripts)
+    update_installations(session, user.id, installations)
+
+
 def add_plan(
     username: str = "", robotname: str = "", scriptname: str = "", userid: str = ""
 ):
-    user: User
     with Session() as session:
-        statement1 = (
-            select(User.id, Robot.id, Script.id, Script.configuration)
-            .join(User.robots)
-            .join(User.scripts)
-        )
-        statement2 = (
-            select(User.id, Robot.id, Installation.id, Installation.configuration)
-            .join(User.robots)
-            .join(User.installations)
+        plan_id = upsert_plan(session, username, robotname, scriptname, userid)
+        session.commit()
+
+    if plan_id is not None:
+        notifier.notify(plan_ids=[plan_id])
+
+
+async def aadd_plan(
+    username: str = "", robotname: str = "", scriptname: str = "", userid: str = ""
+):
+    """add_plan的异步版本"""
+    async with AsyncSession() as session:
+        plan_id = await session.run_sync(
+            upsert_plan, username, robotname, scriptname, userid
         )
+        await session.commit()
+
+    if plan_id is not None:
+        notifier.notify(plan_ids=[plan_id])
+
+
+def upsert_plan(
+    session: Session,
+    username: str = "",
+    robotname: str = "",
+    scriptname: str = "",
+    userid: str = "",
+) -> int | None:
+    """按名称找到用户/机器人/脚本并新建或更新Plan, 返回plan_id"""
+    statement1 = (
+        select(User.id, Robot.id, Script.id, Script.configuration)
+        .join(User.robots)
+        .join(User.scripts)
+    )
+    statement2 = (
+        select(User.id, Robot.id, Installation.id, Installation.configuration)
+        .join(User.robots)
+        .join(User.installations)
+    )
+
+    if username:
+        statement1 = statement1.where(User.username == username)
+        statement2 = statement2.where(User.username == username)
 
-        if username:
-            statement1 = statement1.where(User.username == username)
-            statement2 = statement2.where(User.username == username)
+    if userid:
+        statement1 = statement1.where(User.id == userid)
+        statement2 = statement2.where(User.id == userid)
 
-        if userid:
-            statement1 = statement1.where(User.id == userid)
-            statement2 = statement2.where(User.id == userid)
+    if robotname:
+        statement1 = statement1.where(Robot.name == robotname)
+        statement2 = statement2.where(Robot.name == robotname)
 
-        if robotname:
-            statement1 = statement1.where(Robot.name == robotname)
-            statement2 = statement2.where(Robot.name == robotname)
+    if scriptname:
+        statement1 = statement1.where(Installation.name == scriptname)
+        statement2 = statement2.where(Installation.name == scriptname)
 
-        if scriptname:
-            statement1 = statement1.where(Installation.name == scriptname)
-            statement2 = statement2.where(Installation.name == scriptname)
+    logger.debug(
+        f"statement1: {statement1.compile(engine, compile_kwargs={'literal_binds': True})}"
+    )
+    logger.debug(
+        f"statement2: {statement1.compile(engine, compile_kwargs={'literal_binds': True})}"
+    )
 
-        logger.debug(
-            f"statement1: {statement1.compile(engine, compile_kwargs={'literal_binds': True})}"
+    values1 = session.execute(statement1).first()
+    values2 = session.execute(statement2).first()
+    logger.info(f"script values: {values1}")
+    logger.info(f"installation values: {values2}")
+
+    if values1:
+        u, r, s, c, t = (
+            values1[0],
+            values1[1],
+            values1[2],
+            values1[3],
+            PlanType.script,
         )
-        logger.debug(
-            f"statement2: {statement1.compile(engine, compile_kwargs={'literal_binds': True})}"
+    elif values2:
+        u, r, s, c, t = (
+            values2[0],
+            values2[1],
+            values2[2],
+            values2[3],
+            PlanType.installation,
         )
+    else:
+        logger.error(
+            f"selection not found: {username}/{robotname}/{scriptname}/{userid}"
+        )
+        return None
+
+    plan = session.execute(
+        select(Plan)
+        .where(Plan.user_id == u)
+        .where(Plan.robot_id == r)
+        .where(Plan.script_id == s)
+        .where(Plan.type == t)
+    ).first()
+
+    if plan:
+        plan = plan[0]
+        logger.info(f"updating plan: {plan.__dict__}")
+
+    if not plan:
+        plan = Plan(
+            user_id=u,
+            robot_id=r,
+            script_id=s,
+            type=t,
+        )
+        session.add(plan)
+        logger.info(f"adding plan: {plan.__dict__}")
 
-        values1 = session.execute(statement1).first()
-        values2 = session.execute(statement2).first()
-        logger.info(f"script values: {values1}")
-        logger.info(f"installation values: {values2}")
-
-        if values1:
-            u, r, s, c, t = (
-                values1[0],
-                values1[1],
-                values1[2],
-                values1[3],
-                PlanType.script,
-            )
-        elif values2:
-            u, r, s, c, t = (
-                values2[0],
-                values2[1],
-                values2[2],
-                values1[3],
-                PlanType.installation,
-            )
-        else:
-            logger.error(
-                f"selection not found: {username}/{robotname}/{scriptname}/{userid}"
-            )
-            return
-
-        plan = session.execute(
-            select(Plan)
-            .where(Plan.user_id == u)
-            .where(Plan.robot_id == r)
-            .where(Plan.script_id == s)
-            .where(Plan.type == t)
-        ).first()
-
-        if plan:
-            plan = plan[0]
-            logger.info(f"updating plan: {plan.__dict__}")
-
-        if not plan:
-            plan = Plan(
-                user_id=u,
-                robot_id=r,
-                script_id=s,
-                type=t,
-            )
-            session.add(plan)
-            logger.info(f"adding plan: {plan.__dict__}")
-
-        ranges = get_ranges_from_configuration(c)
-        if ranges:
-            plan.ranges = ranges
+    ranges = get_ranges_from_configuration(c)
+    if ranges:
+        plan.ranges = ranges
 
-        session.commit()
+    session.flush()
+    return plan.id
 
 
 def del_plan(id: int):
@@ -138,6 +245,8 @@ def del_plan(id: int):
         session.execute(statement)
         session.commit()
 
+    notifier.notify(plan_ids=[id])
+
 
 def list_plans():
     with Session() as session:
@@ -160,77 +269,111 @@ def list_plans():
                 )
 
 
-def update_robots(session: Session, robots: List[RobotInfo]):
-    logger.debug("updating robots")
-    statement = (
-        update(Robot).where(Robot.id.not_in(iter_ids(robots))).values(deleted=True)
+def comparable(value):
+    """SQLite里的DateTime不带时区, 比较前去掉时区"""
+    if isinstance(value, datetime) and value.tzinfo:
+        return value.replace(tzinfo=None)
+    return value
+
+
+def sync_rows(
+    session: Session, model, user_id: str, items: Iterable[BaseModel | dict]
+) -> Tuple[int, int, int]:
+    """
+    把一个用户的远端数据同步到`model`表
+
+    只读取该用户的行, 按id比对后只写有变化的列, 远端已经没有的行标记为删除,
+    新增和更新分别用一次bulk_insert_mappings/bulk_update_mappings写入,
+    返回(新增, 更新, 删除)的行数
+    """
+    incoming: Dict[str, dict] = {}
+    keys = {"id", "deleted"}
+    for item in items:
+        values = dict(item) if isinstance(item, dict) else item.dict()
+        values["user_id"] = user_id
+        values["deleted"] = False
+        incoming[values["id"]] = values
+        keys.update(values)
+
+    table = model.__table__
+    columns = [table.c[key] for key in keys]
+    statement = select(*columns).where(table.c.user_id == user_id)
+    existing = {row.id: row._mapping for row in session.execute(statement)}
+
+    # id在其他用户名下的(比如设备转移)也按更新处理
+    missing = [id for id in incoming if id not in existing]
+    if missing:
+        statement = select(*columns).where(table.c.id.in_(missing))
+        existing.update(
+            (row.id, row._mapping) for row in session.execute(statement)
+        )
+
+    now = datetime.now()
+    inserts, updates = [], []
+    for id, values in incoming.items():
+        row = existing.get(id)
+        if row is None:
+            inserts.append(values)
+            continue
+        changed = {
+            key: value
+            for key, value in values.items()
+            if comparable(value) != comparable(row[key])
+        }
+        if changed:
+            updates.append(dict(changed, id=id, modified_at=now))
+
+    deleted = [
+        dict(id=id, deleted=True, modified_at=now)
+        for id, row in existing.items()
+        if id not in incoming and not row["deleted"]
+    ]
+
+    if inserts:
+        session.bulk_insert_mappings(model, inserts)
+    if updates or deleted:
+        session.bulk_update_mappings(model, updates + deleted)
+
+    logger.debug(
+        f"{table.name}: {len(inserts)} inserted, {len(updates)} updated, "
+        f"{len(deleted)} deleted"
     )
-    session.execute(statement)
-
-    updated_ids = set()
-    robot: Robot
-    statement = select(Robot).where(Robot.id.in_(iter_ids(robots)))
-    for robot in session.execute(statement).scalars():
-        updated_ids.add(robot.id)
-        for ri in robots:
-            if ri.id == robot.id:
-                for key, value in ri:
-                    setattr(robot, key, value)
-                break
-    for ri in robots:
-        if ri.id not in updated_ids:
-            session.add(Robot(**ri.dict()))
-
-
-def update_scripts(session: Session, scripts: List[ScriptInfo]):
+    return len(inserts), len(updates), len(deleted)
+
+
+def update_robots(session: Session, user_id: str, robots: List[RobotInfo]):
+    logger.debug("updating robots")
+    return sync_rows(session, Robot, user_id, robots)
+
+
+def update_scripts(session: Session, user_id: str, scripts: List[ScriptInfo]):
     logger.debug("updating scripts")
-    statement = (
-        update(Script).where(Script.id.not_in(iter_ids(scripts))).values(deleted=True)
-    )
-    session.execute(statement)
-
-    updated_ids = set()
-    script: Script
-    statement = select(Script).where(Script.id.in_(iter_ids(scripts)))
-    for script in session.execute(statement).scalars():
-        updated_ids.add(script.id)
-        for si in scripts:
-            if si.id == script.id:
-                for key, value in si:
-                    setattr(script, key, value)
-                break
+    items = []
     for si in scripts:
-        if si.id not in updated_ids:
-            session.add(Script(**si.dict()))
+        values = si.dict()
+        if si.files is None:
+            # 没有拉取文件的脚本保留已保存的文件
+            values.pop("files")
+        else:
+            values["files"] = pack_files(session, si.files)
+        items.append(values)
+    return sync_rows(session, Script, user_id, items)
 
 
-def update_installations(session: Session, installations: List[InstallationInfo]):
-    logger.debug("updating installations")
-    statement = (
-        update(Installation)
-        .where(Installation.id.not_in(iter_ids(installations)))
-        .values(deleted=True)
+def load_script_versions(user_id: str) -> Dict[str, datetime]:
+    """已保存的脚本 id => updatedAt, 供HamiCli跳过没有变化的脚本"""
+    statement = select(Script.id, Script.updated_at).where(
+        Script.user_id == user_id, Script.files.is_not(None)
     )
-    session.execute(statement)
-
-    updated_ids = set()
-    installation: Installation
-    statement = select(Installation).where(Installation.id.in_(iter_ids(installations)))
-    for installation in session.execute(statement).scalars():
-        updated_ids.add(installation.id)
-        for ii in installations:
-            if ii.id == installation.id:
-                for key, value in ii:
-                    setattr(installation, key, value)
-                break
-    for ii in installations:
-        if ii.id not in updated_ids:
-            session.add(Installation(**ii.dict()))
+    with ReadSession() as session:
+        return dict(session.execute(statement).all())
 
 
-def iter_ids(iterable: Iterable):
-    for item in iterable:
-        yield item.id
+def update_installations(
+    session: Session, user_id: str, installations: List[InstallationInfo]
+):
+    logger.debug("updating installations")
+    return sync_rows(session, Installation, user_id, installations)
 
 
 def get_ranges_from_configuration(configuration: dict):
@@ -239,8 +382,18 @@ def get_ranges_from_configuration(configuration: dict):
             "defaultValues", {}
         ).get(key)
 
-    clockin_range = get_config("clockInRange")
-    clockout_range = get_config("clockOutRange")
-    ranges = dict(clockin_range=clockin_range, clockout_range=clockout_range)
+    ranges = {}
+    for key, name in [
+        ("clockin_range", "clockInRange"),
+        ("clockout_range", "clockOutRange"),
+    ]:
+        ran = get_config(name)
+        if not ran:
+            continue
+        try:
+            # 存储前检查并规范成"HH:MM-HH:MM"
+            ranges[key] = format_range(*parse_range(ran))
+        except ValueError:
+            logger.warning(f"ignoring invalid {name}: {ran}")
     logger.info(f"ranges = {ranges}")
     return ranges
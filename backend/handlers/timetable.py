@@ -0,0 +1,260 @@
+"""
+Plan打卡时间段的预编译和批量判断
+
+时间段在加载时编译成当天的分钟区间 [start, end), end < start 表示跨零点,
+所有Plan的区间和打卡状态按列存成NumPy数组, 一次向量运算就能选出到期的Plan
+
+跨零点的时间段属于开始的那一天: 零点之后、结束之前看前一天的打卡状态;
+下班时间段比上班开始得早的是夜班, 第二天的下班打卡也属于前一天
+"""
+from typing import Dict, List, Tuple, Iterable
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+from logger import logger
+
+MINUTES_PER_DAY = 24 * 60
+
+DEFAULT_CLOCKIN_RANGE = "08:00-11:00"
+DEFAULT_CLOCKOUT_RANGE = "19:00-24:00"
+
+
+def parse_range(ran: str) -> Tuple[int, int]:
+    """把"08:00-11:00"解析成分钟区间(480, 660), 格式不对抛出ValueError"""
+    start, end = ran.split("-")
+    h1, m1 = start.split(":")
+    h2, m2 = end.split(":")
+    return int(h1) * 60 + int(m1), int(h2) * 60 + int(m2)
+
+
+def format_range(start: int, end: int) -> str:
+    return f"{start // 60:02d}:{start % 60:02d}-{end // 60:02d}:{end % 60:02d}"
+
+
+def compile_range(ran: str | None, default: str) -> Tuple[int, int]:
+    """解析时间段, 没有设置或格式不对时使用`default`"""
+    if ran:
+        try:
+            return parse_range(ran)
+        except ValueError:
+            logger.warning(f"invalid range: {ran}, using {default}")
+    return parse_range(default)
+
+
+def night_shift(in_start, out_start):
+    """下班时间段在上班的第二天"""
+    return out_start < in_start
+
+
+def clock_date(now: datetime, ranges: dict | None, key: str) -> date:
+    """
+    `now`的打卡(`key`为clockin或clockout)算在哪一天
+
+    在跨零点时间段零点之后的部分, 或者是夜班下一次上班之前的下班打卡时算前一天
+    """
+    ranges = ranges or {}
+    in_start, in_end = compile_range(
+        ranges.get("clockin_range"), DEFAULT_CLOCKIN_RANGE
+    )
+    out_start, out_end = compile_range(
+        ranges.get("clockout_range"), DEFAULT_CLOCKOUT_RANGE
+    )
+    minute = now.hour * 60 + now.minute
+    if key == "clockin":
+        start, end = in_start, in_end
+    elif night_shift(in_start, out_start) and minute < in_start:
+        return now.date() - timedelta(days=1)
+    else:
+        start, end = out_start, out_end
+    if start > end and minute < end:
+        return now.date() - timedelta(days=1)
+    return now.date()
+
+
+def in_tail(start: np.ndarray, end: np.ndarray, minute: int) -> np.ndarray:
+    """是否在跨零点时间段零点之后的部分"""
+    return (start > end) & (minute < end)
+
+
+def prev_out(
+    in_start: np.ndarray, out_start: np.ndarray, out_end: np.ndarray, minute: int
+) -> np.ndarray:
+    """下班打卡是否看前一天的状态: 跨零点的下班时间段零点之后, 或夜班下班时间段结束前"""
+    return in_tail(out_start, out_end, minute) | (
+        night_shift(in_start, out_start) & (minute < out_end)
+    )
+
+
+def in_window(start: np.ndarray, end: np.ndarray, minute: int) -> np.ndarray:
+    return np.where(
+        start <= end,
+        (start <= minute) & (minute < end),
+        (minute >= start) | (minute < end),
+    )
+
+
+def minutes_until(start: np.ndarray, minute: int) -> np.ndarray:
+    """距离下一次到达`start`的分钟数, 刚好在`start`则算明天"""
+    delta = (start - minute) % MINUTES_PER_DAY
+    return np.where(delta == 0, MINUTES_PER_DAY, delta)
+
+
+class PlanTable:
+    """
+    按列存放的Plan时间段和打卡状态(当天和前一天)
+
+    删除的行放回空闲列表复用, 容量不够时翻倍
+    """
+
+    def __init__(self, capacity: int = 1024):
+        self.rows: Dict[int, int] = {}  # plan_id => row
+        self.free: List[int] = []
+        self.size = 0
+        self.capacity = 0
+        self.allocate(capacity)
+
+    def allocate(self, capacity: int):
+        def resize(array: np.ndarray | None, dtype) -> np.ndarray:
+            new = np.zeros(capacity, dtype=dtype)
+            if array is not None:
+                new[: len(array)] = array
+            return new
+
+        fresh = self.capacity == 0
+        self.plan_ids = resize(None if fresh else self.plan_ids, np.int64)
+        self.active = resize(None if fresh else self.active, np.bool_)
+        self.in_start = resize(None if fresh else self.in_start, np.int16)
+        self.in_end = resize(None if fresh else self.in_end, np.int16)
+        self.out_start = resize(None if fresh else self.out_start, np.int16)
+        self.out_end = resize(None if fresh else self.out_end, np.int16)
+        self.clockin = resize(None if fresh else self.clockin, np.bool_)
+        self.clockout = resize(None if fresh else self.clockout, np.bool_)
+        self.prev_clockin = resize(None if fresh else self.prev_clockin, np.bool_)
+        self.prev_clockout = resize(None if fresh else self.prev_clockout, np.bool_)
+        self.capacity = capacity
+
+    def clear(self):
+        self.rows.clear()
+        self.free.clear()
+        self.size = 0
+        self.active[:] = False
+
+    def upsert(
+        self,
+        plan_id: int,
+        ranges: dict | None,
+        clockin: bool,
+        clockout: bool,
+        prev_clockin: bool = False,
+        prev_clockout: bool = False,
+    ):
+        row = self.rows.get(plan_id)
+        if row is None:
+            if self.free:
+                row = self.free.pop()
+            else:
+                if self.size == self.capacity:
+                    self.allocate(self.capacity * 2)
+                row = self.size
+                self.size += 1
+            self.rows[plan_id] = row
+
+        ranges = ranges or {}
+        in_start, in_end = compile_range(
+            ranges.get("clockin_range"), DEFAULT_CLOCKIN_RANGE
+        )
+        out_start, out_end = compile_range(
+            ranges.get("clockout_range"), DEFAULT_CLOCKOUT_RANGE
+        )
+        self.plan_ids[row] = plan_id
+        self.active[row] = True
+        self.in_start[row], self.in_end[row] = in_start, in_end
+        self.out_start[row], self.out_end[row] = out_start, out_end
+        self.clockin[row] = clockin
+        self.clockout[row] = clockout
+        self.prev_clockin[row] = prev_clockin
+        self.prev_clockout[row] = prev_clockout
+
+    def remove(self, plan_id: int):
+        row = self.rows.pop(plan_id, None)
+        if row is not None:
+            self.active[row] = False
+            self.free.append(row)
+
+    def out_pending(self, rows: np.ndarray | slice, minute: int) -> np.ndarray:
+        """`rows`中已经上班打卡、还没下班打卡的行"""
+        return np.where(
+            prev_out(
+                self.in_start[rows], self.out_start[rows], self.out_end[rows], minute
+            ),
+            self.prev_clockin[rows] & ~self.prev_clockout[rows],
+            self.clockin[rows] & ~self.clockout[rows],
+        )
+
+    def due_masks(
+        self, rows: np.ndarray | slice, minute: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """`rows`中当前需要上班打卡、下班打卡的行"""
+        in_start, in_end = self.in_start[rows], self.in_end[rows]
+        out_start, out_end = self.out_start[rows], self.out_end[rows]
+
+        # 跨零点的时间段在零点之后仍按前一天的打卡状态判断
+        in_done = np.where(
+            in_tail(in_start, in_end, minute),
+            self.prev_clockin[rows],
+            self.clockin[rows],
+        )
+
+        active = self.active[rows]
+        due_in = active & ~in_done & in_window(in_start, in_end, minute)
+        due_out = (
+            active
+            & self.out_pending(rows, minute)
+            & in_window(out_start, out_end, minute)
+        )
+        return due_in, due_out
+
+    def due_mask(self, rows: np.ndarray | slice, minute: int) -> np.ndarray:
+        """`rows`中当前需要打卡的行"""
+        due_in, due_out = self.due_masks(rows, minute)
+        return due_in | due_out
+
+    def phase(self, plan_id: int, now: datetime) -> str:
+        """当前需要上班打卡(in)还是下班打卡(out)"""
+        rows = np.array([self.rows[plan_id]])
+        due_in, due_out = self.due_masks(rows, now.hour * 60 + now.minute)
+        if due_in[0]:
+            return "in"
+        if due_out[0]:
+            return "out"
+        return "out" if self.clockin[rows[0]] else "in"
+
+    def due(self, now: datetime) -> np.ndarray:
+        """所有当前需要打卡的plan_id"""
+        minute = now.hour * 60 + now.minute
+        rows = slice(0, self.size)
+        return self.plan_ids[rows][self.due_mask(rows, minute)]
+
+    def evaluate(
+        self, plan_ids: Iterable[int], now: datetime
+    ) -> Tuple[np.ndarray, List[datetime]]:
+        """
+        批量判断`plan_ids`是否需要打卡, 并计算下次可以运行的时间
+
+        需要打卡的返回`now`, 否则返回下一个需要打卡的时间段的开始时间
+        """
+        rows = np.fromiter((self.rows[plan_id] for plan_id in plan_ids), np.int64)
+        minute = now.hour * 60 + now.minute
+        due = self.due_mask(rows, minute)
+
+        next_in = minutes_until(self.in_start[rows], minute)
+        next_out = minutes_until(self.out_start[rows], minute)
+        offsets = np.where(self.out_pending(rows, minute), next_out, next_in)
+
+        base = now.replace(second=0, microsecond=0)
+        fire_times = [
+            now if is_due else base + timedelta(minutes=int(offset))
+            for is_due, offset in zip(due.tolist(), offsets.tolist())
+        ]
+        return due, fire_times
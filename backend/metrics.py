@@ -0,0 +1,108 @@
+"""
+Prometheus指标
+
+app的/metrics输出这里注册的所有指标。API进程开多个uvicorn worker时,
+`server.py`给它们设置PROMETHEUS_MULTIPROC_DIR, 各worker的指标写进这个目录,
+/metrics汇总所有worker(`registry`)
+"""
+import os
+import time
+
+from prometheus_client import (
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    multiprocess,
+)
+
+# 打卡高峰时一次tick可能派发上千个Job, 桶的上限放宽一些
+TICK_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BATCH_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+scheduler_tick_seconds = Histogram(
+    "clockin_scheduler_tick_seconds",
+    "Scheduler每次tick的耗时",
+    buckets=TICK_BUCKETS,
+)
+plan_reload_seconds = Histogram(
+    "clockin_plan_reload_seconds",
+    "从数据库重新加载Plan/Clock的耗时",
+    ["kind"],  # full/incremental
+    buckets=TICK_BUCKETS,
+)
+scheduler_dispatched = Counter(
+    "clockin_scheduler_dispatched_total", "派发给执行器的Job数"
+)
+
+# 多进程模式下只汇总还活着的进程
+executor_queued = Gauge(
+    "clockin_executor_queued", "已派发还没开始运行的Job数", multiprocess_mode="livesum"
+)
+executor_active = Gauge(
+    "clockin_executor_active", "正在运行的Job数", multiprocess_mode="livesum"
+)
+executor_workers = Gauge(
+    "clockin_executor_workers", "执行器当前的线程数", multiprocess_mode="livesum"
+)
+scheduler_deferred = Counter(
+    "clockin_scheduler_deferred_total",
+    "每次tick后仍在等执行器或机器人/用户空位的Plan数之和",
+)
+job_run_seconds = Histogram(
+    "clockin_job_run_seconds",
+    "Job从开始运行到收到确认的耗时",
+    ["outcome"],  # ok/unconfirmed/error
+)
+
+hamicli_connect_seconds = Histogram(
+    "clockin_hamicli_connect_seconds",
+    "HamiCli连接各阶段的耗时",
+    ["phase"],  # handshake/join/list
+)
+
+done_clock_seconds = Histogram(
+    "clockin_done_clock_seconds", "/done_clock/请求的处理耗时"
+)
+done_clock_batch_size = Histogram(
+    "clockin_done_clock_batch_size",
+    "每次写入数据库的/done_clock/回调数",
+    buckets=BATCH_BUCKETS,
+)
+
+
+def job_started() -> float:
+    executor_queued.dec()
+    executor_active.inc()
+    return time.perf_counter()
+
+
+def job_finished(started: float, result: dict | None):
+    executor_active.dec()
+    if not result or result.get("code") != 0:
+        outcome = "error"
+    elif result.get("confirmed") is False:
+        outcome = "unconfirmed"
+    else:
+        outcome = "ok"
+    job_run_seconds.labels(outcome).observe(time.perf_counter() - started)
+
+
+def multiprocess_dir() -> str | None:
+    return os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+
+
+def registry() -> CollectorRegistry:
+    """/metrics输出的指标, 多进程模式下汇总目录里所有进程的"""
+    if not multiprocess_dir():
+        return REGISTRY
+    collected = CollectorRegistry()
+    multiprocess.MultiProcessCollector(collected)
+    return collected
+
+
+def mark_process_dead():
+    """worker退出时清掉它的Gauge, 累计的Counter/Histogram保留"""
+    if multiprocess_dir():
+        multiprocess.mark_process_dead(os.getpid())
@@ -1,7 +1,12 @@
 import enum
-from sqlalchemy import inspect, create_engine
+import zlib
+from datetime import datetime
+
+from sqlalchemy import inspect, create_engine, text, event, select, update, bindparam
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession as _AsyncSession
 from sqlalchemy import (
     Boolean,
     Column,
@@ -13,16 +18,112 @@ from sqlalchemy import (
     DateTime,
     Date,
     Enum,
+    Index,
+    LargeBinary,
 )
 from sqlalchemy.orm import relationship, deferred
 
-from config import get_config
+from config import get_config, store
+from logger import logger
+
+# 连接建立时执行的SQLite PRAGMA
+PRAGMAS = ["journal_mode", "synchronous", "mmap_size", "cache_size", "busy_timeout"]
+
+
+def storage_profile() -> dict:
+    """configs/*.yaml里`database.profile`指定的storage配置"""
+    config = get_config()
+    name = config["database"].get("profile", "default")
+    return config.get("storage", {}).get(name) or {}
+
+
+def apply_profile(engine, readonly: bool = False):
+    """每个新连接都按当前的profile设置PRAGMA"""
+    if engine.dialect.name != "sqlite":
+        return
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        profile = storage_profile()
+        cursor = dbapi_connection.cursor()
+        for key in PRAGMAS:
+            # 只读连接改不了journal_mode
+            if key in profile and not (readonly and key == "journal_mode"):
+                cursor.execute(f"PRAGMA {key}={profile[key]}")
+        cursor.close()
+
+
+def pool_options(profile: dict) -> dict:
+    if "pool_size" not in profile:
+        return {}
+    return dict(
+        poolclass=QueuePool,
+        pool_size=profile["pool_size"],
+        max_overflow=profile.get("max_overflow", 10),
+    )
+
+
+def async_url(url: str) -> str:
+    """sqlite:///... => sqlite+aiosqlite:///..."""
+    if url.startswith("sqlite://"):
+        return "sqlite+aiosqlite://" + url[len("sqlite://") :]
+    return url
+
+
+def readonly_url(url: str) -> str:
+    """sqlite:///path => sqlite:///file:path?mode=ro&uri=true"""
+    if url.startswith("sqlite:///") and "?" not in url:
+        return f"sqlite:///file:{url[len('sqlite:///') :]}?mode=ro&uri=true"
+    return url
+
+
+profile = storage_profile()
 
 engine = create_engine(
-    get_config()["database"]["url"], connect_args={"check_same_thread": False}
+    get_config()["database"]["url"],
+    connect_args={"check_same_thread": False},
+    **pool_options(profile),
 )
+apply_profile(engine)
 Session = sessionmaker(bind=engine)
 
+# 调度器只读, 用单独的只读连接, 在WAL模式下不会阻塞写入
+read_engine = create_engine(
+    get_config()["database"].get("readonly_url")
+    or readonly_url(get_config()["database"]["url"]),
+    connect_args={"check_same_thread": False},
+    **pool_options(profile),
+)
+apply_profile(read_engine, readonly=True)
+ReadSession = sessionmaker(bind=read_engine)
+
+async_engine = create_async_engine(
+    get_config()["database"].get("async_url")
+    or async_url(get_config()["database"]["url"])
+)
+apply_profile(async_engine.sync_engine)
+AsyncSession = sessionmaker(
+    bind=async_engine, class_=_AsyncSession, expire_on_commit=False
+)
+
+
+def on_database_changed(old: dict, new: dict):
+    """
+    数据库配置变化: 丢掉空闲连接, 之后新建的连接按新的PRAGMA设置
+
+    连接地址和连接池大小在引擎创建时就确定了, 需要重启才能生效
+    """
+    for key in ("url", "readonly_url", "async_url"):
+        if old["database"].get(key) != new["database"].get(key):
+            logger.warning(f"database.{key} changed, restart to apply")
+    if pool_options(profile) != pool_options(storage_profile()):
+        logger.warning("database pool options changed, restart to apply")
+    engine.dispose()
+    read_engine.dispose()
+
+
+store.subscribe(on_database_changed, "database", "storage")
+
 Base = declarative_base()
 
 
@@ -47,6 +148,9 @@ class User(Base):
     referral_count = Column(Integer)
 
     cookie = Column(String)
+    modified_at = Column(
+        DateTime, index=True, default=datetime.now, onupdate=datetime.now
+    )
 
     robots = relationship("Robot", back_populates="user")
     scripts = relationship("Script", back_populates="user")
@@ -62,6 +166,9 @@ class Robot(Base):
     id = Column(String, primary_key=True, index=True)
     user_id = Column(String, ForeignKey("users.id"))
     deleted = Column(Boolean, index=True, default=False)
+    modified_at = Column(
+        DateTime, index=True, default=datetime.now, onupdate=datetime.now
+    )
 
     online = Column(Boolean)
     version = Column(String)
@@ -87,7 +194,11 @@ class Script(Base):
     use_message = Column(Boolean)
     updated_at = Column(DateTime)
     listing_slug = Column(String)
+    modified_at = Column(
+        DateTime, index=True, default=datetime.now, onupdate=datetime.now
+    )
     configuration = deferred(Column(JSON))
+    # 文件元信息, 正文存在blobs里, 每项的"blob"是正文的sha256
     files = deferred(Column(JSON))
 
     user = relationship("User", back_populates="scripts")
@@ -110,24 +221,41 @@ class Installation(Base):
     version = Column(String)
     icon = Column(String)
     use_for_task = Column(Boolean)
+    modified_at = Column(
+        DateTime, index=True, default=datetime.now, onupdate=datetime.now
+    )
 
     user = relationship("User", back_populates="installations")
     plans = relationship("Plan", back_populates="installation")
 
 
+def shard_of(user_id: str) -> int:
+    """用户所在的分片, 同一用户的Plan总在同一个调度节点上"""
+    return zlib.crc32(user_id.encode()) % get_config()["cluster"]["shards"]
+
+
+def plan_shard(context) -> int | None:
+    user_id = context.get_current_parameters().get("user_id")
+    return shard_of(user_id) if user_id else None
+
+
 class Plan(Base):
     __tablename__ = "plans"
 
     id = Column(Integer, primary_key=True, index=True)
     type = Column(Enum(PlanType))
-    user_id = Column(String, ForeignKey("users.id"))
-    robot_id = Column(String, ForeignKey("robots.id"))
-    script_id = Column(String, ForeignKey("scripts.id"))
-    installation_id = Column(String, ForeignKey("installations.id"))
+    user_id = Column(String, ForeignKey("users.id"), index=True)
+    robot_id = Column(String, ForeignKey("robots.id"), index=True)
+    script_id = Column(String, ForeignKey("scripts.id"), index=True)
+    installation_id = Column(String, ForeignKey("installations.id"), index=True)
     deleted = Column(Boolean, index=True, default=False)
     ranges = Column(
         JSON, default={"clockin_range": "08:00-11:00", "clockout_range": "19:00-24:00"}
     )
+    shard = Column(Integer, index=True, default=plan_shard)
+    modified_at = Column(
+        DateTime, index=True, default=datetime.now, onupdate=datetime.now
+    )
 
     user = relationship("User", back_populates="plans")
     robot = relationship("Robot", back_populates="plans")
@@ -136,7 +264,14 @@ class Plan(Base):
 
 
 class Record(Base):
+    """
+    打卡回调的原始记录
+
+    只保留最近的数据, 更早的由handlers/records.py汇总进RecordDaily并按月归档
+    """
+
     __tablename__ = "records"
+    __table_args__ = (Index("ix_records_user_timestamp", "user_id", "timestamp"),)
 
     id = Column(Integer, primary_key=True, index=True)
 
@@ -152,19 +287,120 @@ class Record(Base):
     robot = relationship("Robot", back_populates="records")
 
 
+class RecordDaily(Base):
+    """每个用户每天的打卡汇总"""
+
+    __tablename__ = "record_dailies"
+
+    user_id = Column(String, ForeignKey("users.id"), primary_key=True)
+    date = Column(Date, primary_key=True)
+
+    count = Column(Integer, default=0)
+    clockin_at = Column(DateTime)  # 最早一次完成上班打卡的时间
+    clockout_at = Column(DateTime)  # 最晚一次完成下班打卡的时间
+
+
+class Blob(Base):
+    """按sha256去重、zlib压缩存放的脚本文件正文"""
+
+    __tablename__ = "blobs"
+
+    hash = Column(String, primary_key=True)
+    size = Column(Integer)  # 压缩前的字节数
+    data = Column(LargeBinary)
+    created_at = Column(DateTime, default=datetime.now)
+    referenced_at = Column(DateTime, default=datetime.now)  # 最近一次被写入的脚本引用
+
+
+class SchedulerNode(Base):
+    """调度节点, 定期心跳, 超过`cluster.lease_ttl`没有心跳的视为下线"""
+
+    __tablename__ = "scheduler_nodes"
+
+    id = Column(String, primary_key=True)
+    host = Column(String)
+    pid = Column(Integer)
+    started_at = Column(DateTime, default=datetime.now)
+    heartbeat_at = Column(DateTime, index=True)
+
+
+class ShardLease(Base):
+    """分片的租约, 只有持有未过期租约的节点可以派发该分片的Plan"""
+
+    __tablename__ = "shard_leases"
+
+    shard = Column(Integer, primary_key=True)
+    node_id = Column(String)
+    expires_at = Column(DateTime)
+
+
+class PlanDispatch(Base):
+    """
+    每个Plan最近一次派发
+
+    派发前写入, 分片换了节点后新节点据此恢复DispatchLedger, 避免重复打卡
+    """
+
+    __tablename__ = "plan_dispatches"
+
+    plan_id = Column(Integer, ForeignKey("plans.id"), primary_key=True)
+    phase = Column(String)
+    node_id = Column(String)
+    dispatched_at = Column(DateTime)
+
+
 class Clock(Base):
     __tablename__ = "clocks"
 
     id = Column(Integer, primary_key=True, index=True)
 
-    user_id = Column(String, ForeignKey("users.id"))
+    user_id = Column(String, ForeignKey("users.id"), index=True)
 
-    date = Column(Date)
+    date = Column(Date, index=True)
     clockin = Column(Boolean, default=False)
     clockout = Column(Boolean, default=False)
+    modified_at = Column(
+        DateTime, index=True, default=datetime.now, onupdate=datetime.now
+    )
 
     user = relationship("User", back_populates="clocks")
 
 
+def migrate(engine):
+    """
+    建表, 并给已有的表补上新增的列
+    """
+    Base.metadata.create_all(engine)
+
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = {c["name"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                type_ = column.type.compile(engine.dialect)
+                conn.execute(
+                    text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {type_}")
+                )
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+        # 补上(或在cluster.shards改变后重新计算)Plan的分片
+        rows = conn.execute(select(Plan.id, Plan.user_id, Plan.shard)).all()
+        updates = [
+            dict(plan_id=id, shard=shard_of(user_id))
+            for id, user_id, shard in rows
+            if user_id and shard != shard_of(user_id)
+        ]
+        if updates:
+            conn.execute(
+                update(Plan)
+                .where(Plan.id == bindparam("plan_id"))
+                .values(shard=bindparam("shard")),
+                updates,
+            )
+
+
 def object_as_dict(obj):
     return {c.key: getattr(obj, c.key) for c in inspect(obj).mapper.column_attrs}
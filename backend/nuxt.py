@@ -0,0 +1,156 @@
+"""
+从Nuxt页面的`window.__NUXT__`里取出状态
+
+页面里的状态是一个闭包::
+
+    window.__NUXT__=(function(a,b,c){return {state:{auth:{user:{token:b}}}}}(null,"xx",1));
+
+按token扫描一遍闭包体, 只记下目标路径(如state.auth.user)对应的片段,
+读完参数后只在这个片段里把参数名替换成实参, 再交给pyjson5解析
+"""
+import re
+from typing import List, Tuple
+
+import pyjson5
+
+HEAD_PATTERN = re.compile(r"__NUXT__\s*=\s*\(\s*function\s*\(([^)]*)\)\s*\{\s*return\s*")
+
+TOKEN_PATTERN = re.compile(
+    r"""
+    "(?:[^"\\]|\\.)*"                           # 双引号字符串
+    |'(?:[^'\\]|\\.)*'                          # 单引号字符串
+    |-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?           # 数字
+    |[A-Za-z_$][\w$]*                           # 标识符
+    |[{}\[\]():,]                               # 结构符号
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+
+# 跳过不关心的子树时只需要看括号和字符串
+SKIP_PATTERN = re.compile(
+    r"""
+    "(?:[^"\\]|\\.)*"
+    |'(?:[^'\\]|\\.)*'
+    |[{}\[\]()]
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+
+OPENERS = {"{", "[", "("}
+CLOSERS = {"}", "]", ")"}
+
+
+def skip(html: str, pos: int, depth: int = 0) -> int:
+    """从`pos`开始跳过括号, 返回嵌套深度回到`depth - 1`之后的位置"""
+    for m in SKIP_PATTERN.finditer(html, pos):
+        token = m.group()
+        if token in OPENERS:
+            depth += 1
+        elif token in CLOSERS:
+            depth -= 1
+            if depth < 0:
+                return m.end()
+    raise ValueError("unterminated object")
+
+
+def scan_body(html: str, start: int, path: List[str]) -> Tuple[int, int, int]:
+    """
+    扫描从`start`开始的对象字面量
+
+    只逐个token走`path`经过的对象, 其他子树直接跳过,
+    返回(`path`对应值的起点, 终点, 对象结束后的位置), 找不到`path`时起点为-1
+    """
+    m = TOKEN_PATTERN.search(html, start)
+    if not m or m.group() != "{":
+        raise ValueError("object expected")
+    pos = m.end()
+    depth = 1  # 已经进入的对象层数, 都在`path`上
+    key: str | None = None
+    expect_key = True
+
+    while True:
+        m = TOKEN_PATTERN.search(html, pos)
+        if not m:
+            raise ValueError("unterminated object")
+        token = m.group()
+        pos = m.end()
+
+        if token == ":":
+            expect_key = False
+        elif token == ",":
+            expect_key = True
+        elif token in CLOSERS:
+            # 这一层里没有找到`path`, 剩下的层直接跳过
+            return -1, -1, skip(html, pos, depth - 2) if depth > 1 else pos
+        elif expect_key:
+            key = token.strip("\"'")
+        elif key != path[depth - 1]:
+            if token in OPENERS:
+                pos = skip(html, pos)
+        elif depth == len(path):
+            span_end = skip(html, pos) if token in OPENERS else pos
+            return m.start(), span_end, skip(html, span_end, depth - 1)
+        elif token == "{":
+            depth += 1
+            expect_key = True
+        else:
+            return -1, -1, skip(html, pos if token not in OPENERS else skip(html, pos), depth - 1)
+
+
+def scan_args(html: str, start: int) -> List[str]:
+    """读取`}(arg1,arg2,...)`里的实参文本"""
+    args: List[str] = []
+    depth = 0
+    arg_start = -1
+    for m in TOKEN_PATTERN.finditer(html, start):
+        token = m.group()
+        if depth == 0:
+            if token == "(":
+                depth = 1
+                arg_start = m.end()
+            continue
+        if token in OPENERS:
+            depth += 1
+        elif token in CLOSERS:
+            depth -= 1
+            if depth == 0:
+                args.append(html[arg_start : m.start()].strip())
+                return [arg for arg in args if arg]
+        elif token == "," and depth == 1:
+            args.append(html[arg_start : m.start()].strip())
+            arg_start = m.end()
+    raise ValueError("unterminated arguments")
+
+
+def substitute(text: str, params: dict) -> str:
+    """把片段里作为值出现的参数名替换成实参"""
+    parts = []
+    last = 0
+    for m in TOKEN_PATTERN.finditer(text):
+        token = m.group()
+        if token in params and text[m.end() :].lstrip()[:1] != ":":
+            parts.append(text[last : m.start()])
+            parts.append(params[token])
+            last = m.end()
+    parts.append(text[last:])
+    return "".join(parts)
+
+
+def extract_state(html: str, path: List[str]):
+    """取出`window.__NUXT__`里`path`对应的值, 找不到时抛出ValueError"""
+    m = HEAD_PATTERN.search(html)
+    if not m:
+        raise ValueError("__NUXT__ not found")
+
+    names = [name.strip() for name in m.group(1).split(",") if name.strip()]
+    span_start, span_end, body_end = scan_body(html, m.end(), path)
+    if span_start < 0:
+        raise ValueError(f"{'.'.join(path)} not found")
+
+    args = scan_args(html, body_end)
+    params = {
+        name: "null" if arg == "void 0" else arg for name, arg in zip(names, args)
+    }
+    # 没有传实参的参数是undefined
+    params.update({name: "null" for name in names[len(args) :]})
+    return pyjson5.decode(substitute(html[span_start:span_end], params))
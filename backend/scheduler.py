@@ -0,0 +1,40 @@
+"""
+调度进程
+
+和API进程分开运行, 同一个数据库只运行一个(开启cluster后每个节点一个)。
+API进程通过`plan.notify_socket`通知Plan和打卡状态的变化;
+`plan.admin_port`上提供调度器的/metrics和/admin/接口::
+
+    python scheduler.py
+"""
+import uvicorn
+from fastapi import FastAPI
+
+import admin
+from config import get_config
+from handlers.plan import start_scheduler
+
+app = FastAPI()
+app.include_router(admin.metrics_router)
+app.include_router(admin.router)
+
+
+@app.on_event("startup")
+def on_startup():
+    start_scheduler()
+
+
+@app.get("/health")
+async def health():
+    """
+    健康检查
+    """
+    return "OK"
+
+
+def main():
+    uvicorn.run(app=app, host="127.0.0.1", port=get_config()["plan"]["admin_port"])
+
+
+if __name__ == "__main__":
+    main()
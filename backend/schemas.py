@@ -1,3 +1,4 @@
+from typing import List
 from datetime import datetime
 
 from pydantic import BaseModel, Field
@@ -24,6 +25,14 @@ class AddUserRequest(BaseModel):
     cookie: str
 
 
+class AddUsersRequest(BaseModel):
+    """
+    批量AddUser请求体
+    """
+
+    cookies: List[str]
+
+
 class DoneClockRequest(BaseModel):
     """
     DoneClock请求体
@@ -76,7 +85,7 @@ class ScriptInfo(BaseModel):
     updated_at: datetime = Field(alias="updatedAt", default_factory=datetime.now)
     listing_slug: str = Field(alias="listingSlug", default="")
     configuration: dict = {}
-    files: list = []
+    files: list | None = None  # None表示没有拉取, 沿用已保存的文件
 
 
 class InstallationInfo(BaseModel):
@@ -1,22 +1,36 @@
+import os
 import sys
+import shutil
 from subprocess import Popen
 
 import uvicorn
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
-from schemas import DoneClockRequest, AddUserRequest, AddPlanRequest
-from handlers.plan import start_scheduler
-from handlers.server import handle_done_clock, handle_add_user, handle_add_plan
+from schemas import DoneClockRequest, AddUserRequest, AddUsersRequest, AddPlanRequest
+import admin
+import metrics
+from config import get_config
+from handlers.server import (
+    ahandle_done_clock,
+    ahandle_add_user,
+    ahandle_add_users,
+    ahandle_add_plan,
+    done_clock_buffer,
+)
 from utils import handles_error
 
 
+# 调度器在单独的进程(scheduler.py)里运行, 这里可以开多个worker
 app = FastAPI()
+# /admin/只在调度进程的本机端口上提供
+app.include_router(admin.metrics_router)
 
 
-@app.on_event("startup")
-def on_startup():
-    start_scheduler()
+@app.on_event("shutdown")
+def on_shutdown():
+    done_clock_buffer.close()
+    metrics.mark_process_dead()
 
 
 @app.get("/health")
@@ -29,13 +43,14 @@ async def health():
 
 @app.post("/done_clock/")
 @handles_error
-def done_clock(req: DoneClockRequest):
+async def done_clock(req: DoneClockRequest):
     """
     完成打卡
 
     记录完成打卡事项
     """
-    handle_done_clock(req)
+    with metrics.done_clock_seconds.time():
+        await ahandle_done_clock(req)
 
 
 app2 = FastAPI()
@@ -51,19 +66,33 @@ app2.add_middleware(
 
 @app2.post("/add_user/")
 @handles_error
-def add_user(req: AddUserRequest):
+async def add_user(req: AddUserRequest):
     """添加用户信息"""
-    handle_add_user(req)
+    await ahandle_add_user(req)
+
+
+@app2.post("/add_users/")
+@handles_error
+async def add_users(req: AddUsersRequest):
+    """批量添加用户信息, 返回失败的cookie序号"""
+    failed = await ahandle_add_users(req)
+    return dict(code=0, msg="ok", failed=failed)
 
 
 @app2.post("/add_plan/")
 @handles_error
-def add_plan(req: AddPlanRequest):
+async def add_plan(req: AddPlanRequest):
     """添加自动打卡脚本"""
-    handle_add_plan(req)
+    await ahandle_add_plan(req)
 
 
 if __name__ == "__main__":
+    Popen([sys.executable, "scheduler.py"], stdout=sys.stdout, stderr=sys.stderr)
+
+    # 多个worker的指标写进同一个目录, 由/metrics汇总; 目录在每次启动时清空
+    metrics_dir = get_config()["server"]["metrics_dir"]
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir)
     Popen(
         [
             "uvicorn",
@@ -73,9 +102,12 @@ if __name__ == "__main__":
             "--port",
             "8000",
             "--proxy-headers",
+            "--workers",
+            str(get_config()["server"]["workers"]),
         ],
         stdout=sys.stdout,
         stderr=sys.stderr,
+        env=dict(os.environ, PROMETHEUS_MULTIPROC_DIR=metrics_dir),
     )
     uvicorn.run(
         app=app2,
@@ -1,14 +1,14 @@
 from invoke import task
 
-from models import Base, engine
+from models import Base, engine, migrate
 
 from handlers.tasks import (
     update_user as update_user_db,
     add_plan as add_plan_db,
     del_plan as del_plan_db,
     list_plans as list_plans_db,
+    load_script_versions,
 )
-from handlers.plan import start_scheduler
 
 
 @task
@@ -19,6 +19,67 @@ def init_db(c, force=False):
     Base.metadata.create_all(engine)
 
 
+@task
+def migrate_db(c):
+    """给已有数据库补上新增的表和列, 把旧格式的脚本文件正文移进blobs"""
+    from models import Session
+    from handlers.blobs import pack_inline_files
+
+    migrate(engine)
+    with Session() as session:
+        count = pack_inline_files(session)
+        session.commit()
+    print(f"packed files of {count} scripts")
+
+
+@task
+def compact_records(c, raw_days=-1, archive_months=-1):
+    """
+    汇总并归档过期的打卡记录, 清理过期的归档
+
+    :param raw_days: 保留多少天的原始记录, 默认取配置
+    :param archive_months: 归档保留几个月, 默认取配置
+    """
+    from handlers.records import compact_records
+
+    compact_records(
+        raw_days=raw_days if raw_days >= 0 else None,
+        archive_months=archive_months if archive_months >= 0 else None,
+    )
+
+
+@task
+def prune_blobs(c):
+    """删除没有脚本引用的文件正文"""
+    from models import Session
+    from handlers.blobs import prune_blobs
+
+    with Session() as session:
+        count = prune_blobs(session)
+        session.commit()
+    print(f"pruned {count} blobs")
+
+
+@task
+def show_script(c, id=""):
+    """
+    输出脚本保存的文件和正文
+
+    :param id: 脚本id
+    """
+    from models import Session, Script
+    from handlers.blobs import unpack_files
+
+    with Session() as session:
+        script = session.get(Script, id)
+        if not script:
+            print(f"script {id} not found")
+            return
+        for file in unpack_files(session, script.files):
+            print(f"--- {file.get('filename')}")
+            print(file.get("text", ""))
+
+
 @task
 def add_user(c, cookie=""):
     """
@@ -26,7 +87,7 @@ def add_user(c, cookie=""):
     """
     from hamicli import HamiCli
 
-    cli = HamiCli(cookie=cookie, fetch=True)
+    cli = HamiCli(cookie=cookie, fetch=True, script_versions=load_script_versions)
 
     # 上一步初始化的东西都拿到了, 直接关闭cli即可
     cli.close()
@@ -40,6 +101,27 @@ def add_user(c, cookie=""):
     )
 
 
+@task
+def add_users(c, file="", concurrency=0):
+    """
+    批量添加用户
+
+    :param file: 每行一个cookie的文件
+    :param concurrency: 同时处理的用户数, 默认取配置
+    """
+    from config import get_config
+    from handlers.server import handle_add_users
+
+    with open(file) as f:
+        cookies = [line.strip() for line in f if line.strip()]
+
+    failed = handle_add_users(
+        cookies, concurrency or get_config()["hamibot"]["onboard_concurrency"]
+    )
+    for item in failed:
+        print(f"#{item['index']}: {item['msg']}")
+
+
 @task
 def update_user(c, cookie=""):
     """
@@ -83,5 +165,6 @@ def run_plans(c):
     """
     执行定时任务
     """
-    thread = start_scheduler()
-    thread.join()
+    from scheduler import main
+
+    main()
@@ -0,0 +1,21 @@
+import os
+
+import pytest
+
+from helpers import use_temp_config
+
+
+@pytest.fixture
+def temp_config(tmp_path, monkeypatch):
+    """
+    按`overrides`在`tmp_path`里写一份临时配置, 返回配置文件的路径
+
+    只给子进程用, 当前进程的CONFIG_PATH在测试结束后恢复原样
+    """
+
+    def make(overrides: dict) -> str:
+        monkeypatch.delenv("CONFIG_PATH", raising=False)
+        use_temp_config(overrides, workdir=str(tmp_path))
+        return os.environ.pop("CONFIG_PATH")
+
+    return make
@@ -0,0 +1,51 @@
+"""
+tests和benchmarks共用的临时配置
+
+项目模块在导入时就会读取配置、创建数据库引擎, 所以必须先调用`use_temp_config`,
+再导入config/models/handlers等模块
+"""
+import os
+import sys
+import tempfile
+
+import yaml
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def merge(base: dict, overrides: dict) -> dict:
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(base.get(key), dict):
+            merge(base[key], value)
+        else:
+            base[key] = value
+    return base
+
+
+def use_temp_config(overrides: dict, workdir: str | None = None) -> str:
+    """
+    以configs/dev.yaml为基础写一份临时配置, 并通过CONFIG_PATH生效
+
+    数据库默认放在临时目录里, 返回临时目录
+    """
+    workdir = workdir or tempfile.mkdtemp(prefix="clockin-bench-")
+    with open(os.path.join(BACKEND, "configs", "dev.yaml")) as f:
+        config = yaml.safe_load(f)
+
+    config["database"]["url"] = f"sqlite:///{os.path.join(workdir, 'bench.db3')}"
+    config["plan"]["notify_socket"] = os.path.join(workdir, "scheduler.sock")
+    merge(config, overrides)
+
+    path = os.path.join(workdir, "config.yaml")
+    with open(path, "w") as f:
+        yaml.safe_dump(config, f, allow_unicode=True)
+    os.environ["CONFIG_PATH"] = path
+    return workdir
+
+
+def quiet_logs(level: str = "WARNING"):
+    """只输出`level`以上的日志, 也不写logs/clockin.log"""
+    from logger import logger
+
+    logger.remove()
+    logger.add(sys.stderr, level=level)
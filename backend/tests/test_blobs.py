@@ -0,0 +1,65 @@
+"""
+脚本文件正文存储的测试, 用单独的临时SQLite
+
+    cd backend
+    python -m pytest tests/test_blobs.py
+"""
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, select, update
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import StaticPool
+
+from models import Base, Blob, Script
+from handlers.blobs import (
+    pack_files,
+    pack_inline_files,
+    prune_blobs,
+    put_blobs,
+    unpack_files,
+)
+
+INLINE = [{"filename": "index.js", "text": "// old\n"}]
+
+
+def create_session(path) -> Session:
+    engine = create_engine(f"sqlite:///{path}", poolclass=StaticPool)
+    Base.metadata.create_all(engine)
+    return Session(engine)
+
+
+def backdate(session: Session, days: int = 2):
+    long_ago = datetime.now() - timedelta(days=days)
+    session.execute(update(Blob).values(created_at=long_ago, referenced_at=long_ago))
+
+
+def test_pack_inline_files(tmp_path):
+    session = create_session(tmp_path / "blobs.db3")
+    session.add(Script(id="s1", user_id="u1", files=INLINE))
+    session.add(Script(id="s2", user_id="u1", files=pack_files(session, INLINE)))
+    session.commit()
+
+    assert pack_inline_files(session) == 1
+    session.commit()
+    assert pack_inline_files(session) == 0
+
+    files = session.execute(select(Script.files).where(Script.id == "s1")).scalar()
+    assert "text" not in files[0]
+    assert unpack_files(session, files) == INLINE
+
+
+def test_prune_keeps_recently_referenced(tmp_path):
+    session = create_session(tmp_path / "blobs.db3")
+    put_blobs(session, ["unused", "shared"])
+    session.commit()
+    backdate(session)
+
+    # 同步中的脚本刚引用了已有的正文, Script.files还没有提交
+    put_blobs(session, ["shared"])
+    assert prune_blobs(session) == 1
+    assert set(session.execute(select(Blob.hash)).scalars()) == set(
+        put_blobs(session, ["shared"])
+    )
+
+    backdate(session)
+    assert prune_blobs(session) == 1
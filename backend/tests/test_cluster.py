@@ -0,0 +1,212 @@
+"""
+多个调度节点的分片测试, 每个节点是一个独立进程, 共用一个临时SQLite
+
+每个节点通过自己的Pipe同步上报, 杀掉一个节点不会影响其他节点的上报
+
+    cd backend
+    python -m pytest tests/test_cluster.py
+"""
+import os
+import time
+import sqlite3
+import multiprocessing
+from multiprocessing.connection import Connection, wait
+from typing import Dict, Iterator, List
+
+import pytest
+
+from helpers import quiet_logs
+
+SHARDS = 16
+USERS = 40
+LEASE_TTL = 2
+HEARTBEAT = 0.3
+
+ctx = multiprocessing.get_context("spawn")
+
+
+def setup_child(config_path: str):
+    os.environ["CONFIG_PATH"] = config_path
+    quiet_logs("ERROR")
+
+
+def run_node(config_path: str, node_id: str, reports: Connection):
+    """只心跳的节点, 每次心跳后上报持有的分片"""
+    setup_child(config_path)
+    from datetime import datetime
+    from handlers.cluster import Cluster
+
+    cluster = Cluster(node_id=node_id)
+    while True:
+        cluster.heartbeat(datetime.now())
+        reports.send((node_id, time.time(), sorted(cluster.owned)))
+        time.sleep(HEARTBEAT)
+
+
+def run_scheduler(config_path: str, node_id: str, dispatched: Connection):
+    """用假的dispatch运行Scheduler, 上报派发的Plan"""
+    setup_child(config_path)
+    from concurrent.futures import Future
+    from handlers.plan import Scheduler
+    from handlers.cluster import Cluster
+
+    class FakeScheduler(Scheduler):
+        def dispatch(self, job):
+            dispatched.send((node_id, job.plan.id, time.time()))
+            future = Future()
+            future.set_result({"code": 0})
+            return future
+
+    scheduler = FakeScheduler()
+    scheduler.cluster = Cluster(node_id=node_id)
+    scheduler.run()
+
+
+def prepare(config_path: str):
+    """建表并为每个用户建一个全天的Plan"""
+    setup_child(config_path)
+    from models import engine, migrate, Session, User, Robot, Script, Plan, PlanType
+
+    migrate(engine)
+    with Session() as session:
+        for index in range(USERS):
+            user_id = f"u{index}"
+            session.add(User(id=user_id, username=user_id, token=user_id))
+            session.add(Robot(id=f"{user_id}-r0", user_id=user_id, name="robot"))
+            session.add(Script(id=f"{user_id}-s0", user_id=user_id, name="script"))
+            session.flush()
+            session.add(
+                Plan(
+                    type=PlanType.script,
+                    user_id=user_id,
+                    robot_id=f"{user_id}-r0",
+                    script_id=f"{user_id}-s0",
+                    ranges={
+                        "clockin_range": "00:00-24:00",
+                        "clockout_range": "00:00-24:00",
+                    },
+                )
+            )
+        session.commit()
+
+
+@pytest.fixture
+def config_path(temp_config):
+    path = temp_config(
+        {
+            "cluster": {
+                "enabled": True,
+                "shards": SHARDS,
+                "vnodes": 16,
+                "lease_ttl": LEASE_TTL,
+                "heartbeat": HEARTBEAT,
+            },
+            "plan": {"cooldown": 600, "interval": 1, "resync": 1},
+            "ingest": {"enabled": False},
+            "tracing": {"enabled": False},
+        }
+    )
+    process = ctx.Process(target=prepare, args=(path,))
+    process.start()
+    process.join(60)
+    assert process.exitcode == 0
+    yield path
+
+
+@pytest.fixture
+def processes():
+    started: List[multiprocessing.Process] = []
+    yield started
+    for process in started:
+        process.kill()
+        process.join()
+
+
+def start(processes, readers: List[Connection], target, *args):
+    """启动节点进程, 它的上报从新加入`readers`的Pipe读取"""
+    reader, writer = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=target, args=args + (writer,), daemon=True)
+    process.start()
+    writer.close()
+    processes.append(process)
+    readers.append(reader)
+    return process
+
+
+def receive(readers: List[Connection], timeout: float) -> Iterator[tuple]:
+    """`timeout`秒内从所有节点收到的上报, 进程退出的节点不再读取"""
+    deadline = time.time() + timeout
+    while readers and time.time() < deadline:
+        for reader in wait(readers, timeout=max(0, min(0.5, deadline - time.time()))):
+            try:
+                yield reader.recv()
+            except EOFError:
+                readers.remove(reader)
+
+
+def latest_owned(readers, nodes: List[str], since: float, timeout: float):
+    """
+    等到`nodes`在`since`之后的最新上报恰好不重不漏地分完所有分片, 且每个节点都分到了分片
+    """
+    latest: Dict[str, List[int]] = {}
+    for node_id, reported_at, owned in receive(readers, timeout):
+        if reported_at < since:
+            continue
+        latest[node_id] = owned
+        if set(latest) != set(nodes) or not all(latest.values()):
+            continue
+        shards = [shard for owned in latest.values() for shard in owned]
+        if sorted(shards) == list(range(SHARDS)):
+            return latest
+    raise AssertionError(f"shards not partitioned: {latest}")
+
+
+def test_partition_and_rebalance(config_path, processes):
+    readers: List[Connection] = []
+    nodes = ["node-a", "node-b", "node-c"]
+    workers = {
+        node: start(processes, readers, run_node, config_path, node) for node in nodes
+    }
+
+    latest_owned(readers, nodes, 0, timeout=30)
+
+    # 节点崩溃后不会主动让出分片, 租约过期后由其余节点接手
+    workers["node-b"].kill()
+    killed_at = time.time()
+    latest = latest_owned(readers, ["node-a", "node-c"], killed_at, timeout=30)
+    assert "node-b" not in latest
+
+
+def test_plan_leases_in_database(config_path, processes):
+    readers: List[Connection] = []
+    for node in ["node-a", "node-b"]:
+        start(processes, readers, run_node, config_path, node)
+    latest = latest_owned(readers, ["node-a", "node-b"], 0, timeout=30)
+
+    database = config_path.replace("config.yaml", "bench.db3")
+    with sqlite3.connect(database) as conn:
+        leases = dict(conn.execute("select shard, node_id from shard_leases"))
+        plans = conn.execute("select shard from plans").fetchall()
+    for node, owned in latest.items():
+        assert {shard for shard, owner in leases.items() if owner == node} >= set(owned)
+    assert all(shard is not None and 0 <= shard < SHARDS for shard, in plans)
+
+
+def test_dispatch_exactly_once(config_path, processes):
+    readers: List[Connection] = []
+
+    def collect(seconds: float) -> list:
+        return list(receive(readers, seconds))
+
+    # 第一个节点先拿到全部分片并派发, 第二个节点加入后分走一半
+    first = start(processes, readers, run_scheduler, config_path, "node-a")
+    items = collect(3)
+    start(processes, readers, run_scheduler, config_path, "node-b")
+    items += collect(3)
+
+    # 第一个节点崩溃, 分片全部转给第二个节点
+    first.kill()
+    items += collect(LEASE_TTL * 3)
+
+    plan_ids = [plan_id for _, plan_id, _ in items]
+    assert sorted(plan_ids) == list(range(1, USERS + 1))
@@ -0,0 +1,50 @@
+"""
+FairDispatcher名额的测试
+
+    cd backend
+    python -m pytest tests/test_dispatcher.py
+"""
+from datetime import datetime, timedelta
+
+from models import Plan, PlanType
+from handlers.dispatcher import FairDispatcher
+
+
+def plans_on_one_robot():
+    return [
+        Plan(id=plan_id, type=PlanType.script, user_id="u1", robot_id="r1")
+        for plan_id in (1, 2)
+    ]
+
+
+def dispatch_first(dispatcher: FairDispatcher, now: datetime):
+    first, second = plans_on_one_robot()
+    dispatcher.offer(first, "clockin")
+    dispatcher.offer(second, "clockin")
+    assert dispatcher.take(10) == [(first, "clockin")]
+    # 服务端已确认运行, 脚本还没跑完
+    dispatcher.hold(first, now)
+    return second
+
+
+def test_second_plan_waits_until_done_clock():
+    dispatcher = FairDispatcher(robot_limit=1, user_limit=2, hold_seconds=600)
+    now = datetime.now()
+    second = dispatch_first(dispatcher, now)
+
+    dispatcher.expire(now + timedelta(seconds=10))
+    assert dispatcher.take(10) == []
+    assert dispatcher.waiting == 1
+
+    dispatcher.release_user("u1")
+    assert dispatcher.take(10) == [(second, "clockin")]
+
+
+def test_second_plan_runs_after_hold_expires():
+    dispatcher = FairDispatcher(robot_limit=1, user_limit=2, hold_seconds=600)
+    now = datetime.now()
+    second = dispatch_first(dispatcher, now)
+
+    dispatcher.expire(now + timedelta(seconds=600))
+    assert dispatcher.take(10) == [(second, "clockin")]
+    assert not dispatcher.held
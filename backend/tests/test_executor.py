@@ -0,0 +1,22 @@
+"""
+AdaptiveExecutor的测试
+
+    cd backend
+    python -m pytest tests/test_executor.py
+"""
+import metrics
+from handlers.executor import AdaptiveExecutor
+
+
+def workers_gauge() -> float:
+    return metrics.executor_workers._value.get()
+
+
+def test_workers_gauge_follows_shutdown():
+    executor = AdaptiveExecutor(min_workers=3, max_workers=5, queue_size=10)
+    assert workers_gauge() == 3
+    assert executor.submit(lambda: {"code": 0}).result(timeout=1) == {"code": 0}
+
+    executor.shutdown()
+    assert executor.workers == 0
+    assert workers_gauge() == 0
@@ -0,0 +1,137 @@
+"""
+HamiCli连接池和运行确认的测试, 不连接真实的Hamibot
+
+    cd backend
+    python -m pytest tests/test_hamicli.py
+"""
+import time
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from schemas import UserInfo, RobotInfo
+from hamicli import BaseHamiCli, HamiCli, HamiCliPool, AsyncHamiCliPool
+
+
+class IdleCli:
+    """只有连接池会用到的属性"""
+
+    def __init__(self, user_id: str, last_used: float):
+        self.user = SimpleNamespace(user_id=user_id, username=user_id)
+        self.last_used = last_used
+        self.alive = True
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+        self.alive = False
+
+
+class AsyncIdleCli(IdleCli):
+    async def close(self):
+        super().close()
+
+
+class RecordingSio:
+    """记下emit的ack回调, 由测试决定什么时候回复"""
+
+    def __init__(self):
+        self.callbacks = []
+
+    def emit(self, event, data, callback=None):
+        self.callbacks.append(callback)
+
+
+def offline_cli() -> HamiCli:
+    """不连接服务端的HamiCli, 只初始化协议处理的状态"""
+    cli = HamiCli.__new__(HamiCli)
+    BaseHamiCli.__init__(cli, UserInfo(token="t", user_id="u"))
+    cli.sio = RecordingSio()
+    return cli
+
+
+def robot(robot_id: str) -> RobotInfo:
+    return RobotInfo(_id=robot_id, name=robot_id)
+
+
+def wait_until(predicate, timeout: float) -> bool:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.05)
+    return predicate()
+
+
+def test_pool_evicts_without_get():
+    pool = HamiCliPool(idle_timeout=0.2)
+    idle = IdleCli("idle", time.time() - 1)
+    busy = IdleCli("busy", time.time() + 60)
+    pool.clis = {"idle": idle, "busy": busy}
+
+    pool.watch()
+    assert wait_until(lambda: idle.closed, timeout=2)
+    assert list(pool.clis) == ["busy"]
+    assert not busy.closed
+
+
+def test_async_pool_evicts_without_get():
+    async def main():
+        pool = AsyncHamiCliPool(idle_timeout=0.2)
+        idle = AsyncIdleCli("idle", time.time() - 1)
+        pool.clis = {"idle": idle}
+
+        pool.watch()
+        for _ in range(40):
+            if idle.closed:
+                break
+            await asyncio.sleep(0.05)
+        await pool.close()
+        return idle.closed, pool.clis
+
+    closed, clis = asyncio.run(main())
+    assert closed
+    assert not clis
+
+
+def test_run_ack_and_broadcast_complete_one_run():
+    cli = offline_cli()
+    first = cli.run_script("s1", robot("r1"))
+    second = cli.run_script("s2", robot("r1"))
+
+    # 第一次运行的ack回调和广播都到了, 第二次运行仍在等待
+    cli.sio.callbacks[0]({"ok": True})
+    cli.on_run_ack("b:script:run", {"ok": True})
+    assert first.result(timeout=0) == {"ok": True}
+    assert not second.done()
+
+    cli.sio.callbacks[1]({"ok": True})
+    assert second.result(timeout=0) == {"ok": True}
+
+
+def test_run_broadcast_matches_script_and_robot():
+    cli = offline_cli()
+    first = cli.run_script("s1", robot("r1"))
+    second = cli.run_script("s2", robot("r2"))
+
+    # 服务端不回ack时用广播完成, 按scriptId/robotId对应而不是发送顺序
+    cli.on_run_ack("b:script:run", {"scriptId": "s2", "robotId": "r2"})
+    assert second.done() and not first.done()
+    cli.on_run_ack("b:script:run", {"scriptId": "s2", "robotId": "r2"})
+    assert not first.done()
+    cli.on_run_ack("b:script:run", {"scriptId": "s1"})
+    assert first.done()
+
+
+def test_subclass_must_implement_transport():
+    class PartialCli(BaseHamiCli):
+        def send(self, event, data):
+            pass
+
+        def drop(self):
+            pass
+
+    # 少实现了notify, 创建时就报错, 而不是等到socket事件里
+    with pytest.raises(TypeError, match="notify"):
+        PartialCli(UserInfo(token="t", user_id="u"))
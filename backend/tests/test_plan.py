@@ -0,0 +1,181 @@
+"""
+JobManager增量加载的测试, 用单独的临时SQLite, 不读写配置里的数据库
+
+    cd backend
+    python -m pytest tests/test_plan.py
+"""
+from datetime import date, datetime, timedelta
+from contextlib import contextmanager
+from concurrent.futures import Future
+
+import pytest
+from sqlalchemy import create_engine, insert, select, update
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import StaticPool
+
+from config import get_config
+from schemas import UserInfo
+from models import Base, User, Robot, Script, Plan, PlanType
+from handlers import plan as plan_module
+from handlers.plan import Job, JobManager, DispatchLedger, Dispatch, UNCONFIRMED
+
+LONG_AGO = datetime.now() - timedelta(days=1)
+
+
+def create_database(path, users: int):
+    engine = create_engine(f"sqlite:///{path}", poolclass=StaticPool)
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        for model, rows in (
+            (User, [dict(id=f"u{i}", username=f"u{i}") for i in range(users)]),
+            (Robot, [dict(id=f"r{i}", user_id=f"u{i}") for i in range(users)]),
+            (Script, [dict(id=f"s{i}", user_id=f"u{i}") for i in range(users)]),
+            (
+                Plan,
+                [
+                    dict(
+                        type=PlanType.script,
+                        user_id=f"u{i}",
+                        robot_id=f"r{i}",
+                        script_id=f"s{i}",
+                        shard=0,
+                    )
+                    for i in range(users)
+                ],
+            ),
+        ):
+            rows = [dict(row, modified_at=LONG_AGO) for row in rows]
+            conn.execute(insert(model), rows)
+    return engine
+
+
+def explain(engine, statement) -> str:
+    sql = str(statement.compile(engine, compile_kwargs={"literal_binds": True}))
+    with engine.connect() as conn:
+        rows = conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}").all()
+    return "\n".join(row[-1] for row in rows)
+
+
+def reload_steps(engine, manager: JobManager, since: datetime) -> int:
+    """增量加载执行的SQLite虚拟机指令数(以100条为单位)"""
+    steps = 0
+
+    def count():
+        nonlocal steps
+        steps += 1
+
+    connection = engine.raw_connection().driver_connection
+    connection.set_progress_handler(count, 100)
+    try:
+        with Session(engine) as session:
+            manager.reload_plans(session, since=since)
+    finally:
+        connection.set_progress_handler(None, 100)
+    return steps
+
+
+@pytest.mark.parametrize("shards", [None, {0, 1}])
+def test_incremental_query_uses_indexes(tmp_path, shards):
+    engine = create_database(tmp_path / "plans.db3", users=10)
+    manager = JobManager()
+    manager.shards = shards
+    plan = explain(engine, manager.plans_query(datetime.now(), plan_ids=[1, 2]))
+    assert "SCAN plans" not in plan
+
+
+def test_incremental_clocks_query_uses_indexes(tmp_path):
+    engine = create_database(tmp_path / "plans.db3", users=10)
+    statement = JobManager.clocks_query(date.today(), datetime.now(), ["u1", "u2"])
+    assert "SCAN clocks" not in explain(engine, statement)
+
+
+def test_incremental_cost_flat_without_changes(tmp_path):
+    steps = []
+    for users in (1000, 10000):
+        engine = create_database(tmp_path / f"plans-{users}.db3", users=users)
+        manager = JobManager()
+        with Session(engine) as session:
+            assert len(manager.reload_plans(session)) == users
+        steps.append(reload_steps(engine, manager, datetime.now()))
+    # 没有变化时开销和Plan数量无关
+    assert steps[1] <= steps[0] + 5
+
+
+def test_incremental_picks_up_related_changes(tmp_path):
+    engine = create_database(tmp_path / "plans.db3", users=10)
+    manager = JobManager()
+    with Session(engine) as session:
+        manager.reload_plans(session)
+
+    since = datetime.now()
+    with engine.begin() as conn:
+        conn.execute(update(User).where(User.id == "u1").values(username="new"))
+        conn.execute(update(Robot).where(Robot.id == "r2").values(name="new"))
+        conn.execute(update(Script).where(Script.id == "s3").values(name="new"))
+        plan_ids = dict(conn.execute(select(Plan.user_id, Plan.id)).all())
+
+    with Session(engine) as session:
+        changed = manager.reload_plans(session, since=since, plan_ids=[plan_ids["u5"]])
+    assert changed == {plan_ids[user_id] for user_id in ("u1", "u2", "u3", "u5")}
+
+
+class StubPool:
+    """连接池的替身, 记下出错时是否丢弃了连接"""
+
+    def __init__(self, cli):
+        self.cli = cli
+        self.discarded = False
+
+    @contextmanager
+    def session(self, user_info):
+        try:
+            yield self.cli
+        except Exception:
+            self.discarded = True
+            raise
+
+
+class SilentCli:
+    """发出运行指令后服务端既不回ack也不广播"""
+
+    def __init__(self, error: Exception | None = None):
+        self.error = error
+        self.handles = []
+
+    def run_script(self, script_id, robot):
+        if self.error:
+            raise self.error
+        handle = Future()
+        self.handles.append(handle)
+        return handle
+
+
+def run_job(monkeypatch, cli) -> tuple:
+    pool = StubPool(cli)
+    monkeypatch.setattr(plan_module, "cli_pool", pool)
+    monkeypatch.setitem(get_config()["hamibot"], "run_timeout", 0.05)
+    job = Job(Plan(id=1, type=PlanType.script, user_id="u1", script_id="s1"))
+    user_info = UserInfo(token="t", user_id="u1")
+    monkeypatch.setattr(job, "describe", lambda: (user_info, "s1"))
+    return job.run(), pool
+
+
+def test_unconfirmed_run_is_not_retried(monkeypatch):
+    cli = SilentCli()
+    result, pool = run_job(monkeypatch, cli)
+    assert result == UNCONFIRMED
+    assert cli.handles[0].cancelled()
+    assert not pool.discarded
+
+    ledger = DispatchLedger(cooldown=600, backoff=30)
+    now = datetime.now()
+    ledger.start(1, "in", now)
+    ledger.finish(1, True, now, confirmed=False)
+    assert ledger.entries[1].state == Dispatch.UNCONFIRMED
+    assert ledger.blocked_until(1, "in", now) == now + timedelta(seconds=600)
+
+
+def test_failed_emit_backs_off(monkeypatch):
+    result, pool = run_job(monkeypatch, SilentCli(ConnectionError("closed")))
+    assert result["code"] != 0
+    assert pool.discarded
@@ -0,0 +1,59 @@
+"""
+/done_clock/写缓冲的测试, 写入数据库的函数用替身代替
+
+    cd backend
+    python -m pytest tests/test_server.py
+"""
+import time
+import threading
+from datetime import datetime
+
+from schemas import DoneClockRequest
+from handlers import server
+from handlers.server import DoneClockBuffer
+
+
+def done_clock(user_id: str) -> DoneClockRequest:
+    return DoneClockRequest(
+        app_env="{}",
+        user_id=user_id,
+        robot_id="r1",
+        script_id="s1",
+        timestamp=datetime.now(),
+        extra={"direction": "in", "done": True},
+    )
+
+
+def test_failed_flush_is_retried(monkeypatch):
+    written, attempts = [], []
+
+    def write_done_clocks(session, reqs):
+        attempts.append(len(reqs))
+        if len(attempts) == 1:
+            raise RuntimeError("database is locked")
+        written.extend(req.user_id for req in reqs)
+
+    monkeypatch.setattr(server, "write_done_clocks", write_done_clocks)
+    buffer = DoneClockBuffer(flush_interval=10, flush_size=2, retries=2)
+    buffer.put(done_clock("u1"))
+    buffer.put(done_clock("u2"))
+    buffer.close()
+    assert attempts == [2, 2]
+    assert written == ["u1", "u2"]
+
+
+def test_take_blocks_while_idle():
+    buffer = DoneClockBuffer(flush_interval=10, flush_size=100)
+    taken = []
+    thread = threading.Thread(target=lambda: taken.append(buffer.take()))
+    thread.start()
+
+    # 没有回调时不会每隔flush_interval空转返回
+    time.sleep(0.1)
+    assert not taken
+
+    with buffer.cond:
+        buffer.pending.append(done_clock("u1"))
+        buffer.cond.notify()
+    thread.join(timeout=1)
+    assert [req.user_id for req in taken[0]] == ["u1"]
@@ -0,0 +1,80 @@
+"""
+打卡时间段判断的测试
+
+    cd backend
+    python -m pytest tests/test_timetable.py
+"""
+from datetime import date, datetime
+
+from handlers.timetable import PlanTable, clock_date
+
+NIGHT = {"clockin_range": "22:00-02:00", "clockout_range": "06:00-08:00"}
+DAY = datetime(2022, 8, 1)
+
+
+def at(day: int, hour: int, minute: int = 0) -> datetime:
+    return DAY.replace(day=day, hour=hour, minute=minute)
+
+
+def test_wrapping_window_uses_previous_day_after_midnight():
+    table = PlanTable()
+    table.upsert(1, NIGHT, clockin=False, clockout=False)
+    assert table.due(at(1, 22, 30)).tolist() == [1]
+
+    # 23:00打卡成功
+    table.upsert(1, NIGHT, clockin=True, clockout=False)
+    assert table.due(at(1, 23)).tolist() == []
+
+    # 零点之后换成新一天的(空)打卡状态, 仍然看前一天的
+    table.upsert(1, NIGHT, clockin=False, clockout=False, prev_clockin=True)
+    assert table.due(at(2, 0, 30)).tolist() == []
+    # 时间段结束后才轮到新一天
+    assert table.due(at(2, 22)).tolist() == [1]
+
+
+def test_wrapping_window_fires_after_midnight_if_missed():
+    table = PlanTable()
+    table.upsert(1, NIGHT, clockin=False, clockout=False, prev_clockin=False)
+    assert table.due(at(2, 1)).tolist() == [1]
+    assert table.phase(1, at(2, 1)) == "in"
+
+
+def test_wrapping_clockout_window():
+    ranges = {"clockin_range": "14:00-16:00", "clockout_range": "23:00-01:00"}
+    table = PlanTable()
+    table.upsert(1, ranges, clockin=False, clockout=False, prev_clockin=True)
+    assert table.due(at(2, 0, 30)).tolist() == [1]
+    assert table.phase(1, at(2, 0, 30)) == "out"
+
+    table.upsert(
+        1, ranges, clockin=False, clockout=False, prev_clockin=True, prev_clockout=True
+    )
+    assert table.due(at(2, 0, 30)).tolist() == []
+
+
+def test_night_shift_clockout_next_morning():
+    table = PlanTable()
+    # 23:00上班打卡, 记在前一天; 零点之后当天还没有打卡记录
+    table.upsert(1, NIGHT, clockin=False, clockout=False, prev_clockin=True)
+    due, fire_times = table.evaluate([1], at(2, 2, 30))
+    assert not due[0] and fire_times[0] == at(2, 6)
+
+    assert table.due(at(2, 7)).tolist() == [1]
+    assert table.phase(1, at(2, 7)) == "out"
+
+    table.upsert(
+        1, NIGHT, clockin=False, clockout=False, prev_clockin=True, prev_clockout=True
+    )
+    assert table.due(at(2, 7)).tolist() == []
+    _, fire_times = table.evaluate([1], at(2, 7))
+    assert fire_times[0] == at(2, 22)
+
+
+def test_clock_date():
+    assert clock_date(at(2, 0, 30), NIGHT, "clockin") == date(2022, 8, 1)
+    assert clock_date(at(2, 2, 30), NIGHT, "clockin") == date(2022, 8, 2)
+    assert clock_date(at(2, 0, 30), None, "clockin") == date(2022, 8, 2)
+    # 夜班第二天早上的下班打卡和前一晚的上班打卡记在同一天
+    assert clock_date(at(2, 7), NIGHT, "clockout") == date(2022, 8, 1)
+    assert clock_date(at(2, 23), NIGHT, "clockout") == date(2022, 8, 2)
+    assert clock_date(at(2, 20), None, "clockout") == date(2022, 8, 2)
@@ -0,0 +1,167 @@
+"""
+调度循环的追踪和采样分析
+
+- `tracer.span(name)`记录一段耗时, 同一线程/协程内嵌套的span自动挂到上一层下面
+- SQL语句的耗时通过SQLAlchemy的引擎事件记成`sql` span
+- span只写进固定大小的环形缓冲区, 关闭时`span`几乎没有开销
+- `sample_stacks`按固定间隔采样所有线程的调用栈, 输出flamegraph用的折叠格式
+"""
+import sys
+import time
+import itertools
+import threading
+from typing import Dict, List
+from collections import Counter, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from config import get_config
+
+
+class Span:
+    __slots__ = (
+        "trace_id",
+        "span_id",
+        "parent_id",
+        "name",
+        "started_at",
+        "started",
+        "duration",
+        "thread",
+        "attrs",
+    )
+
+    def __init__(self, name: str, parent: "Span | None", span_id: int, attrs: dict):
+        self.span_id = span_id
+        self.parent_id = parent.span_id if parent else None
+        self.trace_id = parent.trace_id if parent else span_id
+        self.name = name
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.duration = 0.0
+        self.thread = threading.current_thread().name
+        self.attrs = attrs
+
+    def to_dict(self) -> dict:
+        return dict(
+            trace_id=self.trace_id,
+            span_id=self.span_id,
+            parent_id=self.parent_id,
+            name=self.name,
+            started_at=self.started_at,
+            duration_ms=round(self.duration * 1000, 3),
+            thread=self.thread,
+            attrs=self.attrs,
+        )
+
+
+current_span: ContextVar[Span | None] = ContextVar("current_span", default=None)
+
+
+class Tracer:
+    def __init__(self, size: int = 10000, enabled: bool = False):
+        self.enabled = enabled
+        self.spans: deque = deque(maxlen=size)
+        self.ids = itertools.count(1)
+
+    @contextmanager
+    def span(self, name: str, **attrs):
+        if not self.enabled:
+            yield None
+            return
+
+        span = Span(name, current_span.get(), next(self.ids), attrs)
+        token = current_span.set(span)
+        try:
+            yield span
+        finally:
+            span.duration = time.perf_counter() - span.started
+            current_span.reset(token)
+            self.spans.append(span)
+
+    def record(self, name: str, started: float, **attrs):
+        """记录一段已经结束的span, `started`是perf_counter的值"""
+        span = Span(name, current_span.get(), next(self.ids), attrs)
+        span.duration = time.perf_counter() - started
+        span.started = started
+        span.started_at -= span.duration
+        self.spans.append(span)
+
+    def recent(self, limit: int = 1000, name: str | None = None) -> List[dict]:
+        """最近的span, 从新到旧"""
+        spans = []
+        for span in reversed(self.spans):
+            if name and span.name != name:
+                continue
+            spans.append(span.to_dict())
+            if len(spans) >= limit:
+                break
+        return spans
+
+    def clear(self):
+        self.spans.clear()
+
+
+tracer = Tracer(
+    size=get_config()["tracing"]["buffer"],
+    enabled=get_config()["tracing"]["enabled"],
+)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if tracer.enabled and context is not None:
+        context._traced_at = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, "_traced_at", None)
+    if started is not None:
+        tracer.record(
+            "sql", started, statement=statement[:500], executemany=executemany
+        )
+
+
+profile_lock = threading.Lock()
+
+
+def sample_stacks(seconds: float, interval: float = 0.005) -> Dict[str, int]:
+    """
+    采样`seconds`秒内所有线程的调用栈
+
+    返回"线程;外层函数;...;内层函数" => 采样次数, 同时只允许一个采样
+    """
+    if not profile_lock.acquire(blocking=False):
+        raise RuntimeError("another profile is running")
+
+    try:
+        me = threading.get_ident()
+        counts: Counter = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    name = f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})"
+                    stack.append(name)
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                counts[";".join(reversed(stack))] += 1
+            time.sleep(interval)
+        return counts
+    finally:
+        profile_lock.release()
+
+
+def profile(seconds: float, interval: float = 0.005) -> str:
+    """采样结果的折叠格式, 可以直接交给flamegraph.pl/speedscope"""
+    counts = sample_stacks(seconds, interval)
+    return "\n".join(f"{stack} {count}" for stack, count in counts.most_common())
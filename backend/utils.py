@@ -6,12 +6,28 @@ SUCCESS = dict(code=0, msg="ok")
 
 
 def handles_error(func):
+    if asyncio.iscoroutinefunction(func):
+
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            try:
+                result = await func(*args, **kwargs)
+                if result is None:
+                    return SUCCESS
+                return result
+            except Exception as e:
+                logger.exception(str(e))
+                return dict(code=500, msg=str(e))
+
+        return async_wrapper
+
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
         try:
             result = func(*args, **kwargs)
             if result is None:
                 return SUCCESS
+            return result
         except Exception as e:
             logger.exception(str(e))
             return dict(code=500, msg=str(e))